@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import os
+import multiprocessing
 Ortho4XP_dir='..' if getattr(sys,'frozen',False) else '.'
 sys.path.append(os.path.join(Ortho4XP_dir,'src'))
 
@@ -18,6 +19,7 @@ import O4_Config_Utils as CFG  # CFG imported last because it can modify other m
 cmd_line="USAGE: Ortho4XP.py lat lon imagery zl (won't read a tile config)\n  OR:  Ortho4XP.py lat lon (with existing tile config file)"
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     if not os.path.isdir(FNAMES.Utils_dir):
         print("Missing ",FNAMES.Utils_dir,"directory, check your install. Exiting.")
         sys.exit()   
@@ -380,6 +380,7 @@
 #include <ctype.h>
 #include <math.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -873,6 +874,7 @@ struct behavior {
 	/*   usesegments: -p, -r, -q, or -c switch; determines whether segments
 	 * are  */
 	/*     used at all. */
+	/*   binaryio: -b switch (added for Triangle4XP). */
 	/*                                                                           */
 	/* Read the instructions to find out the meaning of these switches. */
 
@@ -887,6 +889,7 @@ struct behavior {
 	int docheck;
 	int quiet, verbose;
 	int usesegments;
+	int binaryio;
 	int order;
 	int nobisect;
 	int steiner;
@@ -1532,6 +1535,7 @@ void syntax()
 	#endif /* not REDUCED */
 	printf("    -Q  Quiet:  No terminal output except errors.\n");
 	printf("    -V  Verbose:  Detailed information on what I'm doing.\n");
+	printf("    -b  Binary input and output files (Triangle4XP).\n");
 	printf("    -h  Help:  Detailed instructions for Triangle.\n");
 	triexit(0);
 }
@@ -3138,6 +3142,7 @@ void parsecommandline(int argc, char **argv, struct behavior *b)
 	b->minangle = 0.0;
 	b->maxarea = -1.0;
 	b->quiet = b->verbose = 0;
+	b->binaryio = 0;
 #ifndef TRILIBRARY
 	b->innodefilename[0] = '\0';
 #endif /* not TRILIBRARY */
@@ -3318,6 +3323,9 @@ void parsecommandline(int argc, char **argv, struct behavior *b)
 				if (argv[i][j] == 'V') {
 					b->verbose++;
 				}
+				if (argv[i][j] == 'b') {
+					b->binaryio = 1;
+				}
 #ifndef TRILIBRARY
 				if ((argv[i][j] == 'h') ||
 				    (argv[i][j] == 'H') ||
@@ -3437,6 +3445,11 @@ void parsecommandline(int argc, char **argv, struct behavior *b)
 		       "triangulation.\n");
 		triexit(1);
 	}
+	if (b->refine && b->binaryio) {
+		printf("Error:  You cannot use the -b switch when refining a "
+		       "triangulation.\n");
+		triexit(1);
+	}
 	/* Be careful not to allocate space for element area constraints that */
 	/*   will never be assigned any value (other than the default -1.0).  */
 	if (!b->refine && !b->poly) {
@@ -3629,6 +3642,122 @@ void set_normal(REAL x, REAL y, REAL *u, REAL *v)
 	*v = -1 * grady / normvector;
 }
 
+/*****************************************************************************/
+/*    Binary files (-b switch).                                              */
+/*                                                                           */
+/*    A binary file is made of sections, each one a 32 bytes header (magic   */
+/*    "O4XPTRIB", format version, kind of items, number of items, number of  */
+/*    REAL and of int columns) followed by one packed row per item : the     */
+/*    REAL columns as little endian doubles, then the int columns as little  */
+/*    endian 32 bits integers.  A .node file is a BIN_NODES section, an .ele */
+/*    file a BIN_TRIANGLES one, and a .poly file the BIN_SEGMENTS, BIN_HOLES */
+/*    and BIN_REGIONS sections in that order (its vertices always come from  */
+/*    the .node file).  Items are numbered from one.                         */
+/*                                                                           */
+/*****************************************************************************/
+
+#define BIN_MAGIC "O4XPTRIB"
+#define BIN_FORMAT 1
+#define BIN_NODES 1
+#define BIN_TRIANGLES 2
+#define BIN_SEGMENTS 3
+#define BIN_HOLES 4
+#define BIN_REGIONS 5
+#define BIN_MAXCOLS 16
+
+void checklittleendian()
+{
+	uint32_t one = 1;
+	if (*(unsigned char *)&one != 1) {
+		printf("ERROR:  Binary files require a little endian "
+		       "machine.\n");
+		triexit(1);
+	}
+}
+
+long readbinaryheader(FILE *infile, char *filename, int kind, int *realcols,
+		      int *intcols)
+{
+	char magic[8];
+	uint32_t format, filekind, cols[2];
+	uint64_t count;
+
+	if ((fread(magic, 1, 8, infile) != 8) ||
+	    (memcmp(magic, BIN_MAGIC, 8) != 0) ||
+	    (fread(&format, 4, 1, infile) != 1) ||
+	    (fread(&filekind, 4, 1, infile) != 1) ||
+	    (fread(&count, 8, 1, infile) != 1) ||
+	    (fread(cols, 4, 2, infile) != 2)) {
+		printf("ERROR:  %s is not a binary Triangle4XP file.\n",
+		       filename);
+		triexit(1);
+	}
+	if ((format != BIN_FORMAT) || (filekind != (uint32_t)kind) ||
+	    (cols[0] > BIN_MAXCOLS) || (cols[1] > BIN_MAXCOLS)) {
+		printf("ERROR:  Unexpected section in binary file %s.\n",
+		       filename);
+		triexit(1);
+	}
+	*realcols = (int)cols[0];
+	*intcols = (int)cols[1];
+	return (long)count;
+}
+
+void readbinaryrow(FILE *infile, char *filename, REAL *reals, int realcols,
+		   int *ints, int intcols)
+{
+	double realrow[BIN_MAXCOLS];
+	int32_t introw[BIN_MAXCOLS];
+	int i;
+
+	if ((fread(realrow, 8, realcols, infile) != (size_t)realcols) ||
+	    (fread(introw, 4, intcols, infile) != (size_t)intcols)) {
+		printf("ERROR:  Unexpected end of binary file %s.\n",
+		       filename);
+		triexit(1);
+	}
+	for (i = 0; i < realcols; i++) {
+		reals[i] = (REAL)realrow[i];
+	}
+	for (i = 0; i < intcols; i++) {
+		ints[i] = (int)introw[i];
+	}
+}
+
+void writebinaryheader(FILE *outfile, int kind, long count, int realcols,
+		       int intcols)
+{
+	uint32_t fields[2];
+	uint64_t items;
+
+	fwrite(BIN_MAGIC, 1, 8, outfile);
+	fields[0] = BIN_FORMAT;
+	fields[1] = (uint32_t)kind;
+	fwrite(fields, 4, 2, outfile);
+	items = (uint64_t)count;
+	fwrite(&items, 8, 1, outfile);
+	fields[0] = (uint32_t)realcols;
+	fields[1] = (uint32_t)intcols;
+	fwrite(fields, 4, 2, outfile);
+}
+
+void writebinaryrow(FILE *outfile, REAL *reals, int realcols, int *ints,
+		    int intcols)
+{
+	double realrow[2 * BIN_MAXCOLS];
+	int32_t introw[BIN_MAXCOLS];
+	int i;
+
+	for (i = 0; i < realcols; i++) {
+		realrow[i] = (double)reals[i];
+	}
+	for (i = 0; i < intcols; i++) {
+		introw[i] = (int32_t)ints[i];
+	}
+	fwrite(realrow, 8, realcols, outfile);
+	fwrite(introw, 4, intcols, outfile);
+}
+
 /*****************************************************************************/
 /*                                                                           */
 /*  triunsuitable()   Determine if a triangle is unsuitable, and thus must   */
@@ -12995,6 +13124,9 @@ void formskeleton(struct mesh *m, struct behavior *b, FILE *polyfile,
 #else  /* not TRILIBRARY */
 	char inputline[INPUTLINESIZE];
 	char *stringptr;
+	REAL reals[BIN_MAXCOLS];
+	int ints[BIN_MAXCOLS];
+	int realcols, intcols;
 #endif /* not TRILIBRARY */
 	vertex endpoint1, endpoint2;
 	int segmentmarkers;
@@ -13015,15 +13147,30 @@ void formskeleton(struct mesh *m, struct behavior *b, FILE *polyfile,
 		segmentmarkers = segmentmarkerlist != (int *)NULL;
 		index = 0;
 #else  /* not TRILIBRARY */
-		/* Read the segments from a .poly file. */
-		/* Read number of segments and number of boundary markers. */
-		stringptr = readline(inputline, polyfile, polyfilename);
-		m->insegments = (int)strtol(stringptr, &stringptr, 0);
-		stringptr = findfield(stringptr);
-		if (*stringptr == '\0') {
-			segmentmarkers = 0;
+		if (b->binaryio) {
+			m->insegments = (int)readbinaryheader(
+			    polyfile, polyfilename, BIN_SEGMENTS, &realcols,
+			    &intcols);
+			if (intcols < 2) {
+				printf("Error:  Segments have no endpoints in "
+				       "%s.\n",
+				       polyfilename);
+				triexit(1);
+			}
+			segmentmarkers = intcols > 2;
 		} else {
-			segmentmarkers = (int)strtol(stringptr, &stringptr, 0);
+			/* Read the segments from a .poly file. */
+			/* Read number of segments and number of boundary
+			 * markers. */
+			stringptr = readline(inputline, polyfile, polyfilename);
+			m->insegments = (int)strtol(stringptr, &stringptr, 0);
+			stringptr = findfield(stringptr);
+			if (*stringptr == '\0') {
+				segmentmarkers = 0;
+			} else {
+				segmentmarkers =
+				    (int)strtol(stringptr, &stringptr, 0);
+			}
 		}
 #endif /* not TRILIBRARY */
 		/* If the input vertices are collinear, there is no
@@ -13053,33 +13200,47 @@ void formskeleton(struct mesh *m, struct behavior *b, FILE *polyfile,
 				boundmarker = segmentmarkerlist[i];
 			}
 #else  /* not TRILIBRARY */
-			stringptr =
-			    readline(inputline, polyfile, b->inpolyfilename);
-			stringptr = findfield(stringptr);
-			if (*stringptr == '\0') {
-				printf("Error:  Segment %d has no endpoints in "
-				       "%s.\n",
-				       b->firstnumber + i, polyfilename);
-				triexit(1);
-			} else {
-				end1 = (int)strtol(stringptr, &stringptr, 0);
-			}
-			stringptr = findfield(stringptr);
-			if (*stringptr == '\0') {
-				printf("Error:  Segment %d is missing its "
-				       "second endpoint in %s.\n",
-				       b->firstnumber + i, polyfilename);
-				triexit(1);
+			if (b->binaryio) {
+				readbinaryrow(polyfile, polyfilename, reals,
+					      realcols, ints, intcols);
+				end1 = ints[0];
+				end2 = ints[1];
+				if (segmentmarkers) {
+					boundmarker = ints[2];
+				}
 			} else {
-				end2 = (int)strtol(stringptr, &stringptr, 0);
-			}
-			if (segmentmarkers) {
+				stringptr = readline(inputline, polyfile,
+						     b->inpolyfilename);
 				stringptr = findfield(stringptr);
 				if (*stringptr == '\0') {
-					boundmarker = 0;
+					printf("Error:  Segment %d has no "
+					       "endpoints in %s.\n",
+					       b->firstnumber + i,
+					       polyfilename);
+					triexit(1);
 				} else {
-					boundmarker = (int)strtol(
-					    stringptr, &stringptr, 0);
+					end1 = (int)strtol(stringptr,
+							   &stringptr, 0);
+				}
+				stringptr = findfield(stringptr);
+				if (*stringptr == '\0') {
+					printf("Error:  Segment %d is missing "
+					       "its second endpoint in %s.\n",
+					       b->firstnumber + i,
+					       polyfilename);
+					triexit(1);
+				} else {
+					end2 = (int)strtol(stringptr,
+							   &stringptr, 0);
+				}
+				if (segmentmarkers) {
+					stringptr = findfield(stringptr);
+					if (*stringptr == '\0') {
+						boundmarker = 0;
+					} else {
+						boundmarker = (int)strtol(
+						    stringptr, &stringptr, 0);
+					}
 				}
 			}
 #endif /* not TRILIBRARY */
@@ -14651,6 +14812,100 @@ char *findfield(char *string)
 
 #endif /* not TRILIBRARY */
 
+/*****************************************************************************/
+/*                                                                           */
+/*  readbinarynodes()   Read the vertices from a binary .node file, and open */
+/*                      the binary .poly file if any (-b switch).            */
+/*                                                                           */
+/*****************************************************************************/
+
+#ifndef TRILIBRARY
+
+void readbinarynodes(struct mesh *m, struct behavior *b, char *nodefilename,
+		     char *polyfilename, FILE **polyfile)
+
+{
+	FILE *infile;
+	vertex vertexloop;
+	REAL reals[BIN_MAXCOLS];
+	int ints[BIN_MAXCOLS];
+	int realcols, intcols;
+	REAL x, y;
+	int i, j;
+
+	checklittleendian();
+	if (b->poly) {
+		if (!b->quiet) {
+			printf("   Opening %s.\n", polyfilename);
+		}
+		*polyfile = fopen(polyfilename, "rb");
+		if (*polyfile == (FILE *)NULL) {
+			printf("ERROR:  Cannot access file %s.\n",
+			       polyfilename);
+			triexit(1);
+		}
+	} else {
+		*polyfile = (FILE *)NULL;
+	}
+	m->readnodefile = 1;
+	if (!b->quiet) {
+		printf("   Opening %s.\n", nodefilename);
+	}
+	infile = fopen(nodefilename, "rb");
+	if (infile == (FILE *)NULL) {
+		printf("ERROR:  Cannot access file %s.\n", nodefilename);
+		triexit(1);
+	}
+	m->invertices = (int)readbinaryheader(infile, nodefilename, BIN_NODES,
+					      &realcols, &intcols);
+	m->mesh_dim = 2;
+	if (realcols < 2) {
+		printf("ERROR:  Vertices have no coordinates in %s.\n",
+		       nodefilename);
+		triexit(1);
+	}
+	m->nextras = realcols - 2;
+	b->firstnumber = 1;
+
+	if (m->invertices < 3) {
+		printf(
+		    "ERROR:  Input must have at least three input vertices.\n");
+		triexit(1);
+	}
+	if (m->nextras == 0) {
+		b->weighted = 0;
+	}
+
+	initializevertexpool(m, b);
+
+	for (i = 0; i < m->invertices; i++) {
+		vertexloop = (vertex)poolalloc(&m->vertices);
+		readbinaryrow(infile, nodefilename, reals, realcols, ints,
+			      intcols);
+		for (j = 0; j < realcols; j++) {
+			vertexloop[j] = reals[j];
+		}
+		setvertexmark(vertexloop, (intcols > 0) ? ints[0] : 0);
+		setvertextype(vertexloop, INPUTVERTEX);
+		x = reals[0];
+		y = reals[1];
+		if (i == 0) {
+			m->xmin = m->xmax = x;
+			m->ymin = m->ymax = y;
+		} else {
+			m->xmin = (x < m->xmin) ? x : m->xmin;
+			m->xmax = (x > m->xmax) ? x : m->xmax;
+			m->ymin = (y < m->ymin) ? y : m->ymin;
+			m->ymax = (y > m->ymax) ? y : m->ymax;
+		}
+	}
+	fclose(infile);
+
+	m->xminextreme = 10 * m->xmin - 9 * m->xmax;
+}
+
+#endif /* not TRILIBRARY */
+
 /*****************************************************************************/
 /*                                                                           */
 /*  readnodes()   Read the vertices from a file, which may be a .node or     */
@@ -14675,6 +14930,10 @@ void readnodes(struct mesh *m, struct behavior *b, char *nodefilename,
 	int currentmarker;
 	int i, j;
 
+	if (b->binaryio) {
+		readbinarynodes(m, b, nodefilename, polyfilename, polyfile);
+		return;
+	}
 	if (b->poly) {
 		/* Read the vertices from a .poly file. */
 		if (!b->quiet) {
@@ -14934,6 +15193,82 @@ void transfernodes(struct mesh *m, struct behavior *b, REAL *pointlist,
 
 #endif /* TRILIBRARY */
 
+/*****************************************************************************/
+/*                                                                           */
+/*  readbinaryholes()   Read the holes, and possibly regional attributes and */
+/*                      area constraints, from a binary .poly file.          */
+/*                                                                           */
+/*****************************************************************************/
+
+#ifndef TRILIBRARY
+
+void readbinaryholes(struct mesh *m, struct behavior *b, FILE *polyfile,
+		     char *polyfilename, REAL **hlist, int *holes,
+		     REAL **rlist, int *regions)
+
+{
+	REAL *holelist;
+	REAL *regionlist;
+	REAL reals[BIN_MAXCOLS];
+	int ints[BIN_MAXCOLS];
+	int realcols, intcols;
+	int i;
+
+	*holes = (int)readbinaryheader(polyfile, polyfilename, BIN_HOLES,
+				       &realcols, &intcols);
+	if (realcols < 2) {
+		printf("ERROR:  Holes have no coordinates in %s.\n",
+		       polyfilename);
+		triexit(1);
+	}
+	if (*holes > 0) {
+		holelist = (REAL *)trimalloc(2 * *holes * (int)sizeof(REAL));
+		*hlist = holelist;
+		for (i = 0; i < *holes; i++) {
+			readbinaryrow(polyfile, polyfilename, reals, realcols,
+				      ints, intcols);
+			holelist[2 * i] = reals[0];
+			holelist[2 * i + 1] = reals[1];
+		}
+	} else {
+		*hlist = (REAL *)NULL;
+	}
+
+	*regions = 0;
+	*rlist = (REAL *)NULL;
+	#ifndef CDT_ONLY
+	if ((b->regionattrib || b->vararea) && !b->refine) {
+		*regions = (int)readbinaryheader(polyfile, polyfilename,
+						 BIN_REGIONS, &realcols,
+						 &intcols);
+		if (realcols < 3) {
+			printf("Error:  Regions have no region attribute or "
+			       "area constraint in %s.\n",
+			       polyfilename);
+			triexit(1);
+		}
+		if (*regions > 0) {
+			regionlist =
+			    (REAL *)trimalloc(4 * *regions * (int)sizeof(REAL));
+			*rlist = regionlist;
+			for (i = 0; i < *regions; i++) {
+				readbinaryrow(polyfile, polyfilename, reals,
+					      realcols, ints, intcols);
+				regionlist[4 * i] = reals[0];
+				regionlist[4 * i + 1] = reals[1];
+				regionlist[4 * i + 2] = reals[2];
+				regionlist[4 * i + 3] =
+				    (realcols > 3) ? reals[3] : reals[2];
+			}
+		}
+	}
+	#endif /* not CDT_ONLY */
+
+	fclose(polyfile);
+}
+
+#endif /* not TRILIBRARY */
+
 /*****************************************************************************/
 /*                                                                           */
 /*  readholes()   Read the holes, and possibly regional attributes and area  */
@@ -14955,6 +15290,11 @@ void readholes(struct mesh *m, struct behavior *b, FILE *polyfile,
 	int index;
 	int i;
 
+	if (b->binaryio) {
+		readbinaryholes(m, b, polyfile, polyfilename, hlist, holes,
+				rlist, regions);
+		return;
+	}
 	/* Read the holes. */
 	stringptr = readline(inputline, polyfile, polyfilename);
 	*holes = (int)strtol(stringptr, &stringptr, 0);
@@ -15268,6 +15608,77 @@ void writenodes(struct mesh *m, struct behavior *b, char *nodefilename,
 #endif /* not TRILIBRARY */
 }
 
+/*****************************************************************************/
+/*                                                                           */
+/*  writebinarynodes()   Number the vertices and write them to a binary      */
+/*                       .node file (-b switch), with the same altitude and  */
+/*                       normal attributes as writenodes().                  */
+/*                                                                           */
+/*****************************************************************************/
+
+#ifndef TRILIBRARY
+
+void writebinarynodes(struct mesh *m, struct behavior *b, char *nodefilename)
+
+{
+	FILE *outfile;
+	vertex vertexloop;
+	long outvertices;
+	int vertexnumber;
+	REAL reals[BIN_MAXCOLS + 3];
+	int marker;
+	int i;
+	double X, Y, XX, YY;
+
+	if (b->jettison) {
+		outvertices = m->vertices.items - m->undeads;
+	} else {
+		outvertices = m->vertices.items;
+	}
+	printf("   Computing altitude and normal maps.\n");
+	outfile = fopen(nodefilename, "wb");
+	if (outfile == (FILE *)NULL) {
+		printf("   Error:  Cannot create file %s.\n", nodefilename);
+		triexit(1);
+	}
+	/* x, y, altitude z, normal components u & v, then the attributes. */
+	writebinaryheader(outfile, BIN_NODES, outvertices, 5 + m->nextras,
+			  1 - b->nobound);
+
+	traversalinit(&m->vertices);
+	vertexnumber = b->firstnumber;
+	vertexloop = vertextraverse(m);
+	while (vertexloop != (vertex)NULL) {
+		if (!b->jettison || (vertextype(vertexloop) != UNDEADVERTEX)) {
+			X = vertexloop[0];
+			Y = vertexloop[1];
+			XX = X > X0 ? X : X0;
+			XX = XX < X1 ? XX : X1;
+			YY = Y > Y0 ? Y : Y0;
+			YY = YY < Y1 ? YY : Y1;
+			reals[2] = altitude(XX, YY);
+			set_normal(XX, YY, &reals[3], &reals[4]);
+			X = X > 0 ? X : 0;
+			reals[0] = X < 1 ? X : 1;
+			Y = Y > 0 ? Y : 0;
+			reals[1] = Y < 1 ? Y : 1;
+			for (i = 0; i < m->nextras; i++) {
+				reals[5 + i] = vertexloop[i + 2];
+			}
+			marker = vertexmark(vertexloop);
+			writebinaryrow(outfile, reals, 5 + m->nextras, &marker,
+				       1 - b->nobound);
+			setvertexmark(vertexloop, vertexnumber);
+			vertexnumber++;
+		}
+		vertexloop = vertextraverse(m);
+	}
+	fclose(outfile);
+	printf("   Node file %s written to disk.\n", nodefilename);
+}
+
+#endif /* not TRILIBRARY */
+
 /*****************************************************************************/
 /*                                                                           */
 /*  numbernodes()   Number the vertices.                                     */
@@ -15423,6 +15834,73 @@ void writeelements(struct mesh *m, struct behavior *b, char *elefilename,
 #endif /* not TRILIBRARY */
 }
 
+/*****************************************************************************/
+/*                                                                           */
+/*  writebinaryelements()   Write the triangles to a binary .ele file (-b    */
+/*                          switch).                                         */
+/*                                                                           */
+/*****************************************************************************/
+
+#ifndef TRILIBRARY
+
+void writebinaryelements(struct mesh *m, struct behavior *b,
+			 char *elefilename)
+
+{
+	FILE *outfile;
+	struct otri triangleloop;
+	vertex p1, p2, p3;
+	vertex mid1, mid2, mid3;
+	REAL reals[BIN_MAXCOLS];
+	int corners[6];
+	int nbrcorners;
+	int i;
+
+	printf("   Tri file  %s  written to disk.\n", elefilename);
+	outfile = fopen(elefilename, "wb");
+	if (outfile == (FILE *)NULL) {
+		printf("   Error:  Cannot create file %s.\n", elefilename);
+		triexit(1);
+	}
+	if (m->eextras > BIN_MAXCOLS) {
+		printf("   Error:  Too many triangle attributes for a binary "
+		       "file.\n");
+		triexit(1);
+	}
+	nbrcorners = (b->order + 1) * (b->order + 2) / 2;
+	writebinaryheader(outfile, BIN_TRIANGLES, m->triangles.items,
+			  m->eextras, nbrcorners);
+
+	traversalinit(&m->triangles);
+	triangleloop.tri = triangletraverse(m);
+	triangleloop.orient = 0;
+	while (triangleloop.tri != (triangle *)NULL) {
+		org(triangleloop, p1);
+		dest(triangleloop, p2);
+		apex(triangleloop, p3);
+		corners[0] = vertexmark(p1);
+		corners[1] = vertexmark(p2);
+		corners[2] = vertexmark(p3);
+		if (b->order > 1) {
+			mid1 = (vertex)triangleloop.tri[m->highorderindex + 1];
+			mid2 = (vertex)triangleloop.tri[m->highorderindex + 2];
+			mid3 = (vertex)triangleloop.tri[m->highorderindex];
+			corners[3] = vertexmark(mid1);
+			corners[4] = vertexmark(mid2);
+			corners[5] = vertexmark(mid3);
+		}
+		for (i = 0; i < m->eextras; i++) {
+			reals[i] = elemattribute(triangleloop, i);
+		}
+		writebinaryrow(outfile, reals, m->eextras, corners,
+			       nbrcorners);
+		triangleloop.tri = triangletraverse(m);
+	}
+	fclose(outfile);
+}
+
+#endif /* not TRILIBRARY */
+
 /*****************************************************************************/
 /*                                                                           */
 /*  writepoly()   Write the segments and holes to a .poly file.              */
@@ -16795,7 +17273,11 @@ int main(int argc, char **argv)
 		writenodes(&m, &b, &out->pointlist, &out->pointattributelist,
 			   &out->pointmarkerlist);
 #else  /* not TRILIBRARY */
-		writenodes(&m, &b, b.outnodefilename, argc, argv);
+		if (b.binaryio) {
+			writebinarynodes(&m, &b, b.outnodefilename);
+		} else {
+			writenodes(&m, &b, b.outnodefilename, argc, argv);
+		}
 #endif /* TRILIBRARY */
 	}
 	if (b.noelewritten) {
@@ -16811,7 +17293,11 @@ int main(int argc, char **argv)
 		writeelements(&m, &b, &out->trianglelist,
 			      &out->triangleattributelist);
 #else  /* not TRILIBRARY */
-		writeelements(&m, &b, b.outelefilename, argc, argv);
+		if (b.binaryio) {
+			writebinaryelements(&m, &b, b.outelefilename);
+		} else {
+			writeelements(&m, &b, b.outelefilename, argc, argv);
+		}
 #endif /* not TRILIBRARY */
 	}
 	/* The -c switch (convex switch) causes a PSLG to be written */
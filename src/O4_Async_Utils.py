@@ -0,0 +1,198 @@
+import time
+import atexit
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import O4_UI_Utils as UI
+
+has_aiohttp = False
+try:
+    import aiohttp
+
+    has_aiohttp = True
+except:
+    pass
+
+################################################################################
+# A single asyncio event loop per process, running in a daemon thread, to
+# which blocking code hands coroutines with run(). HTTP requests share one
+# pooled session (aiohttp if present, otherwise a requests session driven
+# from a thread pool so that the same code keeps working) whose size,
+# max_async_requests, caps the number of connections, and requests to a given
+# provider are further limited by its own limiter.
+################################################################################
+
+max_async_requests = 128
+
+loop = None
+loop_lock = threading.Lock()
+session = None
+executor = None
+limiters = {}
+
+################################################################################
+def start_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            new_loop = asyncio.new_event_loop()
+            threading.Thread(target=new_loop.run_forever, daemon=True).start()
+            loop = new_loop
+    return loop
+
+
+################################################################################
+def close_session():
+    # The loop thread is a daemon, the aiohttp session must be closed from
+    # it before the interpreter exits.
+    if loop is None or not has_aiohttp or session is None or session.closed:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+    except:
+        pass
+
+
+atexit.register(close_session)
+
+
+################################################################################
+def run(coroutine):
+    # Schedules the coroutine on the shared loop, returns a
+    # concurrent.futures.Future.
+    return asyncio.run_coroutine_threadsafe(coroutine, start_loop())
+
+
+################################################################################
+class limiter:
+    # At most max_requests simultaneous requests and, if max_rate is set, at
+    # most max_rate request starts per second.
+    def __init__(self, max_requests, max_rate=None):
+        self.semaphore = asyncio.Semaphore(max_requests)
+        self.interval = 1 / max_rate if max_rate else 0
+        self.next_start = 0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.interval:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+
+################################################################################
+def get_limiter(key, max_requests, max_rate=None):
+    # Only to be called from within the loop. The limits are part of the key,
+    # so that a change of them (e.g. from the config) takes effect.
+    key = (key, max_requests, max_rate)
+    if key not in limiters:
+        limiters[key] = limiter(max_requests, max_rate)
+    return limiters[key]
+
+
+################################################################################
+async def backoff(attempt, base=2, cap=30):
+    # Exponential backoff with jitter, it only suspends the calling request.
+    await asyncio.sleep(min(cap, base * 2 ** attempt) * random.uniform(0.5, 1))
+
+
+################################################################################
+async def http_get(url, headers, timeout, provider_limiter=None):
+    # Returns (status_code, headers, content), raises on connection errors
+    # (aiohttp.ClientError, asyncio.TimeoutError or requests exceptions).
+    # As for requests, timeout is either a total or a (connect, read) tuple,
+    # the latter leaves no bound on the duration of a steady download.
+    global session, executor
+    if provider_limiter is None:
+        provider_limiter = get_limiter(None, max_async_requests)
+    async with provider_limiter:
+        if has_aiohttp:
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=max_async_requests, ttl_dns_cache=300
+                    )
+                )
+            if isinstance(timeout, tuple):
+                client_timeout = aiohttp.ClientTimeout(
+                    sock_connect=timeout[0], sock_read=timeout[1]
+                )
+            else:
+                client_timeout = aiohttp.ClientTimeout(total=timeout)
+            async with session.get(
+                url, headers=headers, timeout=client_timeout
+            ) as r:
+                content = await r.read()
+                return (r.status, r.headers, content)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_async_requests)
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=32, pool_maxsize=max_async_requests
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        r = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            lambda: session.get(url, headers=headers, timeout=timeout),
+        )
+        return (r.status_code, r.headers, r.content)
+
+
+################################################################################
+def is_connection_error(e):
+    if isinstance(
+        e, (asyncio.TimeoutError, requests.exceptions.RequestException)
+    ):
+        return True
+    return has_aiohttp and isinstance(e, aiohttp.ClientError)
+
+
+################################################################################
+async def in_thread(function, *args):
+    # CPU bound work (image decoding, pasting) off the loop.
+    return await asyncio.get_running_loop().run_in_executor(
+        None, function, *args
+    )
+
+
+################################################################################
+async def gather_queue(task, queue, progress=None):
+    # Asyncio counterpart of parallel_execute : all the arguments in queue
+    # are run concurrently through the coroutine task, the limiters decide
+    # how many of them actually hit the network.
+    jobs = []
+    while not queue.empty():
+        jobs.append(queue.get())
+    remaining = [len(jobs)]
+
+    async def run_job(args):
+        if UI.red_flag:
+            return 0
+        try:
+            success = await task(*args)
+        except Exception as e:
+            UI.vprint(2, "Asynchronous download failed:", e)
+            success = 0
+        remaining[0] -= 1
+        if progress:
+            progress["done"] += 1
+            UI.progress_bar(
+                progress["bar"],
+                int(
+                    100 * progress["done"] / (progress["done"] + remaining[0])
+                ),
+            )
+        return success
+
+    results = await asyncio.gather(*(run_job(args) for args in jobs))
+    if UI.red_flag:
+        return 0
+    return int(all(results))
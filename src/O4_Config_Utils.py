@@ -1,4 +1,5 @@
 import os
+import sys
 from math import ceil
 import tkinter as tk
 import tkinter.ttk as ttk
@@ -7,9 +8,15 @@ import O4_File_Names as FNAMES
 import O4_UI_Utils as UI
 import O4_DEM_Utils as DEM
 import O4_OSM_Utils as OSM
+import O4_OSM_Extracts as EXTRACTS
 import O4_Vector_Map as VMAP
 import O4_Imagery_Utils as IMG
+import O4_Imagery_Cache as ICACHE
+import O4_Async_Utils as AIO
+import O4_Stats_Utils as STATS
 import O4_Tile_Utils as TILE
+import O4_Mask_Utils as MASK
+import O4_Mesh_Utils as MESH
 import O4_Overlay_Utils as OVL
 
 
@@ -47,6 +54,19 @@ redo any prior step; Level 0 keeps every single file.",
 modified on the fly (as all _Application_ variables) in case of problem with \
 a particular server.",
     },
+    "max_overpass_requests": {
+        "module": "OSM",
+        "type": int,
+        "default": 2,
+        "values": (1, 2, 3, 4),
+        "hint": "Number of simultaneous queries sent to each Overpass server. The OSM layers of a tile are downloaded at once and spread over the servers (according to their recent failures when the server choice is random), public servers only grant a couple of slots per user.",
+    },
+    "use_osm_extracts": {
+        "module": "EXTRACTS",
+        "type": bool,
+        "default": True,
+        "hint": "When set, tiles entirely covered by a regional extract ingested in OSM_data/Extracts (see O4_OSM_Extracts.py) get their OSM data from it instead of Overpass.",
+    },
     "skip_downloads": {
         "module": "TILE",
         "type": bool,
@@ -59,6 +79,13 @@ a particular server.",
         "default": False,
         "hint": "Imagery will be downloaded but not converted from jpg to dds. Some user prefer to postprocess imagery with third party softwares prior to the dds conversion. In that case Step 3 needs to be run a second time after the retouch work.",
     },
+    "max_download_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4, 6, 8),
+        "hint": "Number of textures downloaded simultaneously during Step 3. Values above 1 keep the conversion workers busy with providers which are slow to serve a whole texture (high latency WMS servers in particular).",
+    },
     "max_convert_slots": {
         "module": "TILE",
         "type": int,
@@ -66,6 +93,34 @@ a particular server.",
         "values": (1, 2, 3, 4, 5, 6, 7, 8),
         "hint": "Number of parallel threads for dds conversion. Should be mainly dictated by the number of cores in your CPU.",
     },
+    "dds_encoder": {
+        "module": "IMG",
+        "type": str,
+        "default": "nvcompress",
+        "values": ("nvcompress", "builtin"),
+        "hint": "Tool used for the dds conversion of textures. nvcompress is an external program, the builtin encoder (BC1/BC3 with mipmaps, quality close to nvcompress -fast) works on the images in memory and so avoids the intermediate png files for combined, color filtered or masked textures. With the builtin encoder and max_convert_slots above 1, textures are encoded in that many separate processes.",
+    },
+    "max_batch_workers": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+        "hint": "Number of tiles built simultaneously (each in its own process) during a batch build. Value 1 keeps the classical tile after tile processing. Above 1, batch steps are pipelined across tiles and this is the number of slots for CPU bound steps (vector data, mesh, masks). Each worker runs its own Triangle4XP and conversion threads, so memory rather than cores is often the limiting factor.",
+    },
+    "batch_network_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 2,
+        "values": (1, 2, 3, 4, 6, 8),
+        "hint": "In a pipelined batch build (max_batch_workers above 1), number of simultaneous network bound steps : OSM downloads and imagery/DSF builds.",
+    },
+    "batch_disk_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4),
+        "hint": "In a pipelined batch build (max_batch_workers above 1), number of simultaneous disk bound steps (overlay extraction).",
+    },
     "check_tms_response": {
         "module": "IMG",
         "type": bool,
@@ -90,6 +145,64 @@ a particular server.",
         "default": 5,
         "hint": "How much times do we try again after an internal server error for an imagery request. Only used if check_tms_response is set to True.",
     },
+    "max_inflight_requests": {
+        "module": "IMG",
+        "type": int,
+        "default": 64,
+        "values": (16, 32, 64, 128, 256),
+        "hint": "Maximum number of simultaneous imagery requests, all textures being downloaded together (download_engine = threads, the asyncio engine uses max_async_requests instead).",
+    },
+    "download_engine": {
+        "module": "IMG",
+        "type": str,
+        "default": "threads",
+        "values": ("threads", "asyncio"),
+        "hint": "How imagery subtiles (TMS/WMTS providers) are downloaded. With threads, each texture uses up to max_threads (provider setting, 16 by default) threads. With asyncio, all requests of the process go through a single event loop and a shared connection pool, the provider max_threads (and optional max_rate, in requests per second) then limit the simultaneous requests per provider and waits between retries do not block other requests. Requires aiohttp (see requirements.txt) for true asynchronous HTTP, without it requests are sent from a pool of max_async_requests threads driven by the event loop.",
+    },
+    "max_async_requests": {
+        "module": "AIO",
+        "type": int,
+        "default": 128,
+        "values": (16, 32, 64, 128, 256, 512),
+        "hint": "With download_engine = asyncio, maximum number of simultaneous HTTP connections, all providers together.",
+    },
+    "subtile_cache_size": {
+        "module": "ICACHE",
+        "type": float,
+        "default": 0,
+        "hint": "Maximum size (in GB) of the local cache of imagery subtiles (TMS/WMTS providers), 0 disables it. Subtiles are kept per provider, zoomlevel and position, so that a change of zoomlevel or of a combined provider does not download them again. The least recently used ones are discarded when the cache is full. It lives in Orthophotos/subtile_cache.db.",
+    },
+    "elevation_disk_cache": {
+        "module": "DEM",
+        "type": bool,
+        "default": False,
+        "hint": "Keep the decoded elevation of each HGT file (upsampled to 1\" when needed) as a float32 .npy file next to it, which is then memory mapped instead of decoded again by the next steps and neighbouring tiles. Takes twice the disk space of the HGT files.",
+    },
+    "max_cached_rasters": {
+        "module": "DEM",
+        "type": int,
+        "default": 9,
+        "hint": "Number of decoded elevation files (about 50MB each) kept in memory by each Ortho4XP process for the next steps and neighbouring tiles. 0 disables it.",
+    },
+    "write_reports": {
+        "module": "STATS",
+        "type": bool,
+        "default": False,
+        "hint": "At the end of each step, write the time spent in its main phases (OSM download and parsing, Triangle4XP, quadtree, DSF writing, texture downloads and conversions, masks...), the number of bytes downloaded and written and the peak memory use to Ortho4XP_+XX+YYY_report.json (and .csv) in the build directory of the tile.",
+    },
+    "masks_build_engine": {
+        "module": "MASK",
+        "type": str,
+        "default": "threads",
+        "values": ("threads", "processes"),
+        "hint": "How the mask tiles of Step 2.5 are built in parallel (4 at a time). Threads share the memory of Ortho4XP but hardly use more than one core. Processes use as many cores, the water triangles and the elevation data are then written once to temporary files in the build directory and shared with them.",
+    },
+    "triangle_binary_io": {
+        "module": "MESH",
+        "type": bool,
+        "default": True,
+        "hint": "Exchange the node, poly and ele files with Triangle4XP in a binary format rather than as text, which is much faster to write and read for large tiles. Only used when the Triangle4XP binary supports it (-b switch) and cleaning_level is not 0 (Step 2 iterations need the text files), the text files are used otherwise.",
+    },
     "ovl_exclude_pol": {
         "module": "OVL",
         "type": list,
@@ -355,13 +468,29 @@ list_app_vars = [
     "verbosity",
     "cleaning_level",
     "overpass_server_choice",
+    "max_overpass_requests",
+    "use_osm_extracts",
     "skip_downloads",
     "skip_converts",
+    "max_download_slots",
     "max_convert_slots",
+    "dds_encoder",
+    "max_batch_workers",
+    "batch_network_slots",
+    "batch_disk_slots",
     "check_tms_response",
     "http_timeout",
     "max_connect_retries",
     "max_baddata_retries",
+    "max_inflight_requests",
+    "download_engine",
+    "max_async_requests",
+    "subtile_cache_size",
+    "elevation_disk_cache",
+    "max_cached_rasters",
+    "write_reports",
+    "masks_build_engine",
+    "triangle_binary_io",
     "ovl_exclude_pol",
     "ovl_exclude_net",
     "custom_scenery_dir",
@@ -481,6 +610,21 @@ except:
     print("No global config file found. Reverting to default values.")
 
 
+################################################################################
+def app_vars_values():
+    # Current values of the application variables, keyed by (module name,
+    # variable) so that spawned worker processes can set them back.
+    app_vars = {}
+    for var in list_app_vars:
+        module = (
+            globals()[cfg_vars[var]["module"]]
+            if "module" in cfg_vars[var]
+            else sys.modules[__name__]
+        )
+        app_vars[(module.__name__, var)] = getattr(module, var)
+    return app_vars
+
+
 ################################################################################
 class Tile:
     def __init__(self, lat, lon, custom_build_dir):
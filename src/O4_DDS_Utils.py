@@ -0,0 +1,231 @@
+import os
+import struct
+import time
+import numpy
+from PIL import Image
+
+################################################################################
+# Built-in BC1 (DXT1) / BC3 (DXT5) encoder, an alternative to nvcompress which
+# takes images directly from memory. End points are the (slightly inset)
+# bounding box of each 4x4 block and pixels are projected on the segment
+# between them, which is what nvcompress -fast roughly does too. All blocks
+# of a band of rows are treated at once with numpy, and the full mipmap chain
+# down to 1x1 is built with a box filter.
+################################################################################
+
+band_rows = 256  # pixel rows encoded at once, bounds the memory footprint
+
+bc1_index_map = numpy.array([1, 3, 2, 0], dtype=numpy.uint32)
+bc3_index_map = numpy.array([1, 7, 6, 5, 4, 3, 2, 0], dtype=numpy.uint64)
+
+################################################################################
+def dds_header(width, height, mipmap_count, fourcc, linear_size):
+    # DDSD_CAPS | HEIGHT | WIDTH | PIXELFORMAT | MIPMAPCOUNT | LINEARSIZE
+    flags = 0x1 | 0x2 | 0x4 | 0x1000 | 0x20000 | 0x80000
+    # DDSCAPS_COMPLEX | TEXTURE | MIPMAP
+    caps = 0x8 | 0x1000 | 0x400000
+    return (
+        b"DDS "
+        + struct.pack(
+            "<7I44x", 124, flags, height, width, linear_size, 0, mipmap_count
+        )
+        + struct.pack("<2I4s20x", 32, 0x4, fourcc)
+        + struct.pack("<I16x", caps)
+    )
+
+
+################################################################################
+def image_blocks(arr):
+    # (h,w,c) -> (16,h*w/16,c), blocks in row major order, pixels too. Pixels
+    # come first so that reductions over a block are plain elementwise ops.
+    (h, w, c) = arr.shape
+    return (
+        arr.reshape(h // 4, 4, w // 4, 4, c)
+        .transpose(1, 3, 0, 2, 4)
+        .reshape(16, -1, c)
+    )
+
+
+################################################################################
+def encode_color_blocks(blocks, force_four_colors):
+    # blocks is (16,n,3) uint8, returns (n,4) uint16 : c0, c1 and indices.
+    pix = blocks.astype(numpy.float32)
+    cmin = pix.min(axis=0)
+    cmax = pix.max(axis=0)
+    inset = (cmax - cmin) / 16
+    cmin += inset
+    cmax -= inset
+    scale = numpy.array([31, 63, 31], dtype=numpy.float32) / 255
+    q0 = numpy.rint(cmax * scale).astype(numpy.uint16)
+    q1 = numpy.rint(cmin * scale).astype(numpy.uint16)
+    c0 = (q0[:, 0] << 11) | (q0[:, 1] << 5) | q0[:, 2]
+    c1 = (q1[:, 0] << 11) | (q1[:, 1] << 5) | q1[:, 2]
+    # Only needed for BC1, otherwise the three colors mode would be selected
+    if not force_four_colors:
+        swap = c0 < c1
+        (c0[swap], c1[swap]) = (c1[swap], c0[swap])
+        (q0[swap], q1[swap]) = (q1[swap], q0[swap])
+    # end points as they will be decoded
+    e0 = expand_565(q0)
+    e1 = expand_565(q1)
+    axis = e0 - e1
+    norm = (axis * axis).sum(axis=1)
+    norm[norm == 0] = 1
+    pix -= e1
+    t = pix[:, :, 0] * axis[:, 0]
+    t += pix[:, :, 1] * axis[:, 1]
+    t += pix[:, :, 2] * axis[:, 2]
+    t *= 3 / norm
+    steps = numpy.clip(numpy.rint(t), 0, 3).astype(numpy.intp)
+    idx = bc1_index_map[steps]
+    idx[:, c0 == c1] = 0
+    bits = numpy.zeros(blocks.shape[1], dtype=numpy.uint32)
+    for k in range(16):
+        bits |= idx[k] << (2 * k)
+    out = numpy.empty((blocks.shape[1], 4), dtype="<u2")
+    out[:, 0] = c0
+    out[:, 1] = c1
+    out[:, 2] = bits & 0xFFFF
+    out[:, 3] = bits >> 16
+    return out
+
+
+################################################################################
+def expand_565(q):
+    e = numpy.empty(q.shape, dtype=numpy.float32)
+    e[:, 0] = (q[:, 0] << 3) | (q[:, 0] >> 2)
+    e[:, 1] = (q[:, 1] << 2) | (q[:, 1] >> 4)
+    e[:, 2] = (q[:, 2] << 3) | (q[:, 2] >> 2)
+    return e
+
+
+################################################################################
+def encode_alpha_blocks(blocks):
+    # blocks is (16,n) uint8, returns (n,8) uint8 : a0, a1 and indices.
+    a0 = blocks.max(axis=0)
+    a1 = blocks.min(axis=0)
+    span = a0.astype(numpy.float32) - a1
+    span[span == 0] = 1
+    t = (blocks - a1.astype(numpy.float32)) * (7 / span)
+    steps = numpy.clip(numpy.rint(t), 0, 7).astype(numpy.intp)
+    idx = bc3_index_map[steps]
+    bits = numpy.zeros(blocks.shape[1], dtype=numpy.uint64)
+    for k in range(16):
+        bits |= idx[k] << numpy.uint64(3 * k)
+    out = numpy.empty((blocks.shape[1], 8), dtype=numpy.uint8)
+    out[:, 0] = a0
+    out[:, 1] = a1
+    out[:, 2:] = bits.astype("<u8").view(numpy.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+
+################################################################################
+def encode_level(arr, bc3):
+    # Encodes a (h,w,3 or 4) uint8 array, returns the compressed bytes.
+    (h, w) = arr.shape[:2]
+    if h % 4 or w % 4:
+        arr = numpy.pad(
+            arr, ((0, -h % 4), (0, -w % 4), (0, 0)), mode="edge"
+        )
+    chunks = []
+    for row in range(0, arr.shape[0], band_rows):
+        blocks = image_blocks(arr[row : row + band_rows])
+        color = encode_color_blocks(blocks[..., :3], bc3)
+        if bc3:
+            chunks.append(
+                numpy.concatenate(
+                    (encode_alpha_blocks(blocks[..., 3]), color.view(numpy.uint8)),
+                    axis=1,
+                ).tobytes()
+            )
+        else:
+            chunks.append(color.tobytes())
+    return b"".join(chunks)
+
+
+################################################################################
+def next_mipmap(arr):
+    # 2x2 box filter, an odd last row/column is dropped.
+    (h, w, c) = arr.shape
+    (fy, fx) = (2 if h > 1 else 1, 2 if w > 1 else 1)
+    (h2, w2) = (h // fy, w // fx)
+    acc = numpy.full((h2, w2, c), fy * fx // 2, dtype=numpy.uint16)
+    for dy in range(fy):
+        for dx in range(fx):
+            acc += arr[dy : h2 * fy : fy, dx : w2 * fx : fx]
+    return (acc // (fy * fx)).astype(numpy.uint8)
+
+
+################################################################################
+def write_dds(im, dds_file_name, bc3=False, mipmaps=True):
+    # im is a PIL image or a (h,w,3 or 4) uint8 array. BC3 encodes the alpha
+    # channel (255 if there is none), BC1 ignores it. The file is first
+    # written under a temporary name, so that a partial dds is never seen.
+    if isinstance(im, Image.Image):
+        im = im.convert("RGBA" if bc3 else "RGB")
+    arr = numpy.asarray(im, dtype=numpy.uint8)
+    if arr.ndim == 2:
+        arr = numpy.repeat(arr[:, :, None], 3, axis=2)
+    if bc3 and arr.shape[2] == 3:
+        arr = numpy.concatenate(
+            (arr, numpy.full(arr.shape[:2] + (1,), 255, numpy.uint8)), axis=2
+        )
+    elif not bc3:
+        arr = arr[:, :, :3]
+    (h, w) = arr.shape[:2]
+    levels = [encode_level(arr, bc3)]
+    while mipmaps and (h > 1 or w > 1):
+        arr = next_mipmap(arr)
+        (h, w) = arr.shape[:2]
+        levels.append(encode_level(arr, bc3))
+    header = dds_header(
+        im.shape[1] if isinstance(im, numpy.ndarray) else im.width,
+        im.shape[0] if isinstance(im, numpy.ndarray) else im.height,
+        len(levels),
+        b"DXT5" if bc3 else b"DXT1",
+        len(levels[0]),
+    )
+    with open(dds_file_name + ".part", "wb") as f:
+        f.write(header)
+        for level in levels:
+            f.write(level)
+    os.replace(dds_file_name + ".part", dds_file_name)
+    return 1
+
+
+################################################################################
+def benchmark(size=4096, repeat=3):
+    # Encoding time of a noisy gradient, and its PSNR once decoded by PIL.
+    yy, xx = numpy.mgrid[0:size, 0:size]
+    rng = numpy.random.default_rng(0)
+    arr = numpy.stack(
+        (xx * 255 // size, yy * 255 // size, (xx + yy) * 127 // size), axis=2
+    ) + rng.integers(0, 16, (size, size, 3))
+    arr = arr.clip(0, 255).astype(numpy.uint8)
+    alpha = (xx * 255 // size).astype(numpy.uint8)[:, :, None]
+    file_name = os.path.join("tmp", "dds_benchmark.dds")
+    for (bc3, src) in ((False, arr), (True, numpy.concatenate((arr, alpha), 2))):
+        timer = time.time()
+        for _ in range(repeat):
+            write_dds(src, file_name, bc3=bc3)
+        elapsed = (time.time() - timer) / repeat
+        decoded = numpy.asarray(
+            Image.open(file_name).convert("RGBA" if bc3 else "RGB"), numpy.float32
+        )
+        mse = ((decoded - src) ** 2).mean()
+        print(
+            "BC3" if bc3 else "BC1",
+            size,
+            "x",
+            size,
+            ":",
+            round(elapsed, 2),
+            "sec, PSNR",
+            round(10 * numpy.log10(255 ** 2 / max(mse, 1e-9)), 2),
+            "dB",
+        )
+    os.remove(file_name)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -4,6 +4,8 @@ import time
 import requests
 import zipfile
 import itertools
+import threading
+import collections
 from math import sqrt
 import array
 import numpy
@@ -17,6 +19,7 @@ except:
 from PIL import Image
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Raster_Utils as RASTER
 
 available_sources = (
     "View",
@@ -33,6 +36,21 @@ available_sources = (
 
 global_sources = ("View", "SRTM", "ALOS")
 
+################################################################################
+# Elevation files around a tile are read (and for 3" data filled and
+# upsampled) once : the decoded float32 rasters are saved next to their
+# source as .npy files when elevation_disk_cache is set and opened as
+# read-only memory maps, and the last max_cached_rasters of them stay in the
+# process, so that the steps of a tile and its neighbours in a batch share
+# them.
+################################################################################
+
+elevation_disk_cache = False
+max_cached_rasters = 9
+
+cached_rasters = collections.OrderedDict()
+cached_rasters_lock = threading.Lock()
+
 ################################################################################
 class DEM:
     def __init__(self, lat, lon, source="", fill_nodata=True, info_only=False):
@@ -51,12 +69,10 @@ class DEM:
         if fill_nodata == "to zero":
             self.nodata_to_zero()
         elif fill_nodata:
-            if not fill_nodata_values_with_nearest_neighbor(
-                self.alt_dem, self.nodata
-            ):
+            if not RASTER.fill_nodata(self.alt_dem, self.nodata):
                 UI.vprint(
                     1,
-                    "   INFO: Dataset contains too much no_data to be filled.",
+                    "   INFO: Dataset contains no valid data to fill the no_data from.",
                 )
                 self.nodata_to_zero()
 
@@ -70,6 +86,18 @@ class DEM:
             self.alt_dem.mean(),
         )
 
+    def __getstate__(self):
+        # The alt and alt_vec bound methods are pickled by name.
+        state = self.__dict__.copy()
+        state["alt"] = self.alt.__name__
+        state["alt_vec"] = self.alt_vec.__name__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.alt = getattr(self, state["alt"])
+        self.alt_vec = getattr(self, state["alt_vec"])
+
     def load_data(self, source, info_only=False):
         if not source:
             if os.path.exists(FNAMES.generic_tif(self.lat, self.lon)):
@@ -290,35 +318,24 @@ class DEM:
         return self.alt_nostrict(node)
 
     def alt_vec_nostrict(self, way):
+        # Same triangular interpolation as alt_nostrict, way is any (n,2) or
+        # wider array of float coordinates.
         Nx = self.nxdem - 1
         Ny = self.nydem - 1
-        x, y = way[:, 0], way[:, 1]
-        x = numpy.maximum.reduce([x, self.x0 * numpy.ones(x.shape)])
-        x = numpy.minimum.reduce([x, self.x1 * numpy.ones(x.shape)])
-        y = numpy.maximum.reduce([y, self.y0 * numpy.ones(y.shape)])
-        y = numpy.minimum.reduce([y, self.y1 * numpy.ones(y.shape)])
+        x = numpy.clip(way[:, 0], self.x0, self.x1)
+        y = numpy.clip(way[:, 1], self.y0, self.y1)
         px = (x - self.x0) / (self.x1 - self.x0) * Nx
         py = (y - self.y0) / (self.y1 - self.y0) * Ny
-        nx = px.astype(numpy.uint16)
-        Nminusny = Ny - py.astype(numpy.uint16)
+        nx = px.astype(numpy.intp)
+        Nminusny = Ny - py.astype(numpy.intp)
         rx = px - nx
         ry = py + Nminusny - Ny
-        t1 = [self.alt_dem[i][j] for i, j in zip(Nminusny, nx)]
-        t2 = [
-            self.alt_dem[i][j]
-            for i, j in zip(
-                (Nminusny - 1) * (Nminusny >= 1),
-                (nx + 1) * (nx < Nx) + Nx * (nx == Nx),
-            )
-        ]
-        t3 = [
-            self.alt_dem[i][j]
-            for i, j in zip(Nminusny, (nx + 1) * (nx < Nx) + Nx * (nx == Nx))
-        ]
-        t4 = [
-            self.alt_dem[i][j]
-            for i, j in zip((Nminusny - 1) * (Nminusny >= 1), nx)
-        ]
+        nx_next = numpy.minimum(nx + 1, Nx)
+        Nminusny_next = numpy.maximum(Nminusny - 1, 0)
+        t1 = self.alt_dem[Nminusny, nx]
+        t2 = self.alt_dem[Nminusny_next, nx_next]
+        t3 = self.alt_dem[Nminusny, nx_next]
+        t4 = self.alt_dem[Nminusny_next, nx]
         return ((1 - rx) * t1 + ry * t2 + (rx - ry) * t3) * (rx >= ry) + (
             (1 - ry) * t1 + rx * t2 + (ry - rx) * t4
         ) * (rx < ry)
@@ -328,16 +345,14 @@ class DEM:
         mask = (x >= self.x0) * (x <= self.x1) * (y >= self.y0) * (y <= self.y1)
         nx = numpy.round(
             (x - self.x0) / (self.x1 - self.x0) * (self.nxdem - 1)
-        ).astype(numpy.uint16)
+        )
         Nminusny = numpy.round(
             (self.y1 - y) / (self.y1 - self.y0) * (self.nydem - 1)
-        ).astype(numpy.uint16)
-        return numpy.array(
-            [
-                self.alt_dem[i][j] if k else self.nodata
-                for i, j, k in zip(Nminusny, nx, mask)
-            ]
         )
+        # out of bounds nodes get nodata, their indices only need to be valid
+        nx = numpy.clip(nx, 0, self.nxdem - 1).astype(numpy.intp)
+        Nminusny = numpy.clip(Nminusny, 0, self.nydem - 1).astype(numpy.intp)
+        return numpy.where(mask, self.alt_dem[Nminusny, nx], self.nodata)
 
     def alt_vec_composite(self, way):
         tmp = self.alt_vec_nostrict(way)
@@ -346,6 +361,14 @@ class DEM:
             tmp[tmp2 != subdem.nodata] = tmp2[tmp2 != subdem.nodata]
         return tmp
 
+    def alt_vec_ways(self, ways):
+        # Samples a list of ways in a single call of alt_vec, returns the list
+        # of their altitude arrays.
+        if not ways:
+            return []
+        alts = self.alt_vec(numpy.concatenate([way[:, :2] for way in ways]))
+        return numpy.split(alts, numpy.cumsum([len(way) for way in ways])[:-1])
+
 ################################################################################
 def build_combined_raster(source, lat, lon, info_only):
     world_tiles = numpy.array(
@@ -382,13 +405,9 @@ def build_combined_raster(source, lat, lon, info_only):
         if not world_tiles[y, x]:
             tmparray = numpy.zeros((base, base), dtype=numpy.float32)
         elif ensure_elevation(source, lat0, (lon0 + 180) % 360 - 180, verbose):
-            tmparray = read_elevation_from_file(
-                FNAMES.elevation_data(source, lat0, (lon0 + 180) % 360 - 180),
-                lat0,
-                (lon0 + 180) % 360 - 180,
-                info_only,
-                base,
-            )[-1]
+            tmparray = cached_elevation(
+                source, lat0, (lon0 + 180) % 360 - 180, base
+            )
         else:
             tmparray = numpy.zeros((base, base), dtype=numpy.float32)
         by = beyond
@@ -437,6 +456,48 @@ def build_combined_raster(source, lat, lon, info_only):
             )
     return (epsg, x0, y0, x1, y1, nodata, nxdem, nydem, alt_dem)
 
+################################################################################
+def cached_elevation(source, lat, lon, base):
+    # Decoded raster of one elevation file, read-only.
+    file_name = FNAMES.elevation_data(source, lat, lon)
+    key = (file_name, base)
+    with cached_rasters_lock:
+        if key in cached_rasters:
+            cached_rasters.move_to_end(key)
+            return cached_rasters[key]
+    alt_dem = None
+    npy_file = FNAMES.decoded_elevation_file(file_name)
+    if elevation_disk_cache:
+        try:
+            if os.path.getmtime(npy_file) >= os.path.getmtime(file_name):
+                alt_dem = numpy.load(npy_file, mmap_mode="r")
+                UI.vprint(3, "   Recycling ", npy_file)
+        except:
+            alt_dem = None
+    if alt_dem is None:
+        alt_dem = read_elevation_from_file(file_name, lat, lon, False, base)[
+            -1
+        ]
+        # An all zero raster is cheap to read again (and could be a read
+        # error), it is not worth the disk space.
+        if elevation_disk_cache and alt_dem.any():
+            try:
+                with open(npy_file + ".part", "wb") as f:
+                    numpy.save(f, alt_dem)
+                os.replace(npy_file + ".part", npy_file)
+                alt_dem = numpy.load(npy_file, mmap_mode="r")
+            except Exception as e:
+                UI.vprint(1, "   WARNING: Could not cache", npy_file)
+                UI.vprint(3, e)
+        alt_dem.flags.writeable = False
+    if max_cached_rasters > 0:
+        with cached_rasters_lock:
+            cached_rasters[key] = alt_dem
+            while len(cached_rasters) > max_cached_rasters:
+                cached_rasters.popitem(last=False)
+    return alt_dem
+
+
 ################################################################################
 def read_elevation_from_file(
     file_name, lat, lon, info_only=False, base_if_error=3601
@@ -458,8 +519,8 @@ def read_elevation_from_file(
             if nxdem == 1201:
                 nxdem = nydem = 3601
                 if not info_only:
-                    fill_nodata_values_with_nearest_neighbor(alt_dem, nodata)
-                    alt_dem = upsample(alt_dem)
+                    RASTER.fill_nodata(alt_dem, nodata)
+                    alt_dem = RASTER.upsample(alt_dem, 3)
         except Exception as e:
             print(e)
             UI.lvprint(
@@ -862,119 +923,16 @@ def http_request(url, source, verbose=False):
         )
         time.sleep(2 ** tentative)
 
-################################################################################
-def fill_nodata_values_with_nearest_neighbor(alt_dem, nodata):
-    step = 0
-    while (alt_dem == nodata).any():
-        if not step:
-            if numpy.sum(alt_dem == nodata) >= 10000:
-                return 0
-            UI.vprint(
-                2,
-                "    INFO: Elevation file contains voids, trying to fill ",
-                "them recursively by nearest neighbour.",
-            )
-        else:
-            UI.vprint(2, "    ", step)
-        alt10 = numpy.roll(alt_dem, 1, axis=0)
-        alt10[0] = alt_dem[0]
-        alt20 = numpy.roll(alt_dem, -1, axis=0)
-        alt20[-1] = alt_dem[-1]
-        alt01 = numpy.roll(alt_dem, 1, axis=1)
-        alt01[:, 0] = alt_dem[:, 0]
-        alt02 = numpy.roll(alt_dem, -1, axis=1)
-        alt02[:, -1] = alt_dem[:, -1]
-        if (nodata < 0):
-            atemp = numpy.maximum(alt10, alt20)
-            atemp = numpy.maximum(atemp, alt01)
-            atemp = numpy.maximum(atemp, alt02)
-        else:
-            atemp = numpy.minimum(alt10, alt20)
-            atemp = numpy.minimum(atemp, alt01)
-            atemp = numpy.minimum(atemp, alt02)
-        alt_dem[alt_dem == nodata] = atemp[alt_dem == nodata]
-        step += 1
-        if step > 20:
-            UI.vprint(
-                1,
-                "    WARNING: The raster contain holes that seem to big to ",
-                "be filled... I'm filling the remainder with zero.",
-            )
-            alt_dem[alt_dem == nodata] = 0
-            break
-    if step:
-        UI.vprint(2, "    Done.")
-    return 1
-
-################################################################################
-def upsample(alt_dem):
-    # only implemented from 1201 to 3601, might be worth upgrading it some day
-    alt_dem_tmp = numpy.zeros((3601, 3601), dtype=numpy.float32)
-    for i in range(1201):
-        alt_dem_tmp[3 * i, ::3] = alt_dem[i]
-        alt_dem_tmp[3 * i, 1::3] = (
-            2 / 3 * alt_dem[i, :-1] + 1 / 3 * alt_dem[i, 1:]
-        )
-        alt_dem_tmp[3 * i, 2::3] = (
-            1 / 3 * alt_dem[i, :-1] + 2 / 3 * alt_dem[i, 1:]
-        )
-        if i == 1200:
-            break
-        alt_dem_tmp[3 * i + 1, ::3] = (
-            2 / 3 * alt_dem[i] + 1 / 3 * alt_dem[i + 1]
-        )
-        alt_dem_tmp[3 * i + 2, ::3] = (
-            1 / 3 * alt_dem[i] + 2 / 3 * alt_dem[i + 1]
-        )
-        alt_dem_tmp[3 * i + 1, 1::3] = (
-            4 / 9 * alt_dem[i][:-1]
-            + 2 / 9 * alt_dem[i, 1:]
-            + 2 / 9 * alt_dem[i + 1, :-1]
-            + 1 / 9 * alt_dem[i + 1, 1:]
-        )
-        alt_dem_tmp[3 * i + 2, 1::3] = (
-            2 / 9 * alt_dem[i][:-1]
-            + 1 / 9 * alt_dem[i, 1:]
-            + 4 / 9 * alt_dem[i + 1, :-1]
-            + 2 / 9 * alt_dem[i + 1, 1:]
-        )
-        alt_dem_tmp[3 * i + 1, 2::3] = (
-            2 / 9 * alt_dem[i][:-1]
-            + 4 / 9 * alt_dem[i, 1:]
-            + 1 / 9 * alt_dem[i + 1, :-1]
-            + 2 / 9 * alt_dem[i + 1, 1:]
-        )
-        alt_dem_tmp[3 * i + 2, 2::3] = (
-            1 / 9 * alt_dem[i][:-1]
-            + 2 / 9 * alt_dem[i, 1:]
-            + 2 / 9 * alt_dem[i + 1, :-1]
-            + 4 / 9 * alt_dem[i + 1, 1:]
-        )
-    return alt_dem_tmp
-
 ################################################################################
 def smoothen(raster, pix_width, mask_im, preserve_boundary=True):
     if not pix_width:
         return raster
     if not mask_im:
         return raster
-    tmp = numpy.array(raster)
     mask_array = numpy.array(mask_im, dtype=numpy.float32) / 255
-    kernel = numpy.array(range(1, 2 * (pix_width + 1)))
-    kernel[pix_width + 1 :] = range(pix_width, 0, -1)
-    kernel = kernel / (pix_width + 1) ** 2
-    tmp = tmp * mask_array
-    tmpw = numpy.array(mask_array)
-    for i in range(0, len(tmp)):
-        tmp[i] = numpy.convolve(tmp[i], kernel)[pix_width:-pix_width]
-        tmpw[i] = numpy.convolve(tmpw[i], kernel)[pix_width:-pix_width]
-    tmp = tmp.transpose()
-    tmpw = tmpw.transpose()
-    for i in range(0, len(tmp)):
-        tmp[i] = numpy.convolve(tmp[i], kernel)[pix_width:-pix_width]
-        tmpw[i] = numpy.convolve(tmpw[i], kernel)[pix_width:-pix_width]
-    tmp = tmp.transpose()
-    tmpw = tmpw.transpose()
+    # convolution with a hat function
+    tmp = RASTER.hat_filter(raster * mask_array, pix_width + 1)
+    tmpw = RASTER.hat_filter(mask_array, pix_width + 1)
     tmp[mask_array != 0] = (
         mask_array[mask_array != 0]
         * tmp[mask_array != 0]
@@ -1000,3 +958,41 @@ def smoothen(raster, pix_width, mask_im, preserve_boundary=True):
                 + (pix_width - i) / pix_width * raster[:, -i - 1]
             )
     return raster * (mask_array == 0) + tmp * (mask_array != 0)
+
+
+################################################################################
+def benchmark_alt_vec(size=3601, nbr_ways=20000, way_length=12):
+    # Point by point sampling (the former way, alt_nostrict), way by way
+    # (alt_vec) and all ways at once (alt_vec_ways) on a random raster.
+    dem = DEM.__new__(DEM)
+    (dem.lat, dem.lon, dem.x0, dem.y0, dem.x1, dem.y1) = (45, 5, 0, 0, 1, 1)
+    (dem.nxdem, dem.nydem, dem.nodata) = (size, size, -32768)
+    rng = numpy.random.default_rng(0)
+    dem.alt_dem = rng.uniform(0, 3000, (size, size)).astype(numpy.float32)
+    dem.alt = dem.alt_nostrict
+    dem.alt_vec = dem.alt_vec_nostrict
+    starts = rng.uniform(-0.01, 1.01, (nbr_ways, 1, 2))
+    ways = list(starts + rng.normal(0, 0.001, (nbr_ways, way_length, 2)))
+    timer = time.time()
+    ref = [numpy.array([dem.alt(node) for node in way]) for way in ways]
+    time_ref = time.time() - timer
+    timer = time.time()
+    per_way = [dem.alt_vec(way) for way in ways]
+    time_per_way = time.time() - timer
+    timer = time.time()
+    batched = dem.alt_vec_ways(ways)
+    time_batched = time.time() - timer
+    print(nbr_ways, "ways of", way_length, "nodes on a", size, "x", size, "DEM")
+    print("   alt (point by point) :", round(time_ref, 3), "sec")
+    print("   alt_vec (way by way) :", round(time_per_way, 3), "sec")
+    print("   alt_vec_ways         :", round(time_batched, 3), "sec")
+    print(
+        "   max difference with alt :",
+        max(numpy.abs(a - b).max() for (a, b) in zip(ref, batched)),
+        ", per way vs batched identical :",
+        all(numpy.array_equal(a, b) for (a, b) in zip(per_way, batched)),
+    )
+
+
+if __name__ == "__main__":
+    benchmark_alt_vec()
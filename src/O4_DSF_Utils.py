@@ -2,20 +2,20 @@ import os
 import pickle
 import shutil
 import io
-from math import floor, ceil
 import array
 import numpy
 from PIL import Image, ImageDraw
 from collections import defaultdict
 import struct
-import hashlib
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Mask_Utils as MASK
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_Overlay_Utils as OVL
 import O4_Mesh_Utils as MESH
 import O4_Bathymetry as BATHY
+import O4_DSF_Writer as DSFW
 
 quad_init_level = 3
 quad_capacity_high = 50000
@@ -25,86 +25,177 @@ quad_capacity_low = 35000
 use_test_texture = False
 
 ################################################################################
-def float2qquad(x):
-    if x >= 1:
-        return "111111111111111111111111"
-    return numpy.binary_repr(int(16777216 * x)).zfill(24)  # 2**24 == 16777216
+def quantize_24bits(x):
+    # Position in [0,1] of the nodes to 24 bits integers, truncated as int()
+    # would do.
+    return numpy.where(
+        x >= 1, 16777215, (16777216 * x).astype(numpy.int64)
+    ).astype(numpy.uint64)
 
 
 ################################################################################
+def morton_codes(qx, qy):
+    # 48 bits codes, each x bit precedes the corresponding y bit so that
+    # quadrants come in the same order as the ones of a split bucket. 
+    codes = numpy.zeros(len(qx), dtype=numpy.uint64)
+    for b in range(24):
+        codes |= ((qx >> numpy.uint64(b)) & numpy.uint64(1)) << numpy.uint64(
+            2 * b + 1
+        )
+        codes |= ((qy >> numpy.uint64(b)) & numpy.uint64(1)) << numpy.uint64(
+            2 * b
+        )
+    return codes
+
 
 ################################################################################
-class QuadTree(dict):
-    class Bucket(dict):
-        def __init__(self):
-            self["size"] = 0
-            self["idx_nodes"] = set()
-
-    def __init__(self, level, bucket_size):
-        self.bucket_size = bucket_size
-        if level == 0:
-            self[("", "")] = self.Bucket()
-        else:
-            for i in range(2 ** level):
-                for j in range(2 ** level):
-                    key = (
-                        numpy.binary_repr(i).zfill(level),
-                        numpy.binary_repr(j).zfill(level),
-                    )
-                    self[key] = self.Bucket()
-        self.nodes = {}
-        self.levels = {}
-        self.last_node = 0
-
-    def split_bucket(self, key):
-        level = len(key[0]) + 1
-        self[(key[0] + "0", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "0", key[1] + "1")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "1")] = self.Bucket()
-        for idx in self[key]["idx_nodes"]:
-            new_key = (self.nodes[idx][0][:level], self.nodes[idx][1][:level])
-            self[new_key]["idx_nodes"].add(idx)
-            self[new_key]["size"] += 1
-            self.levels[idx] += 1
-        del self[key]
-
-    def insert(self, bx, by, level):
-        while True:
-            key = (bx[:level], by[:level])
-            if key in self:
-                break
-            level += 1
-        if self[key]["size"] < self.bucket_size:
-            self[key]["idx_nodes"].add(self.last_node)
-            self[key]["size"] += 1
-            self.nodes[self.last_node] = (bx, by)
-            self.levels[self.last_node] = level
-            self.last_node += 1
-        else:
-            self.split_bucket(key)
-            self.insert(bx, by, level + 1)
-
-    def clean(self):
-        for key in list(self.keys()):
-            if not self[key]["size"]:
-                del self[key]
-
-    def statistics(self):
-        lengths = numpy.array([self[key]["size"] for key in self])
-        depths = numpy.array([len(key[0]) for key in self])
-        UI.vprint(2, "     Number of buckets:", len(lengths))
-        UI.vprint(
+@STATS.timed("quadtree")
+def build_point_pools(tile, nbr_nodes, node_coords, init_level, capacity):
+    # Adaptive quadtree on the tile : a bucket is split into four as soon as
+    # it holds more than capacity nodes, starting from 4**init_level ones. 
+    # Everything is derived from the sorted Morton codes of the nodes, and
+    # the pools are numbered in the order a sequential insertion of the nodes
+    # would have created the buckets (initial ones first, then the children
+    # of each split in the order the splits occured). 
+    # Returns pool_nbr, the pool index of each node, pool_param and the 16
+    # bits encoding (x, y, z, normals) of the nodes.
+    qx = quantize_24bits(node_coords[0::5] - tile.lon)
+    qy = quantize_24bits(node_coords[1::5] - tile.lat)
+    codes = morton_codes(qx, qy)
+    order = numpy.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    level = init_level
+    prefixes = numpy.arange(4 ** level, dtype=numpy.uint64)
+    # creation order of the buckets : (time of the split which created it, 
+    # level of the split bucket, position among its siblings)
+    ix = numpy.zeros(len(prefixes), dtype=numpy.int64)
+    iy = numpy.zeros(len(prefixes), dtype=numpy.int64)
+    for b in range(level):
+        ix |= ((prefixes.astype(numpy.int64) >> (2 * b + 1)) & 1) << b
+        iy |= ((prefixes.astype(numpy.int64) >> (2 * b)) & 1) << b
+    created = (
+        numpy.full(len(prefixes), -1),
+        numpy.zeros(len(prefixes), dtype=numpy.int64),
+        ix * 2 ** level + iy,
+    )
+    leaves = []
+    while len(prefixes):
+        shift = numpy.uint64(2 * (24 - level))
+        lo = numpy.searchsorted(sorted_codes, prefixes << shift)
+        hi = numpy.searchsorted(
+            sorted_codes, (prefixes + numpy.uint64(1)) << shift
+        )
+        is_leaf = (hi - lo <= capacity) | (level == 24)
+        keep = is_leaf & (hi > lo)
+        leaves.append(
+            (
+                numpy.full(keep.sum(), level),
+                lo[keep],
+                hi[keep],
+                created[0][keep],
+                created[1][keep],
+                created[2][keep],
+            )
+        )
+        split = numpy.nonzero(~is_leaf)[0]
+        split_time = numpy.array(
+            [
+                numpy.partition(order[lo[k] : hi[k]], capacity)[capacity]
+                for k in split
+            ],
+            dtype=numpy.int64,
+        )
+        prefixes = (
+            (prefixes[split] << numpy.uint64(2))[:, None]
+            + numpy.arange(4, dtype=numpy.uint64)
+        ).ravel()
+        created = (
+            numpy.repeat(split_time, 4),
+            numpy.full(len(prefixes), level),
+            numpy.tile(numpy.arange(4), len(split)),
+        )
+        level += 1
+    (levels, lo, hi, ctime, clevel, cpos) = [
+        numpy.concatenate(x) for x in zip(*leaves)
+    ]
+    pool_nbr = len(lo)
+    idx_pool = numpy.empty(pool_nbr, dtype=numpy.int64)
+    idx_pool[numpy.lexsort((cpos, clevel, ctime))] = numpy.arange(pool_nbr)
+    # leaves sorted by lo are a partition of the sorted nodes
+    by_lo = numpy.argsort(lo)
+    (levels, lo, hi, idx_pool) = (levels[by_lo], lo[by_lo], hi[by_lo], 
+                                  idx_pool[by_lo])
+    counts = hi - lo
+    node_pool = numpy.empty(nbr_nodes, dtype=numpy.int64)
+    node_pool[order] = numpy.repeat(idx_pool, counts)
+    node_level = numpy.empty(nbr_nodes, dtype=numpy.int64)
+    node_level[order] = numpy.repeat(levels, counts)
+    # 16 bits of the quantized coordinates right after the pool key
+    node_icoords = numpy.zeros(5 * nbr_nodes, dtype=numpy.uint16)
+    for (dim, q) in ((0, qx), (1, qy)):
+        q = q.astype(numpy.int64)
+        node_icoords[dim::5] = numpy.where(
+            node_level <= 8,
+            (q >> numpy.maximum(8 - node_level, 0)) & 65535,
+            q & ((1 << numpy.maximum(24 - node_level, 0)) - 1),
+        )
+    # altitudes
+    altitudes = node_coords[2::5][order]
+    altmin = numpy.floor(numpy.minimum.reduceat(altitudes, lo)).astype(int)
+    altmax = numpy.ceil(numpy.maximum.reduceat(altitudes, lo)).astype(int)
+    span = altmax - altmin
+    scale_z = numpy.select(
+        [span < 770, span < 1284, span < 4368], [771, 1285, 4369], 13107
+    )  # 65535=771*85=1285*51=4369*15=13107*5
+    inv_stp = numpy.select(
+        [span < 770, span < 1284, span < 4368], [85, 51, 15], 5
+    )
+    node_icoords[2::5][order] = numpy.round(
+        (altitudes - numpy.repeat(altmin, counts))
+        * numpy.repeat(inv_stp, counts)
+    )
+    node_icoords[3::5] = numpy.round(
+        (1 + tile.normal_map_strength * node_coords[3::5]) / 2 * 65535
+    )
+    node_icoords[4::5] = numpy.round(
+        (1 - tile.normal_map_strength * node_coords[4::5]) / 2 * 65535
+    )
+    pool_param = {}
+    for k in range(pool_nbr):
+        level = int(levels[k])
+        first_node = order[lo[k]]
+        scal_x = scal_y = 2 ** (-level)
+        pool_param[int(idx_pool[k])] = (
+            scal_x,
+            tile.lon + int(qx[first_node] >> numpy.uint64(24 - level)) * scal_x,
+            scal_y,
+            tile.lat + int(qy[first_node] >> numpy.uint64(24 - level)) * scal_y,
+            int(scale_z[k]),
+            int(altmin[k]),
             2,
-            "     Average depth:",
-            depths.mean(),
-            ", Average bucket size:",
-            lengths.mean(),
+            -1,
+            2,
+            -1,
+            1,
+            0,
+            1,
+            0,
+            1,
+            0,
+            1,
+            0,
         )
-        UI.vprint(2, "     Largest depth:", numpy.max(depths))
-
+    UI.vprint(2, "     Number of buckets:", pool_nbr)
+    UI.vprint(
+        2,
+        "     Average depth:",
+        levels.mean(),
+        ", Average bucket size:",
+        counts.mean(),
+    )
+    UI.vprint(2, "     Largest depth:", levels.max())
+    return (pool_nbr, node_pool.tolist(), pool_param, node_icoords)
 
-################################################################################
 
 ################################################################################
 def zone_list_to_ortho_dico(tile):
@@ -491,89 +582,15 @@ def build_dsf(tile, download_queue):
     
     UI.vprint(1, "-> Computing point pools and texture requirements")
     
-    # 5 Compute quadtree
+    # 5 Compute point pools
     if (tile.use_masks_for_inland):
         quad_capacity = quad_capacity_low
     else:
         quad_capacity = quad_capacity_high
-    pool_quadtree = QuadTree(quad_init_level, quad_capacity)
-    for i in range(nbr_nodes):
-        pool_quadtree.insert(
-                float2qquad(node_coords[5 * i + 0] - tile.lon),
-                float2qquad(node_coords[5 * i + 1] - tile.lat),
-                quad_init_level)
-    pool_quadtree.clean()
-    pool_quadtree.statistics()
-    
-    # 6 Compute pool params
-    pool_nbr = len(pool_quadtree)
-    idx_node_to_idx_pool = {}
-    idx_pool = 0
-    key_to_idx_pool = {}
-    for key in pool_quadtree:
-        key_to_idx_pool[key] = idx_pool
-        for idx_node in pool_quadtree[key]["idx_nodes"]:
-            idx_node_to_idx_pool[idx_node] = idx_pool
-        idx_pool += 1
-    pool_param = {}
-    node_icoords = numpy.zeros(5 * nbr_nodes, dtype = numpy.uint16)
-    for key in pool_quadtree:
-        level = len(key[0])
-        plist = sorted(list(pool_quadtree[key]["idx_nodes"]))
-        node_icoords[[5 * idx_node for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][0][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        node_icoords[[5 * idx_node + 1 for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][1][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        altitudes = numpy.array(
-            [node_coords[5 * idx_node + 2] for idx_node in plist]
-        )
-        altmin = floor(altitudes.min())
-        altmax = ceil(altitudes.max())
-        if altmax - altmin < 770:
-            scale_z = 771  # 65535=771*85
-            inv_stp = 85
-        elif altmax - altmin < 1284:
-            scale_z = 1285  # 65535=1285*51
-            inv_stp = 51
-        elif altmax - altmin < 4368:
-            scale_z = 4369  # 65535=4369*15
-            inv_stp = 15
-        else:
-            scale_z = 13107  # 65535=13107*5
-            inv_stp = 5
-        scal_x = scal_y = 2 ** (-level)
-        node_icoords[[5 * idx_node + 2 for idx_node in plist]] = numpy.round(
-            (altitudes - altmin) * inv_stp
-        )
-        pool_param[key_to_idx_pool[key]] = (
-            scal_x,
-            tile.lon + int(key[0], 2) * scal_x,
-            scal_y,
-            tile.lat + int(key[1], 2) * scal_y,
-            scale_z,
-            altmin,
-            2,
-            -1,
-            2,
-            -1,
-            1,
-            0,
-            1,
-            0,
-            1,
-            0,
-            1,
-            0,
+    (pool_nbr, idx_node_to_idx_pool, pool_param, node_icoords) = (
+        build_point_pools(
+            tile, nbr_nodes, node_coords, quad_init_level, quad_capacity
         )
-    node_icoords[3::5] = numpy.round(
-        (1 + tile.normal_map_strength * node_coords[3::5]) / 2 * 65535
-    )
-    node_icoords[4::5] = numpy.round(
-        (1 - tile.normal_map_strength * node_coords[4::5]) / 2 * 65535
     )
     node_icoords = array.array("H", node_icoords)
 
@@ -1081,280 +1098,102 @@ def build_dsf(tile, download_queue):
     # Transfer DEM and bathymetry raster from Global Scenery tiles
     (bDEMN, bDEMS) = extract_elevation_and_bathymetry_data(tile.lat, tile.lon)
 
-    # Computation of intermediate and of total length
-    size_of_head_atom = 16 + len(bPROP)
-    size_of_prop_atom = 8 + len(bPROP)
-    size_of_defn_atom = (
-        48 + len(bTERT) + len(bOBJT) + len(bPOLY) + len(bNETW) + len(bDEMN)
-    )
-    size_of_geod_atom = 8 + len(bGEOD)
-    size_of_dems_atom = 8 + len(bDEMS)
+    # Since we possibly skipped some pools, and since we possibly
+    # get pools from elsewhere, we rebuild a lookup table
+    # which tells the pool position in the dsf of a pool prior
+    # to the stripping :
+    pool_lookup = numpy.zeros(max(dsf_pool_nbr, 1), dtype=numpy.int64)
+    new_idx_dsfpool = nbr_dsfpools_yet_in
     for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] > 0:
-            size_of_geod_atom += 21 + dsf_pool_plane[k] * (
-                9 + 2 * dsf_pool_length[k]
-            )
-    UI.vprint(
-        2, "     Size of DEFN atom : " + str(size_of_defn_atom) + " bytes."
-    )
-    UI.vprint(
-        2, "     Size of GEOD atom : " + str(size_of_geod_atom) + " bytes."
+        if dsf_pool_length[k] != 0:
+            pool_lookup[k] = new_idx_dsfpool
+            new_idx_dsfpool += 1
+
+    # Head and definitions super-atoms
+    head_atom = DSFW.atom(b"DAEH", DSFW.atom(b"PORP", bPROP))
+    defn_atom = DSFW.atom(
+        b"NFED",
+        DSFW.atom(b"TRET", bTERT),
+        DSFW.atom(b"TJBO", bOBJT),
+        DSFW.atom(b"YLOP", bPOLY),
+        DSFW.atom(b"WTEN", bNETW),
+        DSFW.atom(b"NMED", bDEMN),
     )
-    f = open(dsf_file_name + ".tmp", "wb")
-    f.write(b"XPLNEDSF")
-    f.write(struct.pack("<I", 1))
-
-    # Head super-atom
-    f.write(b"DAEH")
-    f.write(struct.pack("<I", size_of_head_atom))
-    f.write(b"PORP")
-    f.write(struct.pack("<I", size_of_prop_atom))
-    f.write(bPROP)
-
-    # Definitions super-atom
-    f.write(b"NFED")
-    f.write(struct.pack("<I", size_of_defn_atom))
-    f.write(b"TRET")
-    f.write(struct.pack("<I", 8 + len(bTERT)))
-    f.write(bTERT)
-    f.write(b"TJBO")
-    f.write(struct.pack("<I", 8 + len(bOBJT)))
-    f.write(bOBJT)
-    f.write(b"YLOP")
-    f.write(struct.pack("<I", 8 + len(bPOLY)))
-    f.write(bPOLY)
-    f.write(b"WTEN")
-    f.write(struct.pack("<I", 8 + len(bNETW)))
-    f.write(bNETW)
-    f.write(b"NMED")
-    f.write(struct.pack("<I", 8 + len(bDEMN)))
-    f.write(bDEMN)
 
     # Geodata super-atom
-    f.write(b"DOEG")
-    f.write(struct.pack("<I", size_of_geod_atom))
-    f.write(bGEOD)
+    geod_atom = DSFW.atom(b"DOEG", bGEOD)
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LOOP")
-        f.write(
-            struct.pack(
-                "<I",
-                13
-                + dsf_pool_plane[k]
-                + 2 * dsf_pool_plane[k] * dsf_pool_length[k],
-            )
-        )
-        f.write(struct.pack("<I", dsf_pool_length[k]))
-        f.write(struct.pack("<B", dsf_pool_plane[k]))
-        for l in range(dsf_pool_plane[k]):
-            f.write(struct.pack("<B", 0))
-            for m in range(dsf_pool_length[k]):
-                f.write(
-                    struct.pack("<H", dsf_pools[k][dsf_pool_plane[k] * m + l])
-                )
+        geod_atom[1].append(DSFW.pool_atom(dsf_pools[k], dsf_pool_plane[k]))
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LACS")
-        f.write(struct.pack("<I", 8 + 8 * dsf_pool_plane[k]))
-        for l in range(2 * dsf_pool_plane[k]):
-            f.write(struct.pack("<f", pool_param[k % pool_nbr][l]))
+        geod_atom[1].append(
+            DSFW.scal_atom(pool_param[k % pool_nbr][: 2 * dsf_pool_plane[k]])
+        )
 
     UI.progress_bar(1, 95)
     if UI.red_flag:
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
-    # Since we possibly skipped some pools, and since we possibly
-    # get pools from elsewhere, we rebuild a dico
-    # which tells the pool position in the dsf of a pool prior
-    # to the stripping :
-
-    dico_new_dsf_pool = {}
-    new_idx_dsfpool = nbr_dsfpools_yet_in
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] != 0:
-            dico_new_dsf_pool[k] = new_idx_dsfpool
-            new_idx_dsfpool += 1
-
     # Commands atom
-    # we first compute its size :
-    size_of_cmds_atom = 8 + len(bCMDS)
+    cmds_atom = DSFW.atom(b"SDMC", bCMDS)
     for terrain_idx in textured_tris:
         if len(textured_tris[terrain_idx]) == 0:
             continue
-        size_of_cmds_atom += 3
-        for idx_dsfpool in textured_tris[terrain_idx]:
-            if idx_dsfpool != "cross-pool":
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 255)
-                )
-            else:
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 510)
-                )
-    UI.vprint(
-        2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
-    )
-    f.write(b"SDMC")  # CMDS header
-    f.write(struct.pack("<I", size_of_cmds_atom))  # CMDS length
-    f.write(bCMDS)
-    for terrain_idx in textured_tris:
-        if len(textured_tris[terrain_idx]) == 0:
-            continue
-        # print("terrain_idx = "+str(terrain_idx))
-        f.write(struct.pack("<B", 4))  # SET DEFINITION 16
-        f.write(struct.pack("<H", terrain_idx))  # TERRAIN INDEX
+        # SET DEFINITION 16
+        cmds_atom[1].append(struct.pack("<BH", 4, terrain_idx))
         flag = (
             1 if terrain_idx not in overlay_terrains else 2
         )  # physical or overlay
         lod = -1 if flag == 1 else tile.overlay_lod
         for idx_dsfpool in textured_tris[terrain_idx]:
-            if idx_dsfpool != "cross-pool":
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[idx_dsfpool])
-                )  # POOL INDEX
-
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 255
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * j + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-                remaining_tri_p = (
-                    len(textured_tris[terrain_idx][idx_dsfpool]) % 255
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * blocks + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-            else:  # idx_dsfpool == 'cross-pool'
-                pool_idx_init = textured_tris[terrain_idx][idx_dsfpool][0]
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[pool_idx_init])
-                )  # POOL INDEX
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 510
+            tris = textured_tris[terrain_idx][idx_dsfpool]
+            pool_idx_init = (
+                idx_dsfpool if idx_dsfpool != "cross-pool" else tris[0]
+            )
+            # POOL SELECT, then TERRAIN PATCH FLAGS AND LOD
+            cmds_atom[1].append(
+                struct.pack(
+                    "<BHBBff", 1, pool_lookup[pool_idx_init], 18, flag, 0, lod
                 )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * j + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * j + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_POOL IDX
-                remaining_tri_p = int(
-                    (len(textured_tris[terrain_idx][idx_dsfpool]) % 510) / 2
+            )
+            if idx_dsfpool != "cross-pool":
+                cmds_atom[1].extend(DSFW.patch_triangle_commands(tris))
+            else:
+                cmds_atom[1].extend(
+                    DSFW.patch_triangle_cross_pool_commands(tris, pool_lookup)
                 )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * blocks + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * blocks + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_PO0L IDX
+    dsf_atoms = [head_atom, defn_atom, geod_atom, cmds_atom]
 
     # DEMS atom
     if bDEMS != b"":
-        f.write(b"SMED")
-        f.write(struct.pack("<I", 8 + len(bDEMS)))
-        f.write(bDEMS)
+        dsf_atoms.append(DSFW.atom(b"SMED", bDEMS))
+
+    UI.vprint(
+        2,
+        "     Size of DEFN atom : " + str(DSFW.atom_size(defn_atom)) + " bytes.",
+    )
+    UI.vprint(
+        2,
+        "     Size of GEOD atom : " + str(DSFW.atom_size(geod_atom)) + " bytes.",
+    )
+    UI.vprint(
+        2,
+        "     Size of CMDS atom : " + str(DSFW.atom_size(cmds_atom)) + " bytes.",
+    )
 
     UI.progress_bar(1, 98)
     if UI.red_flag:
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
-    f.close()
+    size_of_dsf = DSFW.write_dsf(dsf_file_name + ".tmp", dsf_atoms)
 
-    f = open(dsf_file_name + ".tmp", "rb")
-    data = f.read()
-    m = hashlib.md5()
-    m.update(data)
-    md5sum = m.digest()
-    f.close()
-    f = open(dsf_file_name + ".tmp", "ab")
-    f.write(md5sum)
-    f.close()
-    
     UI.progress_bar(1, 100)
-    
-    size_of_dsf = (
-        28
-        + size_of_head_atom
-        + size_of_defn_atom
-        + size_of_geod_atom
-        + size_of_cmds_atom
-        + size_of_dems_atom
-    )
+
     UI.vprint(
         1,
         "     DSF file encoded, total size is :",
@@ -0,0 +1,114 @@
+import struct
+import hashlib
+import numpy
+import O4_Stats_Utils as STATS
+
+################################################################################
+# A DSF file is a header, a tree of atoms and the md5 of everything before it.
+# Atoms are represented here by (code, parts) where parts is a list of either
+# (sub)atoms or bytes-like buffers (bytes, array.array, contiguous numpy
+# arrays), so that large pools and command streams are serialized in bulk
+# and their size is known before anything is written. Codes are given as they
+# appear in the file, i.e. reversed (b"LOOP" for the POOL atom).
+################################################################################
+
+
+################################################################################
+def atom(code, *parts):
+    return (code, list(parts))
+
+
+################################################################################
+def atom_size(item):
+    if isinstance(item, tuple):
+        return 8 + sum(atom_size(part) for part in item[1])
+    return memoryview(item).nbytes
+
+
+################################################################################
+@STATS.timed("dsf_write")
+def write_dsf(file_name, atoms):
+    # Streams the atoms to file_name while computing the md5, returns the
+    # total size of the file.
+    f = open(file_name, "wb")
+    md5 = hashlib.md5()
+
+    def write(data):
+        f.write(data)
+        md5.update(data)
+
+    def write_item(item):
+        if isinstance(item, tuple):
+            write(item[0])
+            write(struct.pack("<I", atom_size(item)))
+            for part in item[1]:
+                write_item(part)
+        elif atom_size(item):
+            write(item)
+
+    write(b"XPLNEDSF")
+    write(struct.pack("<I", 1))
+    for item in atoms:
+        write_item(item)
+    f.write(md5.digest())
+    size = f.tell()
+    f.close()
+    STATS.count_file(file_name)
+    return size
+
+
+################################################################################
+def pool_atom(pool_data, nbr_planes):
+    # POOL atom from interleaved uint16 data (nbr_planes values per point),
+    # stored plane after plane without compression.
+    planes = numpy.ascontiguousarray(
+        numpy.frombuffer(pool_data, dtype=numpy.uint16)
+        .reshape(-1, nbr_planes)
+        .T,
+        dtype="<u2",
+    )
+    parts = [struct.pack("<IB", planes.shape[1], nbr_planes)]
+    for plane in planes:
+        parts.extend((b"\0", plane))
+    return atom(b"LOOP", *parts)
+
+
+################################################################################
+def scal_atom(params):
+    return atom(b"LACS", struct.pack("<" + str(len(params)) + "f", *params))
+
+
+################################################################################
+def patch_commands(cmd_id, data, block_size):
+    # Splits data (uint16) in as many commands cmd_id as needed, each one
+    # followed by its count of coordinates (at most 255) and block_size
+    # values of data.
+    data = numpy.asarray(data, dtype="<u2")
+    blocks = len(data) // block_size
+    full = data[: blocks * block_size].view(numpy.uint8).reshape(blocks, 2 * block_size)
+    head = numpy.empty((blocks, 2), dtype=numpy.uint8)
+    head[:, 0] = cmd_id
+    head[:, 1] = 255
+    parts = [numpy.concatenate((head, full), axis=1)]
+    remaining = (len(data) % block_size) // (block_size // 255)
+    if remaining:
+        parts.append(struct.pack("<BB", cmd_id, remaining))
+        parts.append(
+            data[blocks * block_size :][: remaining * (block_size // 255)]
+        )
+    return parts
+
+
+################################################################################
+def patch_triangle_commands(tris):
+    # PATCH TRIANGLE (23) commands, tris are indices within the current pool.
+    return patch_commands(23, tris, 255)
+
+
+################################################################################
+def patch_triangle_cross_pool_commands(tris, pool_lookup):
+    # PATCH TRIANGLE CROSS-POOL (24) commands, tris is a sequence of
+    # (pool, index in pool) pairs, pools are renumbered through pool_lookup.
+    tris = numpy.array(tris, dtype=numpy.int64).reshape(-1, 2)
+    tris[:, 0] = pool_lookup[tris[:, 0]]
+    return patch_commands(24, tris.ravel(), 510)
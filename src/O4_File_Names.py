@@ -11,6 +11,7 @@ Provider_dir = os.path.join(Ortho4XP_dir, "Providers")
 Extent_dir = os.path.join(Ortho4XP_dir, "Extents")
 Filter_dir = os.path.join(Ortho4XP_dir, "Filters")
 OSM_dir = os.path.join(Ortho4XP_dir, "OSM_data")
+OSM_extracts_dir = os.path.join(OSM_dir, "Extracts")
 Mask_dir = os.path.join(Ortho4XP_dir, "Masks")
 Imagery_dir = os.path.join(Ortho4XP_dir, "Orthophotos")
 Elevation_dir = os.path.join(Ortho4XP_dir, "Elevation_data")
@@ -193,6 +194,24 @@ def mesh_file(build_dir, lat, lon):
     return os.path.join(build_dir, "Data" + short_latlon(lat, lon) + ".mesh")
 
 
+def binary_mesh_file(mesh_file):
+    return mesh_file[:-5] + ".bmesh"
+
+
+def masks_manifest(dest_dir):
+    return os.path.join(dest_dir, "masks_manifest.json")
+
+
+def masks_shared_file(build_dir, name):
+    return os.path.join(build_dir, "masks_" + name + ".npy")
+
+
+def report_file(build_dir, lat, lon, ext):
+    return os.path.join(
+        build_dir, "Ortho4XP_" + short_latlon(lat, lon) + "_report." + ext
+    )
+
+
 def dsf_file(build_dir, lat, lon):
     return os.path.join(
         build_dir, "Earth nav data", long_latlon(lat, lon) + ".dsf"
@@ -262,6 +281,10 @@ def custom_water_dir(lat, lon):
     return os.path.join(OSM_dir, long_latlon(lat, lon), "custom_water")
 
 
+def subtile_cache_file():
+    return os.path.join(Imagery_dir, "subtile_cache.db")
+
+
 def osm_cached(lat, lon, cached_suffix):
     return os.path.join(
         OSM_dir,
@@ -270,6 +293,21 @@ def osm_cached(lat, lon, cached_suffix):
     )
 
 
+def osm_binary_cached(osm_file_name):
+    for ext in (".bz2", ".osm"):
+        if osm_file_name.endswith(ext):
+            osm_file_name = osm_file_name[: -len(ext)]
+    return osm_file_name + ".npz"
+
+
+def osm_extract_dir(name):
+    return os.path.join(OSM_extracts_dir, name)
+
+
+def osm_extract_tile(name, lat, lon):
+    return os.path.join(OSM_extracts_dir, name, short_latlon(lat, lon) + ".npz")
+
+
 def osm_old_cached(lat, lon, query):
     subtags = query.split('"')
     return os.path.join(
@@ -309,6 +347,13 @@ def elevation_data(source, lat, lon):
         return base_file_name(lat, lon) + "_NED1.tif"
 ##############################################################################
 
+##############################################################################
+def decoded_elevation_file(file_name):
+    return file_name + ".npy"
+
+
+##############################################################################
+
 ##############################################################################
 def generic_tif(lat, lon):
     return base_file_name(lat, lon) + ".tif"
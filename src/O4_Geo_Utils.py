@@ -1,5 +1,6 @@
 from math import log, tan, pi, atan, exp, cos, sin, sqrt, atan2
 from pyproj import CRS, Transformer
+import numpy
 
 earth_radius = 6378137
 lat_to_m = pi * earth_radius / 180
@@ -96,6 +97,16 @@ def wgs84_to_pix(lat, lon, zoomlevel):
     return (pix_x, pix_y)
 ################################################################################
 
+################################################################################
+def wgs84_to_pix_vec(lat, lon, zoomlevel):
+    # Same as wgs84_to_pix for arrays, returns int64 arrays.
+    rat_x = numpy.asarray(lon, dtype=numpy.float64) / 180
+    rat_y = numpy.log(numpy.tan((90 + numpy.asarray(lat)) * pi / 360)) / pi
+    pix_x = numpy.round((rat_x + 1) * (2 ** (zoomlevel + 7)))
+    pix_y = numpy.round((1 - rat_y) * (2 ** (zoomlevel + 7)))
+    return (pix_x.astype(numpy.int64), pix_y.astype(numpy.int64))
+################################################################################
+
 ################################################################################
 def pix_to_wgs84(pix_x, pix_y, zoomlevel):
     rat_x = pix_x / (2 ** (zoomlevel + 7)) - 1
@@ -133,6 +144,17 @@ def wgs84_to_orthogrid(lat, lon, zoomlevel):
     return (til_x, til_y)
 ################################################################################
 
+################################################################################
+def wgs84_to_orthogrid_vec(lat, lon, zoomlevel):
+    # Same as wgs84_to_orthogrid for arrays, returns int64 arrays.
+    ratio_x = numpy.asarray(lon, dtype=numpy.float64) / 180
+    ratio_y = numpy.log(numpy.tan((90 + numpy.asarray(lat)) * pi / 360)) / pi
+    mult = 2 ** (zoomlevel - 5)
+    til_x = ((ratio_x + 1) * mult).astype(numpy.int64) * 16
+    til_y = ((1 - ratio_y) * mult).astype(numpy.int64) * 16
+    return (til_x, til_y)
+################################################################################
+
 ################################################################################
 def st_coord(lat, lon, tex_x, tex_y, zoomlevel, provider_code):
     """
@@ -0,0 +1,203 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+
+################################################################################
+# Persistent cache of the WMTS/TMS subtiles (usually 256x256 jpegs) which
+# make up the 4096x4096 orthophotos, keyed by provider/zoom/x/y so that a
+# change of zoomlevel or of a combined provider does not need to fetch them
+# again. The images are stored once per content (md5) in an SQLite database,
+# blank sea or no-data tiles repeated thousands of times thus cost nothing.
+# The least recently used subtiles are evicted when the total size exceeds
+# subtile_cache_size. One connection per process, shared by the download
+# threads.
+################################################################################
+
+subtile_cache_size = 0  # in GB, 0 disables the cache
+
+connection = None
+connection_pid = None
+lock = threading.Lock()
+total_size = 0
+stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+################################################################################
+def open_cache():
+    global connection, connection_pid, total_size
+    if connection is not None and connection_pid == os.getpid():
+        return connection
+    try:
+        if not os.path.isdir(FNAMES.Imagery_dir):
+            os.makedirs(FNAMES.Imagery_dir)
+        connection = sqlite3.connect(
+            FNAMES.subtile_cache_file(),
+            timeout=60,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS subtiles (provider TEXT, zoom INTEGER, "
+            + "x INTEGER, y INTEGER, hash BLOB, last_access REAL, "
+            + "PRIMARY KEY (provider, zoom, x, y))"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS subtiles_access "
+            + "ON subtiles (last_access)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS subtiles_hash ON subtiles (hash)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (hash BLOB PRIMARY KEY, "
+            + "data BLOB, size INTEGER)"
+        )
+        total_size = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()[0]
+        connection_pid = os.getpid()
+    except Exception as e:
+        UI.lvprint(1, "WARNING: Could not open the subtile cache, disabling it.")
+        UI.vprint(3, e)
+        connection = None
+    return connection
+
+
+################################################################################
+def is_enabled():
+    return subtile_cache_size > 0
+
+
+################################################################################
+def max_size():
+    return subtile_cache_size * 2 ** 30
+
+
+################################################################################
+def get(provider_code, zoom, x, y):
+    # Returns the cached content or None.
+    if not is_enabled():
+        return None
+    with lock:
+        db = open_cache()
+        if db is None:
+            return None
+        try:
+            row = db.execute(
+                "SELECT blobs.data FROM subtiles JOIN blobs "
+                + "ON subtiles.hash = blobs.hash WHERE provider=? AND "
+                + "zoom=? AND x=? AND y=?",
+                (provider_code, zoom, x, y),
+            ).fetchone()
+            if row is None:
+                stats["misses"] += 1
+                return None
+            db.execute(
+                "UPDATE subtiles SET last_access=? WHERE provider=? AND "
+                + "zoom=? AND x=? AND y=?",
+                (time.time(), provider_code, zoom, x, y),
+            )
+            stats["hits"] += 1
+            return row[0]
+        except Exception as e:
+            UI.vprint(3, "Subtile cache read error:", e)
+            return None
+
+
+################################################################################
+def put(provider_code, zoom, x, y, content):
+    global total_size
+    if not is_enabled():
+        return 0
+    digest = hashlib.md5(content).digest()
+    with lock:
+        db = open_cache()
+        if db is None:
+            return 0
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute(
+                "INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)",
+                (digest, content, len(content)),
+            ).rowcount:
+                total_size += len(content)
+            old = db.execute(
+                "SELECT hash FROM subtiles WHERE provider=? AND zoom=? AND "
+                + "x=? AND y=?",
+                (provider_code, zoom, x, y),
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO subtiles VALUES (?, ?, ?, ?, ?, ?)",
+                (provider_code, zoom, x, y, digest, time.time()),
+            )
+            if old and old[0] != digest:
+                remove_orphan_blobs(db, [old[0]])
+            if total_size > max_size():
+                evict(db)
+            db.execute("COMMIT")
+            stats["stored"] += 1
+            return 1
+        except Exception as e:
+            UI.vprint(3, "Subtile cache write error:", e)
+            try:
+                db.execute("ROLLBACK")
+            except:
+                pass
+            return 0
+
+
+################################################################################
+def remove_orphan_blobs(db, hashes):
+    global total_size
+    for digest in set(hashes):
+        if db.execute(
+            "SELECT 1 FROM subtiles WHERE hash=? LIMIT 1", (digest,)
+        ).fetchone():
+            continue
+        row = db.execute(
+            "SELECT size FROM blobs WHERE hash=?", (digest,)
+        ).fetchone()
+        if row:
+            db.execute("DELETE FROM blobs WHERE hash=?", (digest,))
+            total_size -= row[0]
+
+
+################################################################################
+def evict(db):
+    # Least recently used subtiles go first, down to 90% of the maximum size
+    # so that we do not evict at every single insertion.
+    while total_size > 0.9 * max_size():
+        rows = db.execute(
+            "SELECT rowid, hash FROM subtiles ORDER BY last_access LIMIT 256"
+        ).fetchall()
+        if not rows:
+            break
+        db.executemany(
+            "DELETE FROM subtiles WHERE rowid=?", [(row[0],) for row in rows]
+        )
+        stats["evicted"] += len(rows)
+        remove_orphan_blobs(db, [row[1] for row in rows])
+
+
+################################################################################
+def print_stats():
+    if not is_enabled() or not (stats["hits"] or stats["misses"]):
+        return
+    UI.vprint(
+        1,
+        "    Subtile cache :",
+        stats["hits"],
+        "hits,",
+        stats["misses"],
+        "misses (hit rate",
+        str(round(100 * stats["hits"] / (stats["hits"] + stats["misses"])))
+        + "%),",
+        stats["evicted"],
+        "evicted, total size",
+        UI.human_print(total_size) + ".",
+    )
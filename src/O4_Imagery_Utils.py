@@ -6,6 +6,10 @@ import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
+import O4_DDS_Utils as DDS
+import O4_Imagery_Cache as ICACHE
+import O4_Async_Utils as AIO
 import time
 import os
 import sys
@@ -14,6 +18,7 @@ import io
 import requests
 import queue
 import random
+import threading
 from math import ceil, log, tan, pi
 import numpy
 from PIL import Image, ImageFilter, ImageEnhance, ImageOps
@@ -43,6 +48,19 @@ check_tms_response = False
 max_connect_retries = 10
 max_baddata_retries = 10
 
+download_engine = "threads"
+# cap on the subtile requests in flight in the process, all textures together
+# (threads engine, the asyncio one has max_async_requests)
+max_inflight_requests = 64
+inflight_requests = threading.BoundedSemaphore(max_inflight_requests)
+# textures can be downloaded concurrently, two of them may need the same
+# orthophoto (combined providers with a max_zl)
+ortho_locks = {}
+ortho_locks_lock = threading.Lock()
+dds_encoder = "nvcompress"
+# process pool for the built-in dds encoder, set up by TILE.build_tile
+dds_encoder_pool = None
+
 user_agent_generic = (
     "Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0"
 )
@@ -1000,7 +1018,55 @@ def has_data(
 ################################################################################
 
 ################################################################################
-def http_request_to_image(width, height, url, request_headers, http_session):
+def read_image_response(url, status_code, headers, content, cache_key):
+    # Common interpretation of a server answer for the threaded and the
+    # asyncio downloads. Returns ("done", (success, data)), ("retry", delay)
+    # or ("break", None).
+    # Bing white image with small camera or Arcgis no data yet =>
+    # try to downsample to lower ZL
+    if ("Content-Length" in headers) and int(headers["Content-Length"]) <= 2521:
+        if (headers["Content-Length"] == "1033") and ("virtualearth" in url):
+            UI.vprint(3, url, headers)
+            return ("done", (0, "[404]"))
+        if (headers["Content-Length"] == "2521") and ("arcgisonline" in url):
+            UI.vprint(3, url, headers)
+            return ("done", (0, "[404]"))
+    if ("[200]" in status_code) and ("image" in headers["Content-Type"]):
+        STATS.count("imagery_bytes", len(content))
+        try:
+            small_image = Image.open(io.BytesIO(content))
+            if cache_key:
+                ICACHE.put(*cache_key, content)
+            return ("done", (1, small_image))
+        except:
+            UI.vprint(
+                2, "Server said 'OK', but the received ", "image was corrupted."
+            )
+            UI.vprint(3, url, headers)
+            return ("retry", 0)
+    elif "[404]" in status_code:
+        UI.vprint(2, "Server said 'Not Found'")
+        UI.vprint(3, url, headers)
+    elif "[200]" in status_code:
+        UI.vprint(2, "Server said 'OK' but sent us the wrong Content-Type.")
+        UI.vprint(3, url, headers, content)
+    elif "[403]" in status_code:
+        UI.vprint(2, "Server said 'Forbidden' ! (IP banned?)")
+        UI.vprint(3, url, headers, content)
+    elif "[5" in status_code or "[429]" in status_code:
+        UI.vprint(2, "Server said 'Internal Error'.", status_code)
+        if check_tms_response:
+            return ("retry", 2)
+    else:
+        UI.vprint(2, "Unmanaged Server answer:", status_code)
+        UI.vprint(3, url, headers)
+    return ("break", None)
+
+
+################################################################################
+def http_request_to_image(
+    width, height, url, request_headers, http_session, cache_key=None
+):
     UI.vprint(
         3, "HTTP request issued :", url, "\nRequest headers :", request_headers
     )
@@ -1009,64 +1075,23 @@ def http_request_to_image(width, height, url, request_headers, http_session):
     r = False
     while True:
         try:
-            if request_headers:
-                r = http_session.get(
-                    url, timeout=http_timeout, headers=request_headers
-                )
-            else:
-                r = http_session.get(url, timeout=http_timeout)
-            status_code = str(r)
-            # Bing white image with small camera or Arcgis no data yet =>
-            # try to downsample to lower ZL
-            if ("Content-Length" in r.headers) and int(
-                r.headers["Content-Length"]
-            ) <= 2521:
-                if (r.headers["Content-Length"] == "1033") and (
-                    "virtualearth" in url
-                ):
-                    UI.vprint(3, url, r.headers)
-                    return (0, "[404]")
-                if (r.headers["Content-Length"] == "2521") and (
-                    "arcgisonline" in url
-                ):
-                    UI.vprint(3, url, r.headers)
-                    return (0, "[404]")
-            if ("[200]" in status_code) and (
-                "image" in r.headers["Content-Type"]
-            ):
-                try:
-                    small_image = Image.open(io.BytesIO(r.content))
-                    return (1, small_image)
-                except:
-                    UI.vprint(
-                        2,
-                        "Server said 'OK', but the received ",
-                        "image was corrupted.",
+            with inflight_requests:
+                if request_headers:
+                    r = http_session.get(
+                        url, timeout=http_timeout, headers=request_headers
                     )
-                    UI.vprint(3, url, r.headers)
-            elif "[404]" in status_code:
-                UI.vprint(2, "Server said 'Not Found'")
-                UI.vprint(3, url, r.headers)
-                break
-            elif "[200]" in status_code:
-                UI.vprint(
-                    2, "Server said 'OK' but sent us the wrong Content-Type."
-                )
-                UI.vprint(3, url, r.headers, r.content)
-                break
-            elif "[403]" in status_code:
-                UI.vprint(2, "Server said 'Forbidden' ! (IP banned?)")
-                UI.vprint(3, url, r.headers, r.content)
-                break
-            elif "[5" in status_code:
-                UI.vprint(2, "Server said 'Internal Error'.", status_code)
-                if not check_tms_response:
-                    break
-                time.sleep(2)
-            else:
-                UI.vprint(2, "Unmanaged Server answer:", status_code)
-                UI.vprint(3, url, r.headers)
+                else:
+                    r = http_session.get(url, timeout=http_timeout)
+            status_code = str(r)
+            (action, result) = read_image_response(
+                url, status_code, r.headers, r.content, cache_key
+            )
+            if action == "done":
+                return result
+            elif action == "break":
                 break
+            if result:
+                time.sleep(result)
             if UI.red_flag:
                 return (0, "Stopped")
             tentative_image += 1
@@ -1090,6 +1115,63 @@ def http_request_to_image(width, height, url, request_headers, http_session):
     return (0, status_code)
 
 
+################################################################################
+async def http_request_to_image_async(url, request_headers, provider, cache_key):
+    # Same as http_request_to_image, but the waits between retries only
+    # suspend this very request.
+    UI.vprint(
+        3, "HTTP request issued :", url, "\nRequest headers :", request_headers
+    )
+    provider_limiter = AIO.get_limiter(
+        provider["code"],
+        int(provider.get("max_threads", 16)),
+        float(provider["max_rate"]) if "max_rate" in provider else None,
+    )
+    tentative_request = 0
+    tentative_image = 0
+    while True:
+        try:
+            (status, headers, content) = await AIO.http_get(
+                url, request_headers, http_timeout, provider_limiter
+            )
+            status_code = "<Response [" + str(status) + "]>"
+            (action, result) = await AIO.in_thread(
+                read_image_response,
+                url,
+                status_code,
+                headers,
+                content,
+                cache_key,
+            )
+            if action == "done":
+                return result
+            elif action == "break":
+                break
+            if result:
+                await AIO.backoff(tentative_image, result)
+            if UI.red_flag:
+                return (0, "Stopped")
+            tentative_image += 1
+        except Exception as e:
+            if not AIO.is_connection_error(e):
+                raise
+            status_code = "Connection failure"
+            UI.vprint(2, "Server could not be connected, retrying.")
+            UI.vprint(3, e)
+            if not check_tms_response:
+                break
+            await AIO.backoff(tentative_request)
+            if UI.red_flag:
+                return (0, "Stopped")
+            tentative_request += 1
+        if (
+            tentative_request == max_connect_retries
+            or tentative_image == max_baddata_retries
+        ):
+            break
+    return (0, status_code)
+
+
 ################################################################################
 
 ################################################################################
@@ -1147,143 +1229,228 @@ def get_wms_image(bbox, width, height, provider, http_session):
 ################################################################################
 
 ################################################################################
-def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
-    til_x_orig, til_y_orig = til_x, til_y
-    down_sample = 0
-    while True:
-        request_headers = None
-        if has_URL and provider["code"] in URL.custom_url_list:
-            (url, request_headers) = URL.custom_tms_request(
-                tilematrix, til_x, til_y, provider
-            )
-        elif provider["request_type"] == "tms":  # TMS
-            url = provider["url_template"].replace("{zoom}", str(tilematrix))
-            url = url.replace("{x}", str(til_x))
-            url = url.replace("{y}", str(til_y))
-            url = url.replace("{|y|}", str(abs(til_y) - 1))
-            url = url.replace("{-y}", str(2 ** tilematrix - 1 - til_y))
-            url = url.replace(
-                "{quadkey}", GEO.gtile_to_quadkey(til_x, til_y, tilematrix)
-            )
-            url = url.replace(
-                "{xcenter}",
-                str(
-                    (til_x + 0.5)
-                    * provider["resolutions"][tilematrix]
-                    * provider["tile_size"]
-                    + provider["top_left_corner"][tilematrix][0]
-                ),
-            )
-            url = url.replace(
-                "{ycenter}",
-                str(
-                    -1
-                    * (til_y + 0.5)
-                    * provider["resolutions"][tilematrix]
+def wmts_request(tilematrix, til_x, til_y, provider):
+    # Returns (url, request_headers) for the non local providers.
+    request_headers = None
+    if has_URL and provider["code"] in URL.custom_url_list:
+        (url, request_headers) = URL.custom_tms_request(
+            tilematrix, til_x, til_y, provider
+        )
+    elif provider["request_type"] == "tms":  # TMS
+        url = provider["url_template"].replace("{zoom}", str(tilematrix))
+        url = url.replace("{x}", str(til_x))
+        url = url.replace("{y}", str(til_y))
+        url = url.replace("{|y|}", str(abs(til_y) - 1))
+        url = url.replace("{-y}", str(2 ** tilematrix - 1 - til_y))
+        url = url.replace(
+            "{quadkey}", GEO.gtile_to_quadkey(til_x, til_y, tilematrix)
+        )
+        url = url.replace(
+            "{xcenter}",
+            str(
+                (til_x + 0.5)
+                * provider["resolutions"][tilematrix]
+                * provider["tile_size"]
+                + provider["top_left_corner"][tilematrix][0]
+            ),
+        )
+        url = url.replace(
+            "{ycenter}",
+            str(
+                -1
+                * (til_y + 0.5)
+                * provider["resolutions"][tilematrix]
+                * provider["tile_size"]
+                + provider["top_left_corner"][tilematrix][1]
+            ),
+        )
+        url = url.replace(
+            "{size}",
+            str(
+                int(
+                    provider["resolutions"][tilematrix]
                     * provider["tile_size"]
-                    + provider["top_left_corner"][tilematrix][1]
-                ),
-            )
-            url = url.replace(
-                "{size}",
-                str(
-                    int(
-                        provider["resolutions"][tilematrix]
-                        * provider["tile_size"]
-                    )
-                ),
-            )
-            if "{switch:" in url:
-                (url_0, tmp) = url.split("{switch:")
-                (tmp, url_2) = tmp.split("}")
-                server_list = tmp.split(",")
-                url_1 = random.choice(server_list).strip()
-                url = url_0 + url_1 + url_2
-        elif provider["request_type"] == "wmts":  # WMTS
-            url = (
-                provider["url_prefix"]
-                + "&SERVICE=WMTS&VERSION=1.0.0&REQUEST=GetTile&LAYER="
-                + provider["layers"]
-                + "&STYLE=&FORMAT=image/"
-                + provider["image_type"]
-                + "&TILEMATRIXSET="
-                + provider["tilematrixset"]["identifier"]
-                + "&TILEMATRIX="
-                + provider["tilematrixset"]["tilematrices"][tilematrix][
-                    "identifier"
-                ]
-                + "&TILEROW="
-                + str(til_y)
-                + "&TILECOL="
-                + str(til_x)
-            )
-        elif provider["request_type"] == "local_tms":  # LOCAL TMS
-            # ! Too much specific, needs to be changed by a
-            # x,y-> file_name lambda fct
-            url_local = provider["url_template"].replace(
-                "{x}", str(5 * til_x).zfill(4)
-            )
-            url_local = url_local.replace("{y}", str(-5 * til_y).zfill(4))
-            if os.path.isfile(url_local):
-                return (1, Image.open(url_local))
-            else:
-                UI.vprint(
-                    2,
-                    "! File ",
-                    url_local,
-                    "absent, using white texture instead !",
                 )
-                return (
-                    0,
-                    Image.new(
-                        "RGB",
-                        (provider["tile_size"], provider["tile_size"]),
-                        "white",
-                    ),
-                )
-        if not request_headers:
-            if "fake_headers" in provider:
-                request_headers = provider["fake_headers"]
-            else:
-                request_headers = request_headers_generic
-        width = height = provider["tile_size"]
-        (success, data) = http_request_to_image(
-            width, height, url, request_headers, http_session
+            ),
         )
-        if success and not down_sample:
-            return (success, data)
-        elif success and down_sample:
-            x0 = (
-                (til_x_orig - 2 ** down_sample * til_x)
-                * width
-                // (2 ** down_sample)
-            )
-            y0 = (
-                (til_y_orig - 2 ** down_sample * til_y)
-                * height
-                // (2 ** down_sample)
-            )
-            x1 = x0 + width // (2 ** down_sample)
-            y1 = y0 + height // (2 ** down_sample)
-            return (
+        if "{switch:" in url:
+            (url_0, tmp) = url.split("{switch:")
+            (tmp, url_2) = tmp.split("}")
+            server_list = tmp.split(",")
+            url_1 = random.choice(server_list).strip()
+            url = url_0 + url_1 + url_2
+    elif provider["request_type"] == "wmts":  # WMTS
+        url = (
+            provider["url_prefix"]
+            + "&SERVICE=WMTS&VERSION=1.0.0&REQUEST=GetTile&LAYER="
+            + provider["layers"]
+            + "&STYLE=&FORMAT=image/"
+            + provider["image_type"]
+            + "&TILEMATRIXSET="
+            + provider["tilematrixset"]["identifier"]
+            + "&TILEMATRIX="
+            + provider["tilematrixset"]["tilematrices"][tilematrix][
+                "identifier"
+            ]
+            + "&TILEROW="
+            + str(til_y)
+            + "&TILECOL="
+            + str(til_x)
+        )
+    if not request_headers:
+        if "fake_headers" in provider:
+            request_headers = provider["fake_headers"]
+        else:
+            request_headers = request_headers_generic
+    return (url, request_headers)
+
+
+################################################################################
+def get_local_tms_image(til_x, til_y, provider):
+    # ! Too much specific, needs to be changed by a
+    # x,y-> file_name lambda fct
+    url_local = provider["url_template"].replace(
+        "{x}", str(5 * til_x).zfill(4)
+    )
+    url_local = url_local.replace("{y}", str(-5 * til_y).zfill(4))
+    if os.path.isfile(url_local):
+        return (1, Image.open(url_local))
+    else:
+        UI.vprint(
+            2,
+            "! File ",
+            url_local,
+            "absent, using white texture instead !",
+        )
+        return (
+            0,
+            Image.new(
+                "RGB",
+                (provider["tile_size"], provider["tile_size"]),
+                "white",
+            ),
+        )
+
+
+################################################################################
+def wmts_answer(
+    success, data, provider, tilematrix, til_x, til_y, down_sample, til_orig
+):
+    # Turns the answer for the subtile til_x, til_y (the down_sample-th
+    # parent of the subtile til_orig we are after) into (result, None) or, if
+    # its parent should be tried, into (None, (tilematrix, til_x, til_y,
+    # down_sample)) for it.
+    width = height = provider["tile_size"]
+    (til_x_orig, til_y_orig) = til_orig
+    if success and not down_sample:
+        return ((success, data), None)
+    elif success and down_sample:
+        x0 = (
+            (til_x_orig - 2 ** down_sample * til_x)
+            * width
+            // (2 ** down_sample)
+        )
+        y0 = (
+            (til_y_orig - 2 ** down_sample * til_y)
+            * height
+            // (2 ** down_sample)
+        )
+        x1 = x0 + width // (2 ** down_sample)
+        y1 = y0 + height // (2 ** down_sample)
+        return (
+            (
                 success,
                 data.crop((x0, y0, x1, y1)).resize(
                     (width, height), Image.BICUBIC
                 ),
+            ),
+            None,
+        )
+    elif "[404]" in data:
+        if ("grid_type" not in provider) or (
+            provider["grid_type"] != "webmercator"
+        ):
+            return ((0, Image.new("RGB", (width, height), "white")), None)
+        if down_sample + 1 >= 6:
+            return ((0, Image.new("RGB", (width, height), "white")), None)
+        return (
+            None,
+            (tilematrix - 1, til_x // 2, til_y // 2, down_sample + 1),
+        )
+    else:
+        return ((0, Image.new("RGB", (width, height), "white")), None)
+
+
+################################################################################
+def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
+    if provider["request_type"] == "local_tms" and not (
+        has_URL and provider["code"] in URL.custom_url_list
+    ):
+        return get_local_tms_image(til_x, til_y, provider)
+    til_orig = (til_x, til_y)
+    down_sample = 0
+    while True:
+        (url, request_headers) = wmts_request(
+            tilematrix, til_x, til_y, provider
+        )
+        width = height = provider["tile_size"]
+        cache_key = (provider["code"], tilematrix, til_x, til_y)
+        content = ICACHE.get(*cache_key)
+        if content is not None:
+            (success, data) = (1, Image.open(io.BytesIO(content)))
+        else:
+            (success, data) = http_request_to_image(
+                width, height, url, request_headers, http_session, cache_key
             )
-        elif "[404]" in data:
-            if ("grid_type" not in provider) or (
-                provider["grid_type"] != "webmercator"
-            ):
-                return (0, Image.new("RGB", (width, height), "white"))
-            til_x = til_x // 2
-            til_y = til_y // 2
-            tilematrix -= 1
-            down_sample += 1
-            if down_sample >= 6:
-                return (0, Image.new("RGB", (width, height), "white"))
+        (result, next_try) = wmts_answer(
+            success,
+            data,
+            provider,
+            tilematrix,
+            til_x,
+            til_y,
+            down_sample,
+            til_orig,
+        )
+        if result:
+            return result
+        (tilematrix, til_x, til_y, down_sample) = next_try
+
+
+################################################################################
+async def get_wmts_image_async(tilematrix, til_x, til_y, provider):
+    if provider["request_type"] == "local_tms" and not (
+        has_URL and provider["code"] in URL.custom_url_list
+    ):
+        return await AIO.in_thread(get_local_tms_image, til_x, til_y, provider)
+    til_orig = (til_x, til_y)
+    down_sample = 0
+    while True:
+        (url, request_headers) = wmts_request(
+            tilematrix, til_x, til_y, provider
+        )
+        cache_key = (provider["code"], tilematrix, til_x, til_y)
+        content = await AIO.in_thread(ICACHE.get, *cache_key)
+        if content is not None:
+            (success, data) = (1, Image.open(io.BytesIO(content)))
         else:
-            return (0, Image.new("RGB", (width, height), "white"))
+            (success, data) = await http_request_to_image_async(
+                url, request_headers, provider, cache_key
+            )
+        (result, next_try) = await AIO.in_thread(
+            wmts_answer,
+            success,
+            data,
+            provider,
+            tilematrix,
+            til_x,
+            til_y,
+            down_sample,
+            til_orig,
+        )
+        if result:
+            return result
+        (tilematrix, til_x, til_y, down_sample) = next_try
 
 
 ################################################################################
@@ -1323,6 +1490,33 @@ def get_and_paste_wmts_part(
     return success
 
 
+################################################################################
+
+################################################################################
+async def get_and_paste_wmts_part_async(
+    tilematrix,
+    til_x,
+    til_y,
+    provider,
+    big_image,
+    x0,
+    y0,
+    http_session,
+    subt_size=None,
+):
+    # http_session is only there to share the arguments of the threaded
+    # version, connections are pooled by the asyncio engine.
+    (success, small_image) = await get_wmts_image_async(
+        tilematrix, til_x, til_y, provider
+    )
+    if subt_size:
+        small_image = await AIO.in_thread(
+            small_image.resize, subt_size, Image.BICUBIC
+        )
+    await AIO.in_thread(big_image.paste, small_image, (x0, y0))
+    return success
+
+
 ################################################################################
 
 ################################################################################
@@ -1358,9 +1552,16 @@ def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
     else:
         max_threads = 16
     # and finally activate them
-    success = parallel_execute(
-        get_and_paste_wmts_part, download_queue, max_threads, progress
-    )
+    if download_engine == "asyncio":
+        success = AIO.run(
+            AIO.gather_queue(
+                get_and_paste_wmts_part_async, download_queue, progress
+            )
+        ).result()
+    else:
+        success = parallel_execute(
+            get_and_paste_wmts_part, download_queue, max_threads, progress
+        )
     # once out big_image has been filled and we return it
     return (success, big_image)
 
@@ -1500,6 +1701,10 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
         success = parallel_execute(
             get_and_paste_wms_part, download_queue, max_threads
         )
+    elif download_engine == "asyncio":
+        success = AIO.run(
+            AIO.gather_queue(get_and_paste_wmts_part_async, download_queue)
+        ).result()
     elif provider["request_type"] in ["wmts", "tms", "local_tms"]:
         success = parallel_execute(
             get_and_paste_wmts_part, download_queue, max_threads
@@ -1533,6 +1738,7 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
 ################################################################################
 
 ################################################################################
+@STATS.timed("texture_download")
 def download_jpeg_ortho(
     file_dir,
     file_name,
@@ -1601,11 +1807,20 @@ def download_jpeg_ortho(
             e,
         )
         return 0
+    STATS.count_file(os.path.join(file_dir, file_name))
     return 1
 
 
 ################################################################################
 
+################################################################################
+def ortho_lock(file_path):
+    with ortho_locks_lock:
+        if file_path not in ortho_locks:
+            ortho_locks[file_path] = threading.Lock()
+        return ortho_locks[file_path]
+
+
 ################################################################################
 def build_jpeg_ortho(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, out_file_name=""
@@ -1662,31 +1877,34 @@ def build_jpeg_ortho(
                     true_zl,
                     providers_dict[rlayer["layer_code"]],
                 )
-                if not os.path.isfile(
-                    os.path.join(true_file_dir, true_file_name)
-                ):
-                    UI.vprint(
-                        1,
-                        "   Downloading missing orthophoto "
-                        + true_file_name
-                        + " (for combining in "
-                        + provider_code
-                        + ")",
-                    )
-                    if not download_jpeg_ortho(
-                        true_file_dir, true_file_name, *true_texture_attributes
+                with ortho_lock(os.path.join(true_file_dir, true_file_name)):
+                    if not os.path.isfile(
+                        os.path.join(true_file_dir, true_file_name)
                     ):
-                        return 0
-                else:
-                    UI.vprint(
-                        2,
-                        "   The orthophoto "
-                        + true_file_name
-                        + " (for combining in "
-                        + provider_code
-                        + ") "
-                        + "is already present.",
-                    )
+                        UI.vprint(
+                            1,
+                            "   Downloading missing orthophoto "
+                            + true_file_name
+                            + " (for combining in "
+                            + provider_code
+                            + ")",
+                        )
+                        if not download_jpeg_ortho(
+                            true_file_dir,
+                            true_file_name,
+                            *true_texture_attributes,
+                        ):
+                            return 0
+                    else:
+                        UI.vprint(
+                            2,
+                            "   The orthophoto "
+                            + true_file_name
+                            + " (for combining in "
+                            + provider_code
+                            + ") "
+                            + "is already present.",
+                        )
         if not data_found:
             UI.lvprint(
                 1,
@@ -1733,16 +1951,18 @@ def build_jpeg_ortho(
         file_dir = FNAMES.jpeg_file_dir_from_attributes(
             tile.lat, tile.lon, zoomlevel, providers_dict[provider_code]
         )
-        if not os.path.isfile(os.path.join(file_dir, file_name)):
-            UI.vprint(1, "   Downloading missing orthophoto " + file_name)
-            if not download_jpeg_ortho(
-                file_dir, file_name, *texture_attributes
-            ):
-                return 0
-        else:
-            UI.vprint(
-                2, "   The orthophoto " + file_name + " is already present."
-            )
+        with ortho_lock(os.path.join(file_dir, file_name)):
+            if not os.path.isfile(os.path.join(file_dir, file_name)):
+                UI.vprint(1, "   Downloading missing orthophoto " + file_name)
+                if not download_jpeg_ortho(
+                    file_dir, file_name, *texture_attributes
+                ):
+                    return 0
+            else:
+                UI.vprint(
+                    2,
+                    "   The orthophoto " + file_name + " is already present.",
+                )
     else:
         (tlat, tlon) = GEO.gtile_to_wgs84(
             til_x_left + 8, til_y_top + 8, zoomlevel
@@ -2288,6 +2508,7 @@ def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
 ################################################################################
 
 ################################################################################
+@STATS.timed("texture_convert")
 def convert_texture(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, type="dds"
 ):
@@ -2314,6 +2535,8 @@ def convert_texture(
     )
     erase_tmp_png = False
     erase_tmp_tif = False
+    builtin_dds = type == "dds" and dds_encoder == "builtin"
+    big_image = None
     dxt5 = False
     masked_texture = False
     if tile.imprint_masks_to_dds and type == "dds":
@@ -2389,9 +2612,12 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(UI.Ortho4XP_dir, "tmp", png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not builtin_dds:
+            file_to_convert = os.path.join(
+                UI.Ortho4XP_dir, "tmp", png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
         # If one wanted to distribute jpegs instead of dds, uncomment the
         # next line.
         # big_image.convert('RGB').save(os.path.join(tile.build_dir,
@@ -2425,13 +2651,33 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(UI.Ortho4XP_dir, "tmp", png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not builtin_dds:
+            file_to_convert = os.path.join(
+                UI.Ortho4XP_dir, "tmp", png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
     # finally if nothing needs to be done prior to the conversion
     else:
         file_to_convert = os.path.join(file_dir, jpeg_file_name)
     # eventually the dds conversion
+    if builtin_dds:
+        if big_image is None:
+            big_image = Image.open(file_to_convert)
+        try:
+            encode_dds(
+                big_image,
+                os.path.join(tile.build_dir, "textures", out_file_name),
+                dxt5,
+            )
+        except Exception as e:
+            UI.lvprint(
+                1,
+                "ERROR: Could not convert texture",
+                os.path.join(tile.build_dir, "textures", out_file_name),
+            )
+            UI.vprint(3, e)
+        return
     if type == "dds":
         if not dxt5:
             conv_cmd = [
@@ -2561,6 +2807,19 @@ def convert_texture(
 
 ################################################################################
 
+################################################################################
+def encode_dds(big_image, dds_file_name, dxt5):
+    # Built-in encoder, in one of the dds_encoder_pool processes if any.
+    if dds_encoder_pool is None:
+        return DDS.write_dds(big_image, dds_file_name, bc3=dxt5)
+    big_image = numpy.asarray(
+        big_image.convert("RGBA" if dxt5 else "RGB"), dtype=numpy.uint8
+    )
+    return dds_encoder_pool.submit(
+        DDS.write_dds, big_image, dds_file_name, dxt5
+    ).result()
+
+
 ################################################################################
 def geotag(input_file_name):
     suffix = input_file_name.split(".")[-1]
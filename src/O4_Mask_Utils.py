@@ -1,14 +1,21 @@
 import os
 import sys
 import time
+import copy
+import json
 import queue
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from math import atan, ceil, floor
 import numpy
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
 import skfmm
 import O4_DEM_Utils as DEM
+import O4_Raster_Utils as RASTER
 import O4_File_Names as FNAMES
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_Geo_Utils as GEO
 import O4_Imagery_Utils as IMG
 import O4_OSM_Utils as OSM
@@ -18,6 +25,18 @@ from O4_Parallel_Utils import parallel_execute
 
 mask_altitude_above = 0.5
 masks_build_slots = 4
+masks_build_engine = "threads"
+# Bump when the masks produced from the same inputs change
+masks_manifest_version = 1
+mask_input_vars = (
+    "mask_zl",
+    "masks_width",
+    "masking_mode",
+    "use_masks_for_inland",
+    "distance_masks_too",
+    "masks_use_DEM_too",
+    "masks_custom_extent",
+)
 
 ################################################################################
 def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
@@ -66,6 +85,7 @@ def build_masks(tile, for_imagery=False):
     if UI.is_working:
         return 0
     UI.is_working = 1
+    STATS.reset()
     
     # Which grey level for inland water equivalent ?
     im = Image.open(os.path.join(FNAMES.Utils_dir, "water_transition.png"))
@@ -110,13 +130,12 @@ def build_masks(tile, for_imagery=False):
     # Select nearby meshes
     mesh_list = select_neighbor_meshes(tile)
 
-    # Delete old masks
-    UI.vprint(1, "-> Deleting existing masks")
-    delete_old_masks_in_tile(tile, dest_dir)
-    
     # Record water tris form mesh (and portions of nearby meshes)
     UI.vprint(1, "-> Reading mesh data")
-    (dico_sea, dico_inland) = record_water_tris(tile, )
+    (water_nodes, dico_sea, dico_inland) = record_water_tris(tile)
+    if UI.red_flag:
+        UI.exit_message_and_bottom_line()
+        return 0
 
     UI.vprint(1, "-> Construction of the masks")
 
@@ -136,89 +155,318 @@ def build_masks(tile, for_imagery=False):
             )
             return 0
 
-    #################################
-    def build_mask(til_x, til_y):
+    # Mask tiles whose inputs did not change since the last build are kept,
+    # the other masks of the tile are deleted
+    (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
+        tile.lat + 1, tile.lon, tile.mask_zl)
+    (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
+        tile.lat, tile.lon + 1, tile.mask_zl)
+    hashes = {
+        key: digest
+        for (key, digest) in mask_input_hashes(
+            tile, mesh_list, water_nodes, dico_sea, dico_inland, sea_level
+        ).items()
+        if til_x_min <= key[0] <= til_x_max and til_y_min <= key[1] <= til_y_max
+    }
+    old_manifest = read_masks_manifest(dest_dir)
+    manifest = {
+        key: old_manifest[key]
+        for key in hashes
+        if key in old_manifest
+        and old_manifest[key]["hash"] == hashes[key]
+        and all(
+            os.path.isfile(os.path.join(dest_dir, file_name))
+            for file_name in old_manifest[key]["files"]
+        )
+    }
+    UI.vprint(1, "-> Deleting existing masks")
+    delete_old_masks_in_tile(tile, dest_dir, keep=manifest)
+    write_masks_manifest(dest_dir, manifest)
+    if manifest:
+        UI.vprint(
+            1,
+            "  ",
+            len(manifest),
+            "mask tile(s) out of",
+            len(hashes),
+            "unchanged since the last build, skipped.",
+        )
+    dico_sea = {key: dico_sea[key] for key in hashes if key not in manifest}
+    dico_inland = {key: dico_inland[key] for key in dico_sea 
+                   if key in dico_inland}
 
-        (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
-            tile.lat + 1, tile.lon, tile.mask_zl)
-        (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
-            tile.lat, tile.lon + 1, tile.mask_zl)
-        if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or 
-            til_y > til_y_max):
-            return 1
+    if masks_build_engine == "processes" and masks_build_slots > 1:
+        success = build_masks_in_processes(
+            tile,
+            mesh_list,
+            water_nodes,
+            dico_sea,
+            dico_inland,
+            sea_level,
+            dest_dir,
+        )
+    else:
+        masks_queue = queue.Queue()
+        for (til_x, til_y) in dico_sea:
+            masks_queue.put(
+                (
+                    til_x,
+                    til_y,
+                    tile,
+                    mesh_list,
+                    water_nodes,
+                    dico_sea,
+                    dico_inland,
+                    sea_level,
+                    dest_dir,
+                )
+            )
+        dico_progress = {"done": 0, "bar": 1}
+        success = parallel_execute(build_mask, masks_queue, masks_build_slots,
+                                   progress=dico_progress)
+    if UI.red_flag:
+        UI.exit_message_and_bottom_line()
+        return 0
+    if not success:
+        UI.exit_message_and_bottom_line(
+            "\nERROR: Some masks could not be built."
+        )
+        return 0
+    for key in dico_sea:
+        manifest[key] = {
+            "hash": hashes[key],
+            "files": [
+                file_name
+                for file_name in (
+                    FNAMES.legacy_mask(*key),
+                    FNAMES.distance_mask(*key),
+                )
+                if os.path.isfile(os.path.join(dest_dir, file_name))
+            ],
+        }
+    write_masks_manifest(dest_dir, manifest)
+    UI.progress_bar(1, 100)
+    STATS.write_report(tile, "masks")
+    UI.timings_and_bottom_line(timer)
+    UI.logprint(
+        "Step 2.5 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
+    )
+    return 1
+################################################################################
 
-        pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, dico_sea,
-                                         dico_inland, sea_level, tile) 
-        if tile.masks_use_DEM_too:
-            dem_array = build_dem_pre_mask(til_x, til_y, tile)
-            pre_mask = numpy.maximum(pre_mask, dem_array)
-            del(dem_array)
+################################################################################
+def build_mask(til_x, til_y, tile, mesh_list, water_nodes, dico_sea, 
+               dico_inland, sea_level, dest_dir):
 
-        if tile.masks_custom_extent:
-            custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
+    (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
+        tile.lat + 1, tile.lon, tile.mask_zl)
+    (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
+        tile.lat, tile.lon + 1, tile.mask_zl)
+    if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or 
+        til_y > til_y_max):
+        return 1
 
-        if (pre_mask.max() == 0) and (
-                not tile.masks_custom_extent or custom_array.max() == 0):
-            return 1
-        
-        
-        blured_mask = blur_mask(pre_mask, tile, sea_level)
+    pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, water_nodes,
+                                     dico_sea, dico_inland, sea_level, tile)
+    if tile.masks_use_DEM_too:
+        dem_array = build_dem_pre_mask(til_x, til_y, tile)
+        pre_mask = numpy.maximum(pre_mask, dem_array)
+        del(dem_array)
 
-        # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop 
-        # to final size, and take the max with the possible custom extent mask
-        blured_mask = numpy.maximum(
-            (pre_mask > 0).astype(numpy.uint8) * 255, 
-            blured_mask
-        )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-        
-        if tile.masks_custom_extent:
-            blured_mask = numpy.maximum(blured_mask, custom_mask)
+    if tile.masks_custom_extent:
+        custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
 
-        if not (blured_mask.max() == 0 or blured_mask.min() == 255):
-            mask_im = Image.fromarray(blured_mask)
-            mask_im.save(os.path.join(
-                dest_dir, FNAMES.legacy_mask(til_x, til_y)))
-            del blured_mask
-            
-            # Distance masks for bathymetry cut-off
-            if (tile.distance_masks_too):
-                pre_mask = (pre_mask > 0).astype(float) * 2 - 1
-                band = 255 / 2**(16 - tile.mask_zl)
-                dist_array = skfmm.distance(pre_mask, narrow = band)
-                if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
-                    dist_array = dist_array.filled(-99999)
-                dist_array[pre_mask > 0] = 0
-                del(pre_mask)
-                dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-                dist_array = dist_array * (2**(16 - tile.mask_zl))
-                dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
-                dist_array = dist_array.astype(numpy.uint8)
-                masks_im = Image.fromarray(dist_array)
-                masks_im.save(os.path.join(
-                    dest_dir, FNAMES.distance_mask(til_x, til_y)))
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y),
-                "and", FNAMES.distance_mask(til_x, til_y))
-            else:
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y))
+    if (pre_mask.max() == 0) and (
+            not tile.masks_custom_extent or custom_array.max() == 0):
         return 1
-    #################################
     
-    masks_queue = queue.Queue()
-    for key in dico_sea:
-        masks_queue.put(key)
-    dico_progress = {"done": 0, "bar": 1}
+    
+    blured_mask = blur_mask(pre_mask, tile, sea_level)
 
-    parallel_execute(build_mask, masks_queue, masks_build_slots,
-                     progress=dico_progress)
+    # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop 
+    # to final size, and take the max with the possible custom extent mask
+    blured_mask = numpy.maximum(
+        (pre_mask > 0).astype(numpy.uint8) * 255, 
+        blured_mask
+    )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+    
+    if tile.masks_custom_extent:
+        blured_mask = numpy.maximum(blured_mask, custom_array)
 
-    UI.progress_bar(1, 100)
-    UI.timings_and_bottom_line(timer)
-    UI.logprint(
-        "Step 2.5 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
+    if not (blured_mask.max() == 0 or blured_mask.min() == 255):
+        mask_im = Image.fromarray(blured_mask)
+        mask_im.save(os.path.join(
+            dest_dir, FNAMES.legacy_mask(til_x, til_y)))
+        STATS.count_file(os.path.join(
+            dest_dir, FNAMES.legacy_mask(til_x, til_y)))
+        del blured_mask
+        
+        # Distance masks for bathymetry cut-off
+        if (tile.distance_masks_too):
+            pre_mask = (pre_mask > 0).astype(float) * 2 - 1
+            band = 255 / 2**(16 - tile.mask_zl)
+            dist_array = skfmm.distance(pre_mask, narrow = band)
+            if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
+                dist_array = dist_array.filled(-99999)
+            dist_array[pre_mask > 0] = 0
+            del(pre_mask)
+            dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+            dist_array = dist_array * (2**(16 - tile.mask_zl))
+            dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
+            dist_array = dist_array.astype(numpy.uint8)
+            masks_im = Image.fromarray(dist_array)
+            masks_im.save(os.path.join(
+                dest_dir, FNAMES.distance_mask(til_x, til_y)))
+            STATS.count_file(os.path.join(
+                dest_dir, FNAMES.distance_mask(til_x, til_y)))
+            UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y),
+            "and", FNAMES.distance_mask(til_x, til_y))
+        else:
+            UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y))
+    return 1
+################################################################################
+
+################################################################################
+def build_masks_in_processes(tile, mesh_list, water_nodes, dico_sea, 
+                             dico_inland, sea_level, dest_dir):
+    # Mask tiles are built by a pool of worker processes, which save them
+    # directly. The water triangles and the DEM are not sent to each task
+    # but written once to .npy files in the build dir, which the workers
+    # memory map.
+    # CFG and TILE import this module, hence the late imports.
+    import O4_Config_Utils as CFG
+    import O4_Tile_Utils as TILE
+
+    shared = {
+        "tile": copy.copy(tile),
+        "mesh_list": mesh_list,
+        "sea_level": sea_level,
+        "dest_dir": dest_dir,
+        "files": {},
+        "index": {},
+    }
+    try:
+        file_name = FNAMES.masks_shared_file(tile.build_dir, "nodes")
+        numpy.save(file_name, water_nodes)
+        shared["files"]["nodes"] = file_name
+        for (name, dico) in (("sea", dico_sea), ("inland", dico_inland)):
+            file_name = FNAMES.masks_shared_file(tile.build_dir, name)
+            shared["files"][name] = file_name
+            shared["index"][name] = write_shared_tris(dico, file_name)
+        if tile.masks_use_DEM_too:
+            file_name = FNAMES.masks_shared_file(tile.build_dir, "dem")
+            numpy.save(file_name, tile.dem.alt_dem)
+            shared["files"]["dem"] = file_name
+            shared["tile"].dem = copy.copy(tile.dem)
+            shared["tile"].dem.alt_dem = None
+    except Exception as e:
+        UI.lvprint(0, "ERROR: Could not write the shared mask data :", e)
+        remove_shared_files(shared)
+        return 0
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    UI.vprint(1, "   Using", masks_build_slots, "worker processes.")
+    success = 1
+    done = 0
+    with ProcessPoolExecutor(
+        masks_build_slots,
+        mp_context=context,
+        initializer=TILE.batch_worker_init,
+        initargs=(CFG.app_vars_values(), stop_event),
+    ) as executor:
+        futures = [
+            executor.submit(build_mask_in_worker, til_x, til_y, shared)
+            for (til_x, til_y) in dico_sea
+        ]
+        for future in as_completed(futures):
+            try:
+                (result, stats) = future.result()
+                STATS.merge(stats)
+                success = result and success
+            except Exception as e:
+                UI.lvprint(0, "ERROR: A mask worker failed :", e)
+                success = 0
+            done += 1
+            UI.progress_bar(1, int(100 * done / len(futures)))
+            if UI.red_flag:
+                stop_event.set()
+                executor.shutdown(cancel_futures=True)
+                break
+    remove_shared_files(shared)
+    return success
+################################################################################
+
+################################################################################
+def write_shared_tris(dico, file_name):
+    # All the triangles of dico go to a single (n,3) array, returns the
+    # dict key -> (start, stop) of their rows.
+    index = {}
+    start = 0
+    for (key, tris) in dico.items():
+        index[key] = (start, start + len(tris))
+        start += len(tris)
+    array = numpy.lib.format.open_memmap(
+        file_name, mode="w+", dtype=numpy.int32, shape=(start, 3)
     )
-    return
+    for (key, (start, stop)) in index.items():
+        if stop > start:
+            array[start:stop] = dico[key]
+    array.flush()
+    del array
+    return index
 ################################################################################
-    
+
+################################################################################
+def remove_shared_files(shared):
+    for file_name in shared["files"].values():
+        try:
+            os.remove(file_name)
+        except:
+            pass
+################################################################################
+
+################################################################################
+shared_arrays = {}
+
+
+def shared_array(file_name):
+    # Memory mapped once per worker process and per build.
+    mtime = os.path.getmtime(file_name)
+    if file_name not in shared_arrays or shared_arrays[file_name][0] != mtime:
+        if os.path.getsize(file_name) > 128:
+            array = numpy.load(file_name, mmap_mode="r")
+        else:
+            array = numpy.load(file_name)
+        shared_arrays[file_name] = (mtime, array)
+    return shared_arrays[file_name][1]
+################################################################################
+
+################################################################################
+def build_mask_in_worker(til_x, til_y, shared):
+    # Returns the result of build_mask and the timings of the task.
+    STATS.reset()
+    tile = shared["tile"]
+    if "dem" in shared["files"]:
+        tile.dem.alt_dem = shared_array(shared["files"]["dem"])
+    (dico_sea, dico_inland) = ({}, {})
+    for (name, dico) in (("sea", dico_sea), ("inland", dico_inland)):
+        if (til_x, til_y) in shared["index"][name]:
+            (start, stop) = shared["index"][name][(til_x, til_y)]
+            dico[(til_x, til_y)] = shared_array(shared["files"][name])[
+                start:stop
+            ]
+    result = build_mask(
+        til_x,
+        til_y,
+        tile,
+        shared["mesh_list"],
+        shared_array(shared["files"]["nodes"]),
+        dico_sea,
+        dico_inland,
+        shared["sea_level"],
+        shared["dest_dir"],
+    )
+    return (result, STATS.snapshot())
 ################################################################################
 def select_neighbor_meshes(tile):
     mesh_list = []
@@ -239,7 +487,7 @@ def select_neighbor_meshes(tile):
 ################################################################################
 
 ################################################################################
-def delete_old_masks_in_tile(tile, dest_dir):
+def delete_old_masks_in_tile(tile, dest_dir, keep=()):
 
     (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
         tile.lat + 1, tile.lon, tile.mask_zl)
@@ -248,83 +496,157 @@ def delete_old_masks_in_tile(tile, dest_dir):
 
     for til_x in range(til_x_min, til_x_max + 1, 16):
         for til_y in range(til_y_min, til_y_max + 1, 16):
-            try:
-                os.remove(
-                    os.path.join(dest_dir, FNAMES.legacy_mask(til_x, til_y))
+            if (til_x, til_y) in keep:
+                continue
+            for file_name in (
+                FNAMES.legacy_mask(til_x, til_y),
+                FNAMES.distance_mask(til_x, til_y),
+            ):
+                try:
+                    os.remove(os.path.join(dest_dir, file_name))
+                except:
+                    pass
+################################################################################
+
+################################################################################
+def mask_input_hashes(tile, mesh_list, water_nodes, dico_sea, dico_inland, 
+                      sea_level):
+    # One hash per mask tile of all what its masks depend on : the mask
+    # parameters, the meshes around, the water triangles drawn in it and the
+    # elevation data if used.
+    common = hashlib.sha1()
+    common.update(
+        repr(
+            (
+                masks_manifest_version,
+                sea_level,
+                mask_altitude_above,
+                [getattr(tile, var) for var in mask_input_vars],
+                sorted(os.path.basename(f) for f in mesh_list),
+            )
+        ).encode()
+    )
+    if tile.masks_custom_extent:
+        # the extent is only named in mask_input_vars, its files may change
+        extent_code = tile.masks_custom_extent.lstrip("!")
+        if extent_code in IMG.extents_dict:
+            extent = IMG.extents_dict[extent_code]
+            common.update(repr(sorted(extent.items())).encode())
+            for suffix in (".ext", ".png"):
+                try:
+                    with open(
+                        os.path.join(
+                            FNAMES.Extent_dir,
+                            extent["dir"],
+                            extent["code"] + suffix,
+                        ),
+                        "rb",
+                    ) as f:
+                        common.update(f.read())
+                except:
+                    pass
+                common.update(b"|")
+    if tile.masks_use_DEM_too:
+        common.update(repr((tile.custom_dem, tile.fill_nodata)).encode())
+        common.update(numpy.ascontiguousarray(tile.dem.alt_dem).data)
+    hashes = {}
+    for key in dico_sea:
+        digest = common.copy()
+        for dico in (dico_sea, dico_inland):
+            if key in dico:
+                digest.update(
+                    numpy.ascontiguousarray(water_nodes[dico[key]]).data
                 )
-            except:
-                pass
+            digest.update(b"|")
+        hashes[key] = digest.hexdigest()
+    return hashes
+################################################################################
+
+################################################################################
+def read_masks_manifest(dest_dir):
+    # dict (til_x, til_y) -> {"hash": ..., "files": [...]} of the last build.
+    try:
+        with open(FNAMES.masks_manifest(dest_dir), "r") as f:
+            manifest = json.load(f)
+        return {
+            tuple(int(x) for x in key.split("_")): entry
+            for (key, entry) in manifest["masks"].items()
+        }
+    except:
+        return {}
+################################################################################
+
+################################################################################
+def write_masks_manifest(dest_dir, manifest):
+    file_name = FNAMES.masks_manifest(dest_dir)
+    try:
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "masks": {
+                        str(til_x) + "_" + str(til_y): entry
+                        for ((til_x, til_y), entry) in sorted(manifest.items())
+                    }
+                },
+                f,
+                indent=1,
+            )
+        os.replace(file_name + ".tmp", file_name)
+    except Exception as e:
+        UI.vprint(1, "   WARNING: Could not write the masks manifest", file_name)
+        UI.vprint(3, e)
+        return 0
+    return 1
 ################################################################################
     
 ################################################################################
-def build_water_pre_mask(til_x, til_y, mesh_list, dico_sea, dico_inland,
-                         sea_level, tile):
+@STATS.timed("water_pre_mask")
+def build_water_pre_mask(til_x, til_y, mesh_list, water_nodes, dico_sea, 
+                         dico_inland, sea_level, tile):
     (latm0, lonm0) = GEO.gtile_to_wgs84(til_x, til_y, tile.mask_zl)
     (px0, py0) = GEO.wgs84_to_pix(latm0, lonm0, tile.mask_zl)
     px0 -= 1024
     py0 -= 1024
+    shape = (4096 + 2 * 1024, 4096 + 2 * 1024)
+
+    def pixel_tris(tris):
+        # (n,3) indices of water_nodes -> (n,3,2) pixel coordinates
+        latlon = water_nodes[tris]
+        (px, py) = GEO.wgs84_to_pix_vec(
+            latlon[:, :, 0], latlon[:, :, 1], tile.mask_zl
+        )
+        return numpy.stack((px - px0, py - py0), axis=2)
+
     # 1) We start with a black mask
-    mask_im = Image.new("L", (4096 + 2 * 1024, 4096 + 2 * 1024), "black")
-    mask_draw = ImageDraw.Draw(mask_im)
+    img_array = numpy.zeros(shape, dtype=numpy.uint8)
     # 2) We fill it with white over the extent of each tile around for 
-    # which we had a mesh available
+    # which we had a mesh available (a rectangle in pixel coordinates)
     for mesh_file_name in mesh_list:
         latlonstr = mesh_file_name.split(".mes")[-2][-7:]
         lathere = int(latlonstr[0:3])
         lonhere = int(latlonstr[3:7])
         (px1, py1) = GEO.wgs84_to_pix(lathere, lonhere, tile.mask_zl)
-        (px2, py2) = GEO.wgs84_to_pix(lathere, lonhere + 1, tile.mask_zl)
-        (px3, py3) = GEO.wgs84_to_pix(
-            lathere + 1, lonhere + 1, tile.mask_zl
-        )
-        (px4, py4) = GEO.wgs84_to_pix(lathere + 1, lonhere, tile.mask_zl)
-        px1 -= px0
-        px2 -= px0
-        px3 -= px0
-        px4 -= px0
-        py1 -= py0
-        py2 -= py0
-        py3 -= py0
-        py4 -= py0
-        mask_draw.polygon(
-            [(px1, py1), (px2, py2), (px3, py3), (px4, py4)], fill="white"
-        )
+        (px3, py3) = GEO.wgs84_to_pix(lathere + 1, lonhere + 1, tile.mask_zl)
+        img_array[
+            max(py3 - py0, 0) : max(py1 - py0 + 1, 0),
+            max(px1 - px0, 0) : max(px3 - px0 + 1, 0),
+        ] = 255
     # 3a)  We overwrite the white part of the mask with grey (ratio_water 
     # dependent) where inland water was detected in the first part above
-    if (til_x, til_y) in dico_inland:
-        for (lat1, lon1, lat2, lon2, lat3, lon3) in dico_inland[
-            (til_x, til_y)
-        ]:
-            (px1, py1) = GEO.wgs84_to_pix(lat1, lon1, tile.mask_zl)
-            (px2, py2) = GEO.wgs84_to_pix(lat2, lon2, tile.mask_zl)
-            (px3, py3) = GEO.wgs84_to_pix(lat3, lon3, tile.mask_zl)
-            px1 -= px0
-            px2 -= px0
-            px3 -= px0
-            py1 -= py0
-            py2 -= py0
-            py3 -= py0
-            mask_draw.polygon(
-                [(px1, py1), (px2, py2), (px3, py3)], fill=sea_level
-            )  # int(255*(1-tile.ratio_water)))
+    if len(dico_inland.get((til_x, til_y), ())):
+        img_array[
+            RASTER.triangles_coverage(
+                pixel_tris(dico_inland[(til_x, til_y)]), shape
+            )
+        ] = sea_level  # int(255*(1-tile.ratio_water)))
     # 3b) We overwrite the white + grey part of the mask with black where 
     # sea water was detected in the first part above
-    for (lat1, lon1, lat2, lon2, lat3, lon3) in dico_sea[(til_x, til_y)]:
-        (px1, py1) = GEO.wgs84_to_pix(lat1, lon1, tile.mask_zl)
-        (px2, py2) = GEO.wgs84_to_pix(lat2, lon2, tile.mask_zl)
-        (px3, py3) = GEO.wgs84_to_pix(lat3, lon3, tile.mask_zl)
-        px1 -= px0
-        px2 -= px0
-        px3 -= px0
-        py1 -= py0
-        py2 -= py0
-        py3 -= py0
-        mask_draw.polygon(
-            [(px1, py1), (px2, py2), (px3, py3)], fill="black"
-        )
-    del mask_draw
-    # mask_im=mask_im.convert("L")
-    img_array = numpy.array(mask_im, dtype=numpy.uint8)
+    if len(dico_sea[(til_x, til_y)]):
+        img_array[
+            RASTER.triangles_coverage(
+                pixel_tris(dico_sea[(til_x, til_y)]), shape
+            )
+        ] = 0
     return img_array
 ################################################################################
 
@@ -391,260 +713,128 @@ def build_custom_pre_mask(til_x, til_y, sea_level, tile):
 ################################################################################
 
 ################################################################################
+@STATS.timed("read_mesh")
 def record_water_tris(tile):
-    mesh_list = []
-    for close_lat in range(tile.lat - 1, tile.lat + 2):
-        for close_lon in range(tile.lon - 1, tile.lon + 2):
-            close_build_dir = (
-                tile.build_dir
-                if tile.grouped
-                else tile.build_dir.replace(
-                    FNAMES.tile_dir(tile.lat, tile.lon),
-                    FNAMES.tile_dir(close_lat, close_lon),
-                )
-            )
-            close_mesh_file_name = FNAMES.mesh_file(
-                close_build_dir, close_lat, close_lon
-            )
-            if os.path.isfile(close_mesh_file_name):
-                mesh_list.append(close_mesh_file_name)
-    ####################
-    dico_sea = {}
-    dico_inland = {}
-    ####################
+    # Returns water_nodes, a (n,2) array of the (lat, lon) of the nodes of
+    # water triangles in the meshes around, and the dicts dico_sea and
+    # dico_inland which map the mask tiles (til_x, til_y) to the (m,3) arrays
+    # of node indices of the triangles to draw in them. Sea triangles go to
+    # the mask tile of their barycenter and to its neighbours when close to
+    # them, inland ones (if not masked themselves) only to the mask tile of
+    # their barycenter and if it already has some sea.
     [til_x_min, til_y_min] = GEO.wgs84_to_orthogrid(
         tile.lat + 1, tile.lon, tile.mask_zl
     )
     [til_x_max, til_y_max] = GEO.wgs84_to_orthogrid(
         tile.lat, tile.lon + 1, tile.mask_zl
     )
-    UI.vprint(1, "-> Deleting existing masks")
-    for til_x in range(til_x_min, til_x_max + 1, 16):
-        for til_y in range(til_y_min, til_y_max + 1, 16):
-            try:
-                os.remove(
-                    os.path.join(dest_dir, FNAMES.legacy_mask(til_x, til_y))
-                )
-            except:
-                pass
-    UI.vprint(1, "-> Reading mesh data")
-    for mesh_file_name in mesh_list:
+    # Mask tiles around are numbered by code = kx * ny + ky
+    (x_base, y_base) = (til_x_min - 32, til_y_min - 32)
+    ny = (til_y_max - til_y_min) // 16 + 5
+    nx = (til_x_max - til_x_min) // 16 + 5
+    has_sea = numpy.zeros(nx * ny, dtype=bool)
+    water_nodes = []
+    nbr_nodes = 0
+    (sea_codes, sea_tris, inland_codes, inland_tris) = ([], [], [], [])
+    mesh_list = select_neighbor_meshes(tile)
+    for (count, mesh_file_name) in enumerate(mesh_list):
+        if UI.red_flag:
+            return (None, None, None)
         try:
-            f_mesh = open(mesh_file_name, "r")
+            (mesh_version, _, node_coords, _, tri_idx, tri_types) = (
+                MESH.read_mesh_file(mesh_file_name)
+            )
             UI.vprint(1, "   * ", mesh_file_name)
         except:
             UI.lvprint(
                 1, "Mesh file ", mesh_file_name, " could not be read. Skipped."
             )
             continue
-        mesh_version = float(f_mesh.readline().strip().split()[-1])
         has_water = 7 if mesh_version >= 1.3 else 3
-        for i in range(3):
-            f_mesh.readline()
-        nbr_pt_in = int(f_mesh.readline())
-        pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i : 5 * i + 3] = [
-                float(x) for x in f_mesh.readline().split()[:3]
-            ]
-        for i in range(0, 3):
-            f_mesh.readline()
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i + 3 : 5 * i + 5] = [
-                float(x) for x in f_mesh.readline().split()[:2]
-            ]
-        for i in range(0, 2):  # skip 2 lines
-            f_mesh.readline()
-        nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
-        step_stones = nbr_tri_in // 100
-        percent = -1
-        UI.vprint(
-            2,
-            " Attribution process of masks buffers to water triangles for "
-            + str(mesh_file_name)
-            + ".",
+        water = numpy.asarray(tri_types) & has_water
+        sea = (water >= 2) | ((water == 1) & bool(tile.use_masks_for_inland))
+        inland = (water == 1) & (not tile.use_masks_for_inland)
+        keep = sea | inland
+        (sea, inland) = (sea[keep], inland[keep])
+        # The nodes of these triangles only, renumbered after those of the
+        # previous meshes
+        (nodes, tris) = numpy.unique(
+            numpy.asarray(tri_idx).reshape(-1, 3)[keep], return_inverse=True
         )
-        for i in range(0, nbr_tri_in):
-            if i % step_stones == 0:
-                percent += 1
-                UI.progress_bar(1, int(percent * 5 / 10))
-                if UI.red_flag:
-                    UI.exit_message_and_bottom_line()
-                    return 0
-            (n1, n2, n3, tri_type) = [
-                int(x) - 1 for x in f_mesh.readline().split()[:4]
-            ]
-            tri_type += 1
-            if (
-                (not tri_type)
-                or (not (tri_type & has_water))
-                or (
-                    (tri_type & has_water) < 2 and not tile.use_masks_for_inland
-                )
-            ):
-                continue
-            (lon1, lat1) = pt_in[5 * n1 : 5 * n1 + 2]
-            (lon2, lat2) = pt_in[5 * n2 : 5 * n2 + 2]
-            (lon3, lat3) = pt_in[5 * n3 : 5 * n3 + 2]
-            bary_lat = (lat1 + lat2 + lat3) / 3
-            bary_lon = (lon1 + lon2 + lon3) / 3
-            (til_x, til_y) = GEO.wgs84_to_orthogrid(
-                bary_lat, bary_lon, tile.mask_zl
-            )
-            if (
-                til_x < til_x_min - 16
-                or til_x > til_x_max + 16
-                or til_y < til_y_min - 16
-                or til_y > til_y_max + 16
-            ):
-                continue
-            (til_x2, til_y2) = GEO.wgs84_to_orthogrid(
-                bary_lat, bary_lon, tile.mask_zl + 2
-            )
-            a = (til_x2 // 16) % 4
-            b = (til_y2 // 16) % 4
-            if (til_x, til_y) in dico_sea:
-                dico_sea[(til_x, til_y)].append(
-                    (lat1, lon1, lat2, lon2, lat3, lon3)
-                )
-            else:
-                dico_sea[(til_x, til_y)] = [
-                    (lat1, lon1, lat2, lon2, lat3, lon3)
-                ]
-            if a == 0:
-                if (til_x - 16, til_y) in dico_sea:
-                    dico_sea[(til_x - 16, til_y)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x - 16, til_y)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-                if b == 0:
-                    if (til_x - 16, til_y - 16) in dico_sea:
-                        dico_sea[(til_x - 16, til_y - 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x - 16, til_y - 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-                elif b == 3:
-                    if (til_x - 16, til_y + 16) in dico_sea:
-                        dico_sea[(til_x - 16, til_y + 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x - 16, til_y + 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            elif a == 3:
-                if (til_x + 16, til_y) in dico_sea:
-                    dico_sea[(til_x + 16, til_y)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x + 16, til_y)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-                if b == 0:
-                    if (til_x + 16, til_y - 16) in dico_sea:
-                        dico_sea[(til_x + 16, til_y - 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x + 16, til_y - 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-                elif b == 3:
-                    if (til_x + 16, til_y + 16) in dico_sea:
-                        dico_sea[(til_x + 16, til_y + 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x + 16, til_y + 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            if b == 0:
-                if (til_x, til_y - 16) in dico_sea:
-                    dico_sea[(til_x, til_y - 16)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x, til_y - 16)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-            elif b == 3:
-                if (til_x, til_y + 16) in dico_sea:
-                    dico_sea[(til_x, til_y + 16)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x, til_y + 16)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-        f_mesh.close()
-        if not tile.use_masks_for_inland:
-            UI.vprint(2, "   Taking care of inland water near shoreline")
-            f_mesh = open(mesh_file_name, "r")
-            for i in range(0, 4):
-                f_mesh.readline()
-            nbr_pt_in = int(f_mesh.readline())
-            for i in range(0, 2 * nbr_pt_in + 5):
-                f_mesh.readline()
-            nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
-            step_stones = nbr_tri_in // 100
-            percent = -1
-            for i in range(0, nbr_tri_in):
-                if i % step_stones == 0:
-                    percent += 1
-                    UI.progress_bar(1, int(percent * 5 / 10))
-                    if UI.red_flag:
-                        UI.exit_message_and_bottom_line()
-                        return 0
-                (n1, n2, n3, tri_type) = [
-                    int(x) - 1 for x in f_mesh.readline().split()[:4]
-                ]
-                tri_type += 1
-                if not (tri_type & has_water) == 1:
-                    continue
-                (lon1, lat1) = pt_in[5 * n1 : 5 * n1 + 2]
-                (lon2, lat2) = pt_in[5 * n2 : 5 * n2 + 2]
-                (lon3, lat3) = pt_in[5 * n3 : 5 * n3 + 2]
-                bary_lat = (lat1 + lat2 + lat3) / 3
-                bary_lon = (lon1 + lon2 + lon3) / 3
-                (til_x, til_y) = GEO.wgs84_to_orthogrid(
-                    bary_lat, bary_lon, tile.mask_zl
-                )
-                if (
-                    til_x < til_x_min - 16
-                    or til_x > til_x_max + 16
-                    or til_y < til_y_min - 16
-                    or til_y > til_y_max + 16
-                ):
-                    continue
-                (til_x2, til_y2) = GEO.wgs84_to_orthogrid(
-                    bary_lat, bary_lon, tile.mask_zl + 2
+        tris = tris.reshape(-1, 3)
+        node_coords = numpy.asarray(node_coords).reshape(-1, 5)[nodes]
+        lats = node_coords[:, 1][tris]
+        lons = node_coords[:, 0][tris]
+        water_nodes.append(node_coords[:, 1::-1])
+        tris = tris.astype(numpy.int32) + nbr_nodes
+        nbr_nodes += len(nodes)
+        bary_lat = (lats[:, 0] + lats[:, 1] + lats[:, 2]) / 3
+        bary_lon = (lons[:, 0] + lons[:, 1] + lons[:, 2]) / 3
+        (til_x, til_y) = GEO.wgs84_to_orthogrid_vec(
+            bary_lat, bary_lon, tile.mask_zl
+        )
+        inside = (
+            (til_x >= til_x_min - 16)
+            & (til_x <= til_x_max + 16)
+            & (til_y >= til_y_min - 16)
+            & (til_y <= til_y_max + 16)
+        )
+        kx = (til_x - x_base) // 16
+        ky = (til_y - y_base) // 16
+        # Sea triangles close (a quarter of a mask tile) to a side or a
+        # corner also go to the neighbouring mask tiles
+        select = numpy.flatnonzero(sea & inside)
+        (til_x2, til_y2) = GEO.wgs84_to_orthogrid_vec(
+            bary_lat[select], bary_lon[select], tile.mask_zl + 2
+        )
+        a = (til_x2 // 16) % 4
+        b = (til_y2 // 16) % 4
+        (codes, rows) = ([], [])
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                near = numpy.ones(len(select), dtype=bool)
+                if dx:
+                    near &= a == (0 if dx < 0 else 3)
+                if dy:
+                    near &= b == (0 if dy < 0 else 3)
+                codes.append(
+                    (kx[select] + dx)[near] * ny + (ky[select] + dy)[near]
                 )
-                a = (til_x2 // 16) % 4
-                b = (til_y2 // 16) % 4
-                # Here an inland water tri is added ONLY if sea water tri were 
-                # already added for this mask extent
-                if (til_x, til_y) in dico_sea:
-                    if (til_x, til_y) in dico_inland:
-                        dico_inland[(til_x, til_y)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_inland[(til_x, til_y)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            f_mesh.close()
-    
-    return (dico_sea, dico_inland)
+                rows.append(select[near])
+        (codes, rows) = (numpy.concatenate(codes), numpy.concatenate(rows))
+        order = numpy.argsort(rows, kind="stable")
+        (codes, rows) = (codes[order], rows[order])
+        has_sea[codes] = True
+        sea_codes.append(codes)
+        sea_tris.append(tris[rows])
+        select = numpy.flatnonzero(inland & inside)
+        codes = kx[select] * ny + ky[select]
+        keep = has_sea[codes]
+        inland_codes.append(codes[keep])
+        inland_tris.append(tris[select[keep]])
+        UI.progress_bar(1, int(50 * (count + 1) / len(mesh_list)))
+    if not water_nodes:
+        return (numpy.zeros((0, 2)), {}, {})
+    water_nodes = numpy.concatenate(water_nodes)
+    dicos = []
+    for (codes, tris) in ((sea_codes, sea_tris), (inland_codes, inland_tris)):
+        (codes, tris) = (numpy.concatenate(codes), numpy.concatenate(tris))
+        order = numpy.argsort(codes, kind="stable")
+        (codes, tris) = (codes[order], tris[order])
+        keys = numpy.unique(codes)
+        bounds = numpy.searchsorted(codes, keys, side="right")
+        dico = {}
+        start = 0
+        for (code, stop) in zip(keys.tolist(), bounds.tolist()):
+            (kx, ky) = divmod(code, ny)
+            dico[(x_base + 16 * kx, y_base + 16 * ky)] = tris[start:stop]
+            start = stop
+        dicos.append(dico)
+    return (water_nodes, dicos[0], dicos[1])
 ################################################################################
         
 ################################################################################
+@STATS.timed("mask_blur")
 def blur_mask(img_array, tile, sea_level):
     ##########################################
     def transition_profile(ratio, ttype):
@@ -666,15 +856,7 @@ def blur_mask(img_array, tile, sea_level):
     if tile.masking_mode == "sand" and blur_width:
         # convolution with a hat function
         b_img_array = numpy.array(img_array)
-        kernel = numpy.array(range(1, 2 * blur_width))
-        kernel[blur_width:] = range(blur_width - 1, 0, -1)
-        kernel = kernel / blur_width ** 2
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
+        RASTER.hat_filter(b_img_array, blur_width, out=b_img_array)
         b_img_array = 2 * numpy.minimum(b_img_array, 127)
         b_img_array = numpy.array(b_img_array, dtype=numpy.uint8)
     # Rocks mode
@@ -2,12 +2,14 @@ import time
 import sys
 import os
 import pickle
+import struct
 import subprocess
 import numpy
 import requests
 from math import sqrt, cos, pi
 import O4_DEM_Utils as DEM
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Vector_Utils as VECT
@@ -30,6 +32,8 @@ else:
     sort_mesh_cmd = os.path.join(FNAMES.Utils_dir, "lin", "moulinette ")
     unzip_cmd = "7z "
 
+# Binary files with Triangle4XP when it supports them (see has_binary_io)
+triangle_binary_io = True
 
 community_server = False
 if os.path.exists(os.path.join(FNAMES.Ortho4XP_dir, "community_server.txt")):
@@ -197,8 +201,7 @@ def build_curv_tol_weight_map(tile, weight_array):
                 cached_suffix="coastline",
             ):
                 return 0
-        for nodeid in sea_layer.dicosmn:
-            (lonp, latp) = [float(x) for x in sea_layer.dicosmn[nodeid]]
+        for (lonp, latp) in sea_layer.dicosmn.coords.tolist():
             if (
                 lonp < tile.lon
                 or lonp > tile.lon + 1
@@ -227,101 +230,346 @@ def build_curv_tol_weight_map(tile, weight_array):
 
 
 ################################################################################
+@STATS.timed("node_altitudes")
 def post_process_nodes_altitudes(tile):
     dico_attributes = VECT.Vector_Map.dico_attributes
-    f_node = open(FNAMES.output_node_file(tile), "r")
-    init_line_f_node = f_node.readline()
-    nbr_pt = int(init_line_f_node.split()[0])
-    vertices = numpy.zeros(6 * nbr_pt)
     UI.vprint(1, "-> Loading of the mesh computed by Triangle4XP.")
-    for i in range(0, nbr_pt):
-        vertices[6 * i : 6 * i + 6] = [
-            float(x) for x in f_node.readline().split()[1:7]
-        ]
-    end_line_f_node = f_node.readline()
-    f_node.close()
+    node_file = FNAMES.output_node_file(tile)
+    ele_file = FNAMES.output_ele_file(tile)
+    binary_io = is_binary_triangle_file(node_file)
+    if binary_io:
+        (node_reals, _) = read_binary_triangle_file(node_file, TRI_NODES)
+        vertices = numpy.ascontiguousarray(node_reals[:, :6]).ravel()
+        del node_reals
+    else:
+        (init_line_f_node, node_data, end_line_f_node) = read_triangle_file(
+            node_file, numpy.float64
+        )
+        vertices = numpy.ascontiguousarray(node_data[:, 1:7]).ravel()
+        del node_data
     UI.vprint(1, "-> Post processing of altitudes according to vector data")
-    f_ele = open(FNAMES.output_ele_file(tile), "r")
-    nbr_tri = int(f_ele.readline().split()[0])
-    water_tris = set()
-    sea_tris = set()
-    interp_alt_tris = set()
-    for i in range(nbr_tri):
-        line = f_ele.readline()
-        # triangle attributes are powers of 2, except for the dummy attributed
-        # which doesn't require post-treatment
-        if line[-2] == "0":
-            continue
-        (v1, v2, v3, attr) = [int(x) - 1 for x in line.split()[1:5]]
-        attr += 1
-        if attr >= dico_attributes["INTERP_ALT"]:
-            interp_alt_tris.add((v1, v2, v3))
-        elif attr & dico_attributes["SEA"]:
-            sea_tris.add((v1, v2, v3))
-        elif (
-            attr & dico_attributes["WATER"]
-            or attr & dico_attributes["SEA_EQUIV"]
-        ):
-            water_tris.add((v1, v2, v3))
+    if binary_io:
+        (ele_reals, ele_ints) = read_binary_triangle_file(
+            ele_file, TRI_TRIANGLES
+        )
+        tris = ele_ints[:, :3].astype(numpy.int64) - 1
+        attr = ele_reals[:, 0].astype(numpy.int64)
+        del ele_reals, ele_ints
+    else:
+        (_, ele_data, _) = read_triangle_file(ele_file, numpy.int64)
+        tris = ele_data[:, 1:4] - 1
+        attr = ele_data[:, 4]
+        del ele_data
+    # triangle attributes are powers of 2, except for the dummy attributed
+    # which doesn't require post-treatment (it was told apart by the last
+    # digit of the line, hence so are all multiples of 10)
+    attr[attr % 10 == 0] = 0
+    interp_alt = attr >= dico_attributes["INTERP_ALT"]
+    sea = ~interp_alt & (attr & dico_attributes["SEA"] != 0)
+    water = (
+        ~interp_alt
+        & ~sea
+        & (
+            attr & (dico_attributes["WATER"] | dico_attributes["SEA_EQUIV"])
+            != 0
+        )
+    )
+    (water_tris, sea_tris, interp_alt_tris) = (
+        tris[water],
+        tris[sea],
+        tris[interp_alt],
+    )
+    del tris, attr
+    z = vertices[2::6]
     if tile.water_smoothing:
         UI.vprint(1, "   Smoothing inland water.")
+        water_tris = water_tris[sequential_order(water_tris)]
+        batches = disjoint_batches(water_tris)
         for j in range(tile.water_smoothing):
-            for v1, v2, v3 in water_tris:
-                zmean = (
-                    vertices[6 * v1 + 2]
-                    + vertices[6 * v2 + 2]
-                    + vertices[6 * v3 + 2]
-                ) / 3
-                vertices[6 * v1 + 2] = zmean
-                vertices[6 * v2 + 2] = zmean
-                vertices[6 * v3 + 2] = zmean
+            for batch in batches:
+                level_triangles(z, water_tris[batch])
     UI.vprint(1, "   Smoothing of sea water.")
-    for v1, v2, v3 in sea_tris:
-        if tile.sea_smoothing_mode == "zero":
-            vertices[6 * v1 + 2] = 0
-            vertices[6 * v2 + 2] = 0
-            vertices[6 * v3 + 2] = 0
-        elif tile.sea_smoothing_mode == "mean":
-            zmean = (
-                vertices[6 * v1 + 2]
-                + vertices[6 * v2 + 2]
-                + vertices[6 * v3 + 2]
-            ) / 3
-            vertices[6 * v1 + 2] = zmean
-            vertices[6 * v2 + 2] = zmean
-            vertices[6 * v3 + 2] = zmean
-        else:
-            vertices[6 * v1 + 2] = max(vertices[6 * v1 + 2], 0)
-            vertices[6 * v2 + 2] = max(vertices[6 * v2 + 2], 0)
-            vertices[6 * v3 + 2] = max(vertices[6 * v3 + 2], 0)
+    if tile.sea_smoothing_mode == "zero":
+        z[sea_tris.ravel()] = 0
+    elif tile.sea_smoothing_mode == "mean":
+        sea_tris = sea_tris[sequential_order(sea_tris)]
+        for batch in disjoint_batches(sea_tris):
+            level_triangles(z, sea_tris[batch])
+    else:
+        nodes = sea_tris.ravel()
+        z[nodes] = numpy.maximum(z[nodes], 0)
     UI.vprint(1, "   Treatment of airports, roads and patches.")
-    for v1, v2, v3 in interp_alt_tris:
-        vertices[6 * v1 + 2] = vertices[6 * v1 + 5]
-        vertices[6 * v2 + 2] = vertices[6 * v2 + 5]
-        vertices[6 * v3 + 2] = vertices[6 * v3 + 5]
-        vertices[6 * v1 + 3] = 0
-        vertices[6 * v2 + 3] = 0
-        vertices[6 * v3 + 3] = 0
-        vertices[6 * v1 + 4] = 0
-        vertices[6 * v2 + 4] = 0
-        vertices[6 * v3 + 4] = 0
+    nodes = numpy.unique(interp_alt_tris)
+    vertices.reshape(-1, 6)[nodes, 2] = vertices.reshape(-1, 6)[nodes, 5]
+    vertices.reshape(-1, 6)[nodes, 3:5] = 0
+    if UI.cleaning_level or binary_io:
+        # the nodes file is removed as soon as the mesh file is written, it
+        # is only kept (post-processed) for later iterations of Step 2.
+        return vertices
     UI.vprint(1, "-> Writing output nodes file.")
-    f_node = open(FNAMES.output_node_file(tile), "w")
+    f_node = open(node_file, "w")
     f_node.write(init_line_f_node)
-    for i in range(0, nbr_pt):
-        f_node.write(
-            str(i + 1)
-            + " "
-            + " ".join(
-                ("{:.15f}".format(x) for x in vertices[6 * i : 6 * i + 6])
-            )
-            + "\n"
-        )
+    write_indexed_lines(
+        f_node, "%d" + " %.15f" * 6 + "\n", vertices.reshape(-1, 6)
+    )
     f_node.write(end_line_f_node)
     f_node.close()
     return vertices
 
 
+################################################################################
+def read_triangle_file(file_name, dtype):
+    # .node or .ele file of Triangle4XP : returns the header line, the array
+    # of the items (index included) and the trailing line if any.
+    f = open(file_name, "r")
+    header = f.readline()
+    nbr_lines = int(header.split()[0])
+    blocks = []
+    for i in range(0, nbr_lines, 100000):
+        lines = [f.readline() for _ in range(min(100000, nbr_lines - i))]
+        blocks.append(
+            numpy.fromstring("".join(lines), dtype=dtype, sep=" ").reshape(
+                len(lines), -1
+            )
+        )
+    footer = f.readline()
+    f.close()
+    data = numpy.concatenate(blocks) if blocks else numpy.zeros((0, 7), dtype)
+    return (header, data, footer)
+
+
+################################################################################
+def write_indexed_lines(f, line_format, data):
+    # One line per row of data, preceded by its index (from 1) as in the text
+    # files of Triangle4XP, formatted by blocks rather than line by line.
+    for i in range(0, len(data), 100000):
+        block = data[i : i + 100000]
+        rows = numpy.column_stack(
+            (numpy.arange(i + 1, i + 1 + len(block)), block)
+        )
+        f.write((line_format * len(block)) % tuple(rows.ravel().tolist()))
+
+
+##############################################################################
+# Binary files of Triangle4XP (-b switch) : a sequence of sections, each one a
+# 32 bytes header (magic, format, kind of items, number of items, number of
+# float64 and of int32 columns) followed by one packed little endian row per
+# item, its float64 columns first. A .node file is a TRI_NODES section, an
+# .ele file a TRI_TRIANGLES one, and a .poly file the TRI_SEGMENTS, TRI_HOLES
+# and TRI_REGIONS sections (its nodes come from the .node file). Items are
+# numbered from 1 as in the text files, which remain the fallback for
+# Triangle4XP builds without the -b switch.
+##############################################################################
+triangle_binary_magic = b"O4XPTRIB"
+triangle_binary_format = 1
+triangle_binary_header = struct.Struct("<8sIIQII")
+(TRI_NODES, TRI_TRIANGLES, TRI_SEGMENTS, TRI_HOLES, TRI_REGIONS) = range(1, 6)
+binary_io_support = {}
+
+
+##############################################################################
+def has_binary_io():
+    # The usage message of Triangle4XP lists the -b switch when it has it.
+    cmd = Triangle4XP_cmd.strip()
+    if cmd not in binary_io_support:
+        try:
+            usage = subprocess.run(
+                [cmd],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=30,
+            ).stdout
+            binary_io_support[cmd] = b"-b  Binary" in usage
+        except:
+            binary_io_support[cmd] = False
+    return binary_io_support[cmd]
+
+
+##############################################################################
+def use_binary_io(tile):
+    # Iterations of Step 2 refine the text files of the previous one, and
+    # those are only kept with cleaning_level = 0.
+    return bool(
+        triangle_binary_io
+        and UI.cleaning_level
+        and not tile.iterate
+        and has_binary_io()
+    )
+
+
+##############################################################################
+def is_binary_triangle_file(file_name):
+    try:
+        f = open(file_name, "rb")
+        magic = f.read(len(triangle_binary_magic))
+        f.close()
+    except:
+        return False
+    return magic == triangle_binary_magic
+
+
+##############################################################################
+def write_triangle_section(f, kind, reals, ints):
+    # reals and ints are 2D arrays with the same number of rows, either of
+    # them can have no column.
+    rows = numpy.empty(
+        len(reals),
+        dtype=[
+            ("reals", "<f8", (reals.shape[1],)),
+            ("ints", "<i4", (ints.shape[1],)),
+        ],
+    )
+    rows["reals"] = reals
+    rows["ints"] = ints
+    f.write(
+        triangle_binary_header.pack(
+            triangle_binary_magic,
+            triangle_binary_format,
+            kind,
+            len(rows),
+            reals.shape[1],
+            ints.shape[1],
+        )
+    )
+    f.write(rows.tobytes())
+
+
+##############################################################################
+def read_triangle_section(f, kind):
+    (magic, file_format, file_kind, count, real_cols, int_cols) = (
+        triangle_binary_header.unpack(f.read(triangle_binary_header.size))
+    )
+    if (magic, file_format, file_kind) != (
+        triangle_binary_magic,
+        triangle_binary_format,
+        kind,
+    ):
+        raise Exception("Unexpected section in binary Triangle4XP file.")
+    dtype = numpy.dtype(
+        [("reals", "<f8", (real_cols,)), ("ints", "<i4", (int_cols,))]
+    )
+    rows = numpy.frombuffer(
+        bytearray(f.read(count * dtype.itemsize)), dtype=dtype
+    )
+    if len(rows) != count:
+        raise Exception("Truncated binary Triangle4XP file.")
+    return (rows["reals"], rows["ints"])
+
+
+##############################################################################
+def read_binary_triangle_file(file_name, kind):
+    f = open(file_name, "rb")
+    (reals, ints) = read_triangle_section(f, kind)
+    f.close()
+    return (reals, ints)
+
+
+##############################################################################
+def write_binary_node_file(node_file, nodes):
+    f = open(node_file, "wb")
+    write_triangle_section(f, TRI_NODES, nodes, numpy.zeros((len(nodes), 0)))
+    f.close()
+
+
+##############################################################################
+def write_binary_poly_file(poly_file, segments, holes, regions):
+    f = open(poly_file, "wb")
+    write_triangle_section(
+        f, TRI_SEGMENTS, numpy.zeros((len(segments), 0)), segments
+    )
+    write_triangle_section(f, TRI_HOLES, holes, numpy.zeros((len(holes), 0)))
+    write_triangle_section(
+        f, TRI_REGIONS, regions, numpy.zeros((len(regions), 0))
+    )
+    f.close()
+
+
+##############################################################################
+def read_binary_poly_file(poly_file):
+    f = open(poly_file, "rb")
+    (_, segments) = read_triangle_section(f, TRI_SEGMENTS)
+    (holes, _) = read_triangle_section(f, TRI_HOLES)
+    (regions, _) = read_triangle_section(f, TRI_REGIONS)
+    f.close()
+    return (segments, holes, regions)
+
+
+##############################################################################
+def convert_binary_input_files(node_file, poly_file):
+    # Text version (as written by the Vector_Map) of binary Step 1 files.
+    (nodes, _) = read_binary_triangle_file(node_file, TRI_NODES)
+    (segments, holes, regions) = read_binary_poly_file(poly_file)
+    f = open(node_file, "w")
+    f.write(str(len(nodes)) + " 2 " + str(nodes.shape[1] - 2) + " 0\n")
+    write_indexed_lines(f, "%d" + " %.9f" * nodes.shape[1] + "\n", nodes)
+    f.close()
+    f = open(poly_file, "w")
+    f.write("0 2 1 0\n\n")
+    f.write(str(len(segments)) + " 1\n")
+    write_indexed_lines(f, "%d %d %d %d\n", segments)
+    f.write("\n" + str(len(holes)) + "\n")
+    write_indexed_lines(f, "%d %.15f %.15f\n", holes)
+    f.write("\n" + str(len(regions)) + "\n")
+    write_indexed_lines(f, "%d %.15f %.15f %d\n", regions)
+    f.close()
+
+
+################################################################################
+def sequential_order(tris):
+    # Indices of the distinct triangles in the order in which the former
+    # sequential code levelled them : that of a set of vertex tuples, which
+    # is deterministic since int tuples hash the same in every run.
+    # (the set is built one tuple at a time as then, its layout and thus its
+    # order depend on it)
+    tuples = list(map(tuple, tris.tolist()))
+    first = {}
+    for (i, tri) in enumerate(tuples):
+        first.setdefault(tri, i)
+    return numpy.array([first[tri] for tri in set(tuples)], dtype=numpy.int64)
+
+
+################################################################################
+def disjoint_batches(tris):
+    # Splits the triangles in batches without common vertex, so that levelling
+    # the batches one after the other, each one at once, is the same as
+    # levelling the triangles one at a time in their order : the batch of a
+    # triangle comes right after the last batch of the earlier triangles
+    # sharing a vertex with it (a wavefront schedule).
+    if not len(tris):
+        return []
+    # the earlier triangle of each (vertex, triangle) incidence, if any
+    incidences = numpy.argsort(tris.ravel(), kind="stable")
+    vertex = tris.ravel()[incidences]
+    succ = incidences[1:][vertex[1:] == vertex[:-1]] // 3
+    pred = incidences[:-1][vertex[1:] == vertex[:-1]] // 3
+    (pred, succ) = (pred[pred != succ], succ[pred != succ])
+    # by rounds of those whose earlier triangles are all batched
+    order = numpy.argsort(pred, kind="stable")
+    (pred, succ) = (pred[order], succ[order])
+    starts = numpy.searchsorted(pred, numpy.arange(len(tris) + 1))
+    waiting = numpy.bincount(succ, minlength=len(tris))
+    batches = []
+    batch = numpy.flatnonzero(waiting == 0)
+    while len(batch):
+        batches.append(batch)
+        counts = starts[batch + 1] - starts[batch]
+        shifts = numpy.repeat(
+            starts[batch] + counts - numpy.cumsum(counts), counts
+        )
+        targets = succ[shifts + numpy.arange(len(shifts))]
+        waiting -= numpy.bincount(targets, minlength=len(tris))
+        targets = numpy.unique(targets)
+        batch = targets[waiting[targets] == 0]
+    return batches
+
+
+################################################################################
+def level_triangles(z, tris):
+    # Sets the vertices of each triangle (without common vertex) to their mean.
+    zmean = (z[tris[:, 0]] + z[tris[:, 1]] + z[tris[:, 2]]) / 3
+    z[tris] = zmean[:, None]
+
+
 ################################################################################
 def write_mesh_file(tile, vertices):
     UI.vprint(
@@ -329,9 +577,17 @@ def write_mesh_file(tile, vertices):
         "-> Writing final mesh to the file "
         + FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon),
     )
-    f_ele = open(FNAMES.output_ele_file(tile), "r")
+    ele_file = FNAMES.output_ele_file(tile)
+    binary_io = is_binary_triangle_file(ele_file)
+    if binary_io:
+        (ele_reals, ele_ints) = read_binary_triangle_file(
+            ele_file, TRI_TRIANGLES
+        )
+        nbr_tri = len(ele_ints)
+    else:
+        f_ele = open(ele_file, "r")
+        nbr_tri = int(f_ele.readline().split()[0])
     nbr_vert = len(vertices) // 6
-    nbr_tri = int(f_ele.readline().split()[0])
     f = open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon), "w")
     f.write("MeshVersionFormatted 2\n")
     f.write("Dimension 3\n\n")
@@ -359,10 +615,43 @@ def write_mesh_file(tile, vertices):
     f.write("\n")
     f.write("Triangles\n")
     f.write(str(nbr_tri) + "\n")
-    for i in range(0, nbr_tri):
-        f.write(" ".join(f_ele.readline().split()[1:]) + "\n")
-    f_ele.close()
+    tri_data = numpy.zeros((nbr_tri, 4), dtype=numpy.uint32)
+    if binary_io:
+        tri_data[:, :3] = ele_ints[:, :3]
+        tri_data[:, 3] = ele_reals[:, 0]
+        del ele_reals, ele_ints
+        for i in range(0, nbr_tri, 100000):
+            block = tri_data[i : i + 100000]
+            f.write(
+                ("%d %d %d %d\n" * len(block)) % tuple(block.ravel().tolist())
+            )
+    else:
+        for i in range(0, nbr_tri, 100000):
+            lines = [
+                " ".join(f_ele.readline().split()[1:]) + "\n"
+                for _ in range(min(100000, nbr_tri - i))
+            ]
+            f.write("".join(lines))
+            tri_data[i : i + len(lines)] = numpy.fromstring(
+                "".join(lines), dtype=numpy.int64, sep=" "
+            ).reshape(len(lines), -1)[:, :4]
+        f_ele.close()
     f.close()
+    STATS.count_file(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon))
+    # Binary companion of the text mesh, this is what Ortho4XP reads back
+    node_coords = numpy.zeros((nbr_vert, 5))
+    node_coords[:, 0] = vertices[0::6] + tile.lon
+    node_coords[:, 1] = vertices[1::6] + tile.lat
+    node_coords[:, 2] = vertices[2::6]
+    node_coords[:, 3] = numpy.round(vertices[3::6], 2)
+    node_coords[:, 4] = numpy.round(vertices[4::6], 2)
+    write_binary_mesh_file(
+        FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon),
+        2,
+        node_coords,
+        tri_data[:, :3] - 1,
+        tri_data[:, 3],
+    )
     return
 
 
@@ -384,29 +673,11 @@ def extract_mesh_to_obj(
     mtl_file_name = FNAMES.mtl_file(
         til_x_left, til_y_top, zoomlevel, provider_code
     )
-    f_mesh = open(mesh_file, "r")
-    for i in range(4):
-        f_mesh.readline()
-    nbr_pt_in = int(f_mesh.readline())
-    UI.vprint(1, "    Reading nodes...")
-    pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-    for i in range(nbr_pt_in):
-        pt_in[5 * i : 5 * i + 3] = [
-            float(x) for x in f_mesh.readline().split()[:3]
-        ]
-    for i in range(3):
-        f_mesh.readline()
-    for i in range(nbr_pt_in):
-        pt_in[5 * i + 3 : 5 * i + 5] = [
-            float(x) for x in f_mesh.readline().split()[:2]
-        ]
-    for i in range(0, 2):  # skip 2 lines
-        f_mesh.readline()
+    UI.vprint(1, "    Reading mesh...")
+    (_, _, pt_in, nbr_tri_in, tri_idx, _) = read_mesh_file(mesh_file)
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
-    UI.vprint(1, "    Reading triangles...")
-    nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
     textured_nodes = {}
     textured_nodes_inv = {}
     nodes_st_coord = {}
@@ -414,7 +685,7 @@ def extract_mesh_to_obj(
     dico_new_tri = {}
     len_dico_new_tri = 0
     for i in range(0, nbr_tri_in):
-        (n1, n2, n3) = [int(x) - 1 for x in f_mesh.readline().split()[:3]]
+        (n1, n2, n3) = tri_idx[3 * i : 3 * i + 3].tolist()
         (lon1, lat1, z1, u1, v1) = pt_in[5 * n1 : 5 * n1 + 5]
         (lon2, lat2, z2, u2, v2) = pt_in[5 * n2 : 5 * n2 + 5]
         (lon3, lat3, z3, u3, v3) = pt_in[5 * n3 : 5 * n3 + 5]
@@ -468,7 +739,7 @@ def extract_mesh_to_obj(
             + " "
             + "{:.9f}".format(pt_in[5 * j + 1] - latmin)
             + " "
-            + "{:.9f}".format(pt_in[5 * j + 2])
+            + "{:.9f}".format(pt_in[5 * j + 2] / 100000)
             + "\n"
         )
     f.write("\n")
@@ -520,7 +791,6 @@ def extract_mesh_to_obj(
             + str(three)
             + "\n"
         )
-    f_mesh.close()
     f.close()
     # then the mtl file
     f = open(mtl_file_name, "w")
@@ -542,6 +812,7 @@ def build_mesh(tile):
         return 0
     UI.is_working = 1
     UI.red_flag = False
+    STATS.reset()
     VECT.scalx = cos((tile.lat + 0.5) * pi / 180)
     UI.logprint(
         "Step 2 for tile lat=", tile.lat, ", lon=", tile.lon, ": starting."
@@ -625,9 +896,20 @@ def build_mesh(tile):
                 "check your custom_dem entry.",
             )
             return 0
+    binary_io = is_binary_triangle_file(node_file)
     try:
-        f = open(node_file, "r")
-        input_nodes = int(f.readline().split()[0])
+        if binary_io and not use_binary_io(tile):
+            UI.vprint(1, "-> Converting the binary input files to text.")
+            convert_binary_input_files(node_file, poly_file)
+            binary_io = False
+        if binary_io:
+            f = open(node_file, "rb")
+            input_nodes = triangle_binary_header.unpack(
+                f.read(triangle_binary_header.size)
+            )[3]
+        else:
+            f = open(node_file, "r")
+            input_nodes = int(f.readline().split()[0])
         f.close()
     except:
         UI.exit_message_and_bottom_line("\nERROR: In reading ", node_file)
@@ -637,6 +919,7 @@ def build_mesh(tile):
     tri_verbosity = "Q" if UI.verbosity <= 1 else "V"
     output_poly = "P" if UI.cleaning_level else ""
     do_refine = "r" if tile.iterate else "A"
+    binary_switch = "b" if binary_io else ""
     try:
         max_tris = float(tile.limit_tris) * 1e6
     except:
@@ -650,7 +933,7 @@ def build_mesh(tile):
     limit_tris = "S" + str(max_steiner)
     Tri_option = (
         "-pq" + "{:.9g}".format(tile.min_angle) + do_refine + 
-        "uYB" + tri_verbosity + output_poly + limit_tris
+        "uYB" + binary_switch + tri_verbosity + output_poly + limit_tris
     )
 
     weight_array = numpy.ones((1001, 1001), dtype=numpy.float32)
@@ -686,6 +969,7 @@ def build_mesh(tile):
     tile.dem = None
     UI.vprint(1, "-> Start of the mesh algorithm Triangle4XP.")
     UI.vprint(2, "   Mesh command:", " ".join(mesh_cmd))
+    triangle_start = time.time()
     fingers_crossed = subprocess.Popen(
         mesh_cmd, stdout=subprocess.PIPE, bufsize=0
     )
@@ -734,6 +1018,7 @@ def build_mesh(tile):
                 ".\n",
             )
             return 0
+    STATS.record("triangle4xp", time.time() - triangle_start)
 
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
@@ -774,6 +1059,7 @@ def build_mesh(tile):
         except:
             pass
 
+    STATS.write_report(tile, "mesh")
     UI.timings_and_bottom_line(timer)
     UI.logprint(
         "Step 2 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
@@ -844,8 +1130,118 @@ def triangulate(name, path_to_Ortho4XP_dir):
 
 
 ##############################################################################
-def read_mesh_file(mesh_file):
+# Binary meshes (.bmesh) : a 64 bytes header followed by the raw little endian
+# arrays of read_mesh_file, node_coords (float64, 5 per node, altitude in
+# meters), tri_idx (uint32, 3 per tri, 0-based) and tri_types (uint32). The 
+# size and mtime of the text mesh it derives from are recorded in order to 
+# detect a text mesh which was modified (or downloaded) since.
+##############################################################################
+binary_mesh_magic = b"O4XPMESH"
+binary_mesh_format = 1
+binary_mesh_header = struct.Struct("<8sI4xdQQQq8x")
+
+
+##############################################################################
+def write_binary_mesh_file(mesh_file, mesh_version, node_coords, tri_idx,
+                           tri_types):
+    bmesh_file = FNAMES.binary_mesh_file(mesh_file)
+    try:
+        text_stat = os.stat(mesh_file)
+        (text_size, text_mtime) = (text_stat.st_size, text_stat.st_mtime_ns)
+    except:
+        (text_size, text_mtime) = (0, 0)
+    node_coords = numpy.ascontiguousarray(node_coords, dtype="<f8")
+    tri_idx = numpy.ascontiguousarray(tri_idx, dtype="<u4")
+    tri_types = numpy.ascontiguousarray(tri_types, dtype="<u4")
+    try:
+        f = open(bmesh_file + ".tmp", "wb")
+        f.write(
+            binary_mesh_header.pack(
+                binary_mesh_magic,
+                binary_mesh_format,
+                mesh_version,
+                node_coords.size // 5,
+                tri_types.size,
+                text_size,
+                text_mtime,
+            )
+        )
+        f.write(node_coords.tobytes())
+        f.write(tri_idx.tobytes())
+        f.write(tri_types.tobytes())
+        f.close()
+        os.replace(bmesh_file + ".tmp", bmesh_file)
+    except Exception as e:
+        UI.vprint(1, "    Could not write binary mesh file", bmesh_file)
+        UI.vprint(2, e)
+        return 0
+    return 1
+
+
+##############################################################################
+def read_binary_mesh_header(bmesh_file):
+    f = open(bmesh_file, "rb")
+    header = binary_mesh_header.unpack(f.read(binary_mesh_header.size))
+    f.close()
+    if header[0] != binary_mesh_magic or header[1] != binary_mesh_format:
+        raise Exception("Not a binary mesh file (or unknown version).")
+    return header[2:]
+
+
+##############################################################################
+def read_binary_mesh_file(bmesh_file, mode="c"):
+    # Arrays are memory maps, the default copy-on-write mode lets callers 
+    # modify them without ever touching the file.
+    (mesh_version, nbr_nodes, nbr_tris, _, _) = read_binary_mesh_header(
+        bmesh_file
+    )
+    offset = binary_mesh_header.size
+    node_coords = numpy.memmap(
+        bmesh_file, dtype="<f8", mode=mode, offset=offset, 
+        shape=(5 * nbr_nodes,)
+    )
+    offset += 40 * nbr_nodes
+    tri_idx = numpy.memmap(
+        bmesh_file, dtype="<u4", mode=mode, offset=offset, 
+        shape=(3 * nbr_tris,)
+    )
+    offset += 12 * nbr_tris
+    tri_types = numpy.memmap(
+        bmesh_file, dtype="<u4", mode=mode, offset=offset, shape=(nbr_tris,)
+    )
+    return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, 
+            tri_types)
+
+
+##############################################################################
+def is_binary_mesh_up_to_date(mesh_file):
+    bmesh_file = FNAMES.binary_mesh_file(mesh_file)
+    if not os.path.isfile(bmesh_file):
+        return False
+    if not os.path.isfile(mesh_file):
+        return True
+    try:
+        (_, _, _, text_size, text_mtime) = read_binary_mesh_header(bmesh_file)
+    except:
+        return False
+    text_stat = os.stat(mesh_file)
+    return (text_size, text_mtime) == (
+        text_stat.st_size, text_stat.st_mtime_ns
+    )
+
+
+##############################################################################
+def read_text_mesh_file(mesh_file):
     
+    def read_block(nbr_lines, dtype):
+        # one C level conversion per block rather than per line
+        data = numpy.fromstring(
+            "".join([f.readline() for _ in range(nbr_lines)]), 
+            dtype=dtype, 
+            sep=" ",
+        )
+        return data.reshape(nbr_lines, -1) if nbr_lines else data
+
     f = open(mesh_file,"r")
     mesh_version = float(f.readline().strip().split()[-1])
     
@@ -857,10 +1253,10 @@ def read_mesh_file(mesh_file):
     node_coords = numpy.zeros(5 * nbr_nodes)
     
     # read positions
-    for i in range(nbr_nodes):
-        node_coords[5 * i : 5 * i + 3] = [
-            float(x) for x in f.readline().split()[:3]
-        ]
+    if nbr_nodes:
+        node_coords.reshape(nbr_nodes, 5)[:, :3] = read_block(
+            nbr_nodes, numpy.float64
+        )[:, :3]
     # altitutes are encoded in .mesh files with a 100000 scaling factor
     node_coords[2::5] *= 100000
     
@@ -869,10 +1265,10 @@ def read_mesh_file(mesh_file):
         f.readline()
     
     # read normals
-    for i in range(nbr_nodes):
-        node_coords[5 * i + 3 : 5 * i + 5] = [
-            float(x) for x in f.readline().split()[:2]
-        ]
+    if nbr_nodes:
+        node_coords.reshape(nbr_nodes, 5)[:, 3:] = read_block(
+            nbr_nodes, numpy.float64
+        )[:, :2]
     
     # skip 2 lines
     for i in range(0, 2): 
@@ -883,14 +1279,56 @@ def read_mesh_file(mesh_file):
 
     tri_idx  = numpy.zeros(3 * nbr_tris, dtype = numpy.uint32)
     tri_types = numpy.zeros(nbr_tris, dtype = numpy.uint32)
-    for i in range(nbr_tris):
-        (n1, n2, n3, t) = [
-            int(x) - 1 for x in f.readline().split()[:4]
-        ]
-        tri_idx[3 * i: 3 * i + 3] = (n1, n2, n3)
-        tri_types[i] = t + 1
+    if nbr_tris:
+        tri_data = read_block(nbr_tris, numpy.int64)
+        tri_idx[:] = (tri_data[:, :3] - 1).ravel()
+        tri_types[:] = tri_data[:, 3]
     f.close()
 
     return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types)
+
+
+##############################################################################
+def convert_mesh_file(mesh_file):
+    (mesh_version, _, node_coords, _, tri_idx, tri_types) = (
+        read_text_mesh_file(mesh_file)
+    )
+    return write_binary_mesh_file(
+        mesh_file, mesh_version, node_coords, tri_idx, tri_types
+    )
+
+
+##############################################################################
+def read_mesh_file(mesh_file):
+    # Binary mesh if up to date, otherwise the text one is parsed and
+    # converted on the fly for subsequent reads.
+    if is_binary_mesh_up_to_date(mesh_file):
+        try:
+            return read_binary_mesh_file(FNAMES.binary_mesh_file(mesh_file))
+        except Exception as e:
+            UI.vprint(1, "    Binary mesh file unreadable, using text one.")
+            UI.vprint(2, e)
+    mesh = read_text_mesh_file(mesh_file)
+    (mesh_version, _, node_coords, _, tri_idx, tri_types) = mesh
+    write_binary_mesh_file(
+        mesh_file, mesh_version, node_coords, tri_idx, tri_types
+    )
+    return mesh
 ##############################################################################
 
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Syntax : python3 O4_Mesh_Utils.py file1.mesh [file2.mesh...]")
+        print("Converts text meshes to the binary (.bmesh) format.")
+        sys.exit(1)
+    for mesh_file in sys.argv[1:]:
+        timer = time.time()
+        if convert_mesh_file(mesh_file):
+            print(
+                mesh_file,
+                "->",
+                FNAMES.binary_mesh_file(mesh_file),
+                "in",
+                UI.nicer_timer(time.time() - timer),
+            )
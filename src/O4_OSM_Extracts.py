@@ -0,0 +1,784 @@
+import os
+import sys
+import re
+import bz2
+import json
+import array
+import threading
+from math import floor, ceil
+import numpy
+from xml.parsers import expat
+from shapely import geometry
+import O4_UI_Utils as UI
+import O4_File_Names as FNAMES
+import O4_OSM_Utils as OSM
+
+has_osmium = False
+try:
+    import osmium
+
+    has_osmium = True
+except:
+    pass
+
+################################################################################
+# Offline OSM data : a regional extract (.osm.pbf through pyosmium, or
+# .osm/.osm.bz2) is ingested once into a store under OSM_data/Extracts, made
+# of one npz per 1x1 degree tile (the layout of the binary OSM caches) which
+# holds the nodes, ways and relations of interest (extract_keys) crossing the
+# tile, with their children. Tiles entirely within the extract boundary
+# (its .poly file when found next to it, its bounds otherwise) are then
+# answered from the store instead of Overpass, for the simple tag queries
+# Ortho4XP issues, with the same content and order as an Overpass answer.
+################################################################################
+
+use_osm_extracts = True
+
+extract_keys = ("aeroway", "highway", "railway", "natural", "waterway")
+extract_format = 1
+
+stores = {}
+stores_lock = threading.Lock()
+loaded_tiles = {}
+
+################################################################################
+def scan_osm_xml(file_name, node=None, way=None, relation=None):
+    # Calls node(id, lon, lat, tags), way(id, refs, tags) and
+    # relation(id, members, tags) for the objects of the file, members being
+    # (type, ref, role) with type 'n', 'w' or 'r'.
+    current = {}
+
+    def start_element(name, attrs):
+        if name == "nd":
+            if way:
+                current["refs"].append(int(attrs[1]))
+            return
+        attrs = dict(zip(attrs[::2], attrs[1::2]))
+        if name == "tag":
+            if current:
+                current["tags"][sys.intern(attrs["k"])] = attrs["v"]
+        elif name == "node":
+            if node:
+                current.update(
+                    type="n",
+                    id=int(attrs["id"]),
+                    lon=float(attrs["lon"]),
+                    lat=float(attrs["lat"]),
+                    tags={},
+                )
+        elif name == "way":
+            if way:
+                current.update(
+                    type="w", id=int(attrs["id"]), refs=array.array("q"), tags={}
+                )
+        elif name == "relation":
+            if relation:
+                current.update(type="r", id=int(attrs["id"]), members=[], tags={})
+        elif name == "member":
+            if current:
+                current["members"].append(
+                    (attrs["type"][0], int(attrs["ref"]), attrs.get("role", ""))
+                )
+
+    def end_element(name):
+        if not current or name not in ("node", "way", "relation"):
+            return
+        if name == "node":
+            node(current["id"], current["lon"], current["lat"], current["tags"])
+        elif name == "way":
+            way(current["id"], current["refs"], current["tags"])
+        else:
+            relation(current["id"], current["members"], current["tags"])
+        current.clear()
+
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    if file_name[-4:] == ".bz2":
+        pfile = bz2.open(file_name, "rb")
+    else:
+        pfile = open(file_name, "rb")
+    with pfile:
+        for chunk in iter(lambda: pfile.read(2 ** 20), b""):
+            parser.Parse(chunk, False)
+    parser.Parse(b"", True)
+
+
+################################################################################
+def scan_osm_pbf(file_name, node=None, way=None, relation=None):
+    # Same as scan_osm_xml, through pyosmium.
+    class handler(osmium.SimpleHandler):
+        pass
+
+    if node:
+        handler.node = lambda self, n: node(
+            n.id,
+            n.location.lon,
+            n.location.lat,
+            {tag.k: tag.v for tag in n.tags},
+        )
+    if way:
+        handler.way = lambda self, w: way(
+            w.id,
+            array.array("q", [nd.ref for nd in w.nodes]),
+            {tag.k: tag.v for tag in w.tags},
+        )
+    if relation:
+        handler.relation = lambda self, r: relation(
+            r.id,
+            [(m.type, m.ref, m.role) for m in r.members],
+            {tag.k: tag.v for tag in r.tags},
+        )
+    handler().apply_file(file_name)
+
+
+################################################################################
+def extract_boundary(file_name):
+    # The polygon of the .poly file (osmosis format) found next to the
+    # extract, else the box of its bounds.
+    base_name = file_name
+    for ext in (".bz2", ".pbf", ".osm"):
+        if base_name.endswith(ext):
+            base_name = base_name[: -len(ext)]
+    if os.path.isfile(base_name + ".poly"):
+        outers = []
+        inners = []
+        with open(base_name + ".poly") as f:
+            lines = [line.strip() for line in f][1:]
+        ring = None
+        for line in lines:
+            if ring is None:
+                if not line or line == "END":
+                    continue
+                ring = []
+                (inners if line[0] == "!" else outers).append(ring)
+            elif line == "END":
+                ring = None
+            else:
+                ring.append([float(x) for x in line.split()[:2]])
+        boundary = geometry.MultiPolygon(
+            [geometry.Polygon(ring) for ring in outers if len(ring) >= 3]
+        ).buffer(0)
+        for ring in inners:
+            if len(ring) >= 3:
+                boundary = boundary.difference(geometry.Polygon(ring))
+        return boundary
+    if file_name.endswith(".pbf"):
+        box = osmium.io.Reader(file_name).header().box()
+        if not box.valid():
+            return None
+        return geometry.box(
+            box.bottom_left.lon,
+            box.bottom_left.lat,
+            box.top_right.lon,
+            box.top_right.lat,
+        )
+    bounds = {}
+
+    def start_element(name, attrs):
+        if name == "bounds":
+            bounds.update(attrs)
+            raise StopIteration
+        elif name in ("node", "way", "relation"):
+            raise StopIteration
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    pfile = bz2.open(file_name) if file_name[-4:] == ".bz2" else open(
+        file_name, "rb"
+    )
+    try:
+        with pfile:
+            parser.Parse(pfile.read(2 ** 16), False)
+    except:
+        pass
+    if not bounds:
+        return None
+    return geometry.box(
+        float(bounds["minlon"]),
+        float(bounds["minlat"]),
+        float(bounds["maxlon"]),
+        float(bounds["maxlat"]),
+    )
+
+
+################################################################################
+def tiles_of_boxes(lon_min, lat_min, lon_max, lat_max):
+    # Ranges of the tiles touched by boxes, boundaries included.
+    return (
+        numpy.ceil(lat_min).astype(numpy.int64) - 1,
+        numpy.floor(lat_max).astype(numpy.int64),
+        numpy.ceil(lon_min).astype(numpy.int64) - 1,
+        numpy.floor(lon_max).astype(numpy.int64),
+    )
+
+
+################################################################################
+def ingest_extract(file_name, name=None):
+    if not os.path.isfile(file_name):
+        UI.lvprint(0, "ERROR: OSM extract", file_name, "not found.")
+        return 0
+    if file_name.endswith(".pbf"):
+        if not has_osmium:
+            UI.lvprint(
+                0,
+                "ERROR: Reading .pbf extracts requires the pyosmium module,",
+                "convert it to .osm.bz2 or install pyosmium.",
+            )
+            return 0
+        scan = scan_osm_pbf
+    else:
+        scan = scan_osm_xml
+    if name is None:
+        name = os.path.basename(file_name).split(".")[0]
+    boundary = extract_boundary(file_name)
+    if boundary is None or boundary.is_empty:
+        UI.lvprint(
+            0,
+            "ERROR: OSM extract",
+            file_name,
+            "has neither bounds nor .poly file, it cannot be used.",
+        )
+        return 0
+    kept_keys = set(extract_keys)
+    UI.vprint(1, "-> Ingesting OSM extract", file_name, "as", name)
+    # 1. relations with tags of interest, and their member ways
+    rels = {"ids": [], "members": [], "tags": []}
+    member_ways = set()
+
+    def relation(osmid, members, tags):
+        if kept_keys.isdisjoint(tags):
+            return
+        members = [
+            (ref, role)
+            for (osmtype, ref, role) in members
+            if osmtype == "w" and role in ("outer", "inner")
+        ]
+        rels["ids"].append(osmid)
+        rels["members"].append(members)
+        rels["tags"].append(tags)
+        member_ways.update(ref for (ref, _) in members)
+
+    UI.vprint(1, "   Reading relations...")
+    scan(file_name, relation=relation)
+    if UI.red_flag:
+        return 0
+    # 2. ways with tags of interest or members of the above relations
+    ways = {
+        "ids": array.array("q"),
+        "lengths": array.array("q"),
+        "refs": array.array("q"),
+        "tags": {},
+    }
+
+    def way(osmid, refs, tags):
+        if kept_keys.isdisjoint(tags) and osmid not in member_ways:
+            return
+        if not refs:
+            return
+        if tags:
+            ways["tags"][len(ways["ids"])] = tags
+        ways["ids"].append(osmid)
+        ways["lengths"].append(len(refs))
+        ways["refs"].extend(refs)
+
+    UI.vprint(1, "   Reading ways...")
+    scan(file_name, way=way)
+    if UI.red_flag:
+        return 0
+    needed_nodes = numpy.unique(numpy.frombuffer(ways["refs"], numpy.int64))
+    # 3. nodes of the above ways, or with tags of interest
+    nodes = {
+        "ids": [],
+        "coords": [],
+        "tags": {},
+        "chunk_ids": array.array("q"),
+        "chunk_coords": array.array("d"),
+        "kept": 0,
+    }
+
+    def flush_nodes():
+        chunk_ids = numpy.frombuffer(nodes["chunk_ids"], numpy.int64)
+        pos = numpy.minimum(
+            numpy.searchsorted(needed_nodes, chunk_ids),
+            max(len(needed_nodes) - 1, 0),
+        )
+        keep = (
+            needed_nodes[pos] == chunk_ids
+            if len(needed_nodes)
+            else numpy.zeros(len(chunk_ids), dtype=bool)
+        )
+        for (idx, tags) in nodes["chunk_tags"].items():
+            if not kept_keys.isdisjoint(tags):
+                keep[idx] = True
+        nodes["ids"].append(chunk_ids[keep].copy())
+        nodes["coords"].append(
+            numpy.frombuffer(nodes["chunk_coords"]).reshape(-1, 2)[keep].copy()
+        )
+        rank = numpy.cumsum(keep) - 1 + nodes["kept"]
+        for (idx, tags) in nodes["chunk_tags"].items():
+            if keep[idx]:
+                nodes["tags"][int(rank[idx])] = tags
+        nodes["kept"] += int(keep.sum())
+        nodes["chunk_ids"] = array.array("q")
+        nodes["chunk_coords"] = array.array("d")
+        nodes["chunk_tags"] = {}
+
+    nodes["chunk_tags"] = {}
+
+    def node(osmid, lonp, latp, tags):
+        if tags:
+            nodes["chunk_tags"][len(nodes["chunk_ids"])] = tags
+        nodes["chunk_ids"].append(osmid)
+        nodes["chunk_coords"].append(lonp)
+        nodes["chunk_coords"].append(latp)
+        if len(nodes["chunk_ids"]) == 2 ** 20:
+            flush_nodes()
+
+    UI.vprint(1, "   Reading nodes...")
+    scan(file_name, node=node)
+    flush_nodes()
+    if UI.red_flag:
+        return 0
+    node_ids = numpy.concatenate(nodes["ids"])
+    node_coords = numpy.concatenate(nodes["coords"])
+    order = numpy.argsort(node_ids, kind="stable")
+    node_tags = {}
+    rank = numpy.empty(len(order), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(order))
+    for (idx, tags) in nodes["tags"].items():
+        node_tags[int(rank[idx])] = tags
+    (node_ids, node_coords) = (node_ids[order], node_coords[order])
+    return write_extract_store(
+        name,
+        file_name,
+        boundary,
+        (node_ids, node_coords, node_tags),
+        ways,
+        rels,
+    )
+
+
+################################################################################
+def write_extract_store(name, file_name, boundary, nodes, ways, rels):
+    (node_ids, node_coords, node_tags) = nodes
+    UI.vprint(1, "   Sorting out the data per tile...")
+    # ways, sorted by id, with their refs as rows of the nodes ; references
+    # to missing nodes (cut by the extract) are dropped
+    way_ids = numpy.frombuffer(ways["ids"], numpy.int64)
+    way_lengths = numpy.frombuffer(ways["lengths"], numpy.int64)
+    way_refs = numpy.frombuffer(ways["refs"], numpy.int64)
+    way_of_ref = numpy.repeat(numpy.arange(len(way_ids)), way_lengths)
+    pos = numpy.minimum(
+        numpy.searchsorted(node_ids, way_refs), max(len(node_ids) - 1, 0)
+    )
+    found = node_ids[pos] == way_refs if len(node_ids) else pos < 0
+    (way_of_ref, ref_rows) = (way_of_ref[found], pos[found])
+    way_lengths = numpy.bincount(way_of_ref, minlength=len(way_ids))
+    way_starts = numpy.concatenate(([0], numpy.cumsum(way_lengths)[:-1]))
+    valid = way_lengths > 0
+    ref_lon = node_coords[ref_rows, 0]
+    ref_lat = node_coords[ref_rows, 1]
+    way_box = numpy.zeros((len(way_ids), 4))
+    if len(ref_rows):
+        starts = way_starts[valid]
+        way_box[valid] = numpy.column_stack(
+            (
+                numpy.minimum.reduceat(ref_lon, starts),
+                numpy.minimum.reduceat(ref_lat, starts),
+                numpy.maximum.reduceat(ref_lon, starts),
+                numpy.maximum.reduceat(ref_lat, starts),
+            )
+        )
+    # relations, with the box of their member ways
+    way_order = numpy.argsort(way_ids, kind="stable")
+    sorted_way_ids = way_ids[way_order]
+
+    def way_rows(refs):
+        refs = numpy.array(refs, dtype=numpy.int64)
+        if not len(sorted_way_ids):
+            return refs[:0]
+        pos = numpy.minimum(
+            numpy.searchsorted(sorted_way_ids, refs), len(sorted_way_ids) - 1
+        )
+        rows = way_order[pos[sorted_way_ids[pos] == refs]]
+        return rows[valid[rows]]
+
+    rel_rows = [way_rows([ref for (ref, _) in m]) for m in rels["members"]]
+    # tiles of the objects
+    tile_objects = {}
+    covered = set()
+
+    def add_to_tiles(kind, idx, box):
+        (lat0, lat1, lon0, lon1) = tiles_of_boxes(*box)
+        for til_lat in range(int(lat0), int(lat1) + 1):
+            for til_lon in range(int(lon0), int(lon1) + 1):
+                if (til_lat, til_lon) not in tile_objects:
+                    tile_objects[(til_lat, til_lon)] = {
+                        "n": [],
+                        "w": [],
+                        "r": [],
+                    }
+                tile_objects[(til_lat, til_lon)][kind].append(idx)
+
+    for idx in numpy.flatnonzero(valid):
+        add_to_tiles("w", idx, way_box[idx])
+    for (idx, rows) in enumerate(rel_rows):
+        if len(rows):
+            add_to_tiles(
+                "r",
+                idx,
+                (
+                    way_box[rows, 0].min(),
+                    way_box[rows, 1].min(),
+                    way_box[rows, 2].max(),
+                    way_box[rows, 3].max(),
+                ),
+            )
+    for (idx, tags) in node_tags.items():
+        if not set(extract_keys).isdisjoint(tags):
+            (lonp, latp) = node_coords[idx]
+            add_to_tiles("n", idx, (lonp, latp, lonp, latp))
+    (lon_min, lat_min, lon_max, lat_max) = boundary.bounds
+    for til_lat in range(floor(lat_min), ceil(lat_max)):
+        for til_lon in range(floor(lon_min), ceil(lon_max)):
+            if geometry.box(
+                til_lon, til_lat, til_lon + 1, til_lat + 1
+            ).within(boundary):
+                covered.add((til_lat, til_lon))
+    if not covered:
+        UI.lvprint(
+            0,
+            "ERROR: OSM extract",
+            file_name,
+            "does not cover any tile entirely, nothing ingested.",
+        )
+        return 0
+    store_dir = FNAMES.osm_extract_dir(name)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    for file in os.listdir(store_dir):
+        os.remove(os.path.join(store_dir, file))
+    for (til_lat, til_lon) in sorted(covered.intersection(tile_objects)):
+        if UI.red_flag:
+            return 0
+        objects = tile_objects[(til_lat, til_lon)]
+        rel_idx = numpy.array(objects["r"], dtype=numpy.int64)
+        tile_ways = numpy.unique(
+            numpy.concatenate(
+                [numpy.array(objects["w"], dtype=numpy.int64)]
+                + [rel_rows[idx] for idx in rel_idx]
+            )
+        )
+        tile_ways = tile_ways[numpy.argsort(way_ids[tile_ways], kind="stable")]
+        ref_idx = numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.int64)]
+            + [
+                numpy.arange(way_starts[w], way_starts[w] + way_lengths[w])
+                for w in tile_ways
+            ]
+        )
+        tile_nodes = numpy.unique(
+            numpy.concatenate(
+                (ref_rows[ref_idx], numpy.array(objects["n"], dtype=numpy.int64))
+            )
+        )
+        osm_data = OSM.OSM_xml_data()
+        osm_data.node_ids = node_ids[tile_nodes]
+        osm_data.node_coords = node_coords[tile_nodes].ravel()
+        osm_data.tags["n"] = {
+            i: node_tags[idx]
+            for (i, idx) in enumerate(tile_nodes.tolist())
+            if idx in node_tags
+        }
+        osm_data.way_ids = way_ids[tile_ways]
+        osm_data.way_starts = numpy.concatenate(
+            ([0], numpy.cumsum(way_lengths[tile_ways])[:-1])
+        ).astype(numpy.int64)
+        osm_data.way_refs = node_ids[ref_rows[ref_idx]]
+        osm_data.tags["w"] = {
+            i: ways["tags"][idx]
+            for (i, idx) in enumerate(tile_ways.tolist())
+            if idx in ways["tags"]
+        }
+        rel_idx = rel_idx[
+            numpy.argsort(
+                numpy.array(rels["ids"], dtype=numpy.int64)[rel_idx],
+                kind="stable",
+            )
+        ] if len(rel_idx) else rel_idx
+        osm_data.rel_ids = [rels["ids"][idx] for idx in rel_idx]
+        osm_data.rel_members = [rels["members"][idx] for idx in rel_idx]
+        osm_data.tags["r"] = {
+            i: rels["tags"][idx] for (i, idx) in enumerate(rel_idx)
+        }
+        numpy.savez(
+            FNAMES.osm_extract_tile(name, til_lat, til_lon),
+            **OSM.osm_data_to_arrays(osm_data)
+        )
+    with open(os.path.join(store_dir, "index.json"), "w") as f:
+        json.dump(
+            {
+                "format": extract_format,
+                "source": os.path.abspath(file_name),
+                "keys": sorted(extract_keys),
+                "tiles": sorted(covered),
+            },
+            f,
+        )
+    with stores_lock:
+        stores.clear()
+    UI.vprint(
+        1,
+        "   Done,",
+        len(covered),
+        "tiles are now covered by",
+        name,
+        "(" + str(len(covered.intersection(tile_objects))),
+        "with data).",
+    )
+    return 1
+
+
+################################################################################
+def list_stores():
+    # Name -> covered tiles, read again whenever an index changes.
+    if not os.path.isdir(FNAMES.OSM_extracts_dir):
+        return {}
+    with stores_lock:
+        for name in os.listdir(FNAMES.OSM_extracts_dir):
+            index_file = os.path.join(
+                FNAMES.osm_extract_dir(name), "index.json"
+            )
+            try:
+                mtime = os.path.getmtime(index_file)
+            except:
+                stores.pop(name, None)
+                continue
+            if name in stores and stores[name][0] == mtime:
+                continue
+            try:
+                with open(index_file) as f:
+                    index = json.load(f)
+                if index["format"] != extract_format:
+                    continue
+                stores[name] = (
+                    mtime,
+                    set(tuple(til) for til in index["tiles"]),
+                    set(index["keys"]),
+                )
+            except:
+                continue
+        return {name: tiles for (name, (_, tiles, _)) in stores.items()}
+
+
+################################################################################
+def bbox_tile(bbox):
+    # The 1x1 degree tile containing bbox=(south, west, north, east), if any.
+    if not isinstance(bbox, tuple):
+        return None
+    (til_lat, til_lon) = (floor(bbox[0]), floor(bbox[1]))
+    if bbox[2] > til_lat + 1 or bbox[3] > til_lon + 1:
+        return None
+    return (til_lat, til_lon)
+
+
+################################################################################
+def store_for_bbox(bbox):
+    # The store covering bbox, if it lies within a single tile.
+    tile = bbox_tile(bbox)
+    if not use_osm_extracts or tile is None:
+        return None
+    for (name, tiles) in sorted(list_stores().items()):
+        if tile in tiles:
+            return name
+    return None
+
+
+################################################################################
+def load_tile(name, til_lat, til_lon):
+    # The (few) tiles last used are kept since a tile is asked many queries.
+    key = (name, til_lat, til_lon)
+    with stores_lock:
+        if key in loaded_tiles:
+            return loaded_tiles[key]
+    file_name = FNAMES.osm_extract_tile(name, til_lat, til_lon)
+    osm_data = OSM.OSM_xml_data()
+    if os.path.isfile(file_name):
+        with numpy.load(file_name, allow_pickle=False) as npz:
+            osm_data = OSM.osm_data_from_arrays(dict(npz))
+    osm_data.node_coords = numpy.asarray(osm_data.node_coords).reshape(-1, 2)
+    with stores_lock:
+        if len(loaded_tiles) >= 4:
+            del loaded_tiles[next(iter(loaded_tiles))]
+        loaded_tiles[key] = osm_data
+    return osm_data
+
+
+################################################################################
+query_regex = re.compile(r'(node|way|rel)((?:\["[^"]+"(?:="[^"]*")?\])+)$')
+filter_regex = re.compile(r'\["([^"]+)"(?:="([^"]*)")?\]')
+
+
+def parse_query(query):
+    # [(osm type, [(key, value or None)])], None if not understood
+    clauses = []
+    for clause in [query] if isinstance(query, str) else query:
+        match = query_regex.match(clause.replace(" ", ""))
+        if not match:
+            return None
+        clauses.append(
+            (
+                match.group(1)[0],
+                [(k, v) for (k, v) in filter_regex.findall(match.group(2))],
+            )
+        )
+    return clauses
+
+
+def store_answers(name, query):
+    # Only queries whose filters all bear on keys ingested in the store are
+    # answered from it, others (e.g. landuse) must go to Overpass.
+    clauses = parse_query(query)
+    if not clauses:
+        return False
+    with stores_lock:
+        keys = stores[name][2] if name in stores else set()
+    return all(
+        filters and all(k in keys for (k, _) in filters)
+        for (_, filters) in clauses
+    )
+
+
+def tags_match(tags, filters):
+    for (k, v) in filters:
+        if k not in tags or (v and tags[k] != v):
+            return False
+    return True
+
+
+################################################################################
+def query_osm_data(name, query, bbox, input_tags=None, target_tags=None):
+    # The content of the Overpass answer to
+    # (query(bbox));(._;>>;);out meta;
+    # as parse_osm_xml would return it, or None if the query is not
+    # understood or the store does not cover bbox (Overpass must be asked).
+    clauses = parse_query(query)
+    if clauses is None:
+        return None
+    if bbox_tile(bbox) is None or bbox_tile(bbox) not in list_stores().get(
+        name, ()
+    ):
+        return None
+    (south, west, north, east) = bbox
+    data = load_tile(name, floor(south), floor(west))
+    (lon, lat) = (data.node_coords[:, 0], data.node_coords[:, 1])
+    node_in = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+    node_ids = numpy.asarray(data.node_ids, dtype=numpy.int64)
+    way_ids = numpy.asarray(data.way_ids, dtype=numpy.int64)
+    way_starts = numpy.asarray(data.way_starts, dtype=numpy.int64)
+    way_lengths = numpy.diff(numpy.append(way_starts, len(data.way_refs)))
+    ref_rows = numpy.searchsorted(
+        node_ids, numpy.asarray(data.way_refs, dtype=numpy.int64)
+    )
+    # ways crossing the bbox : with a node inside, or else a segment
+    way_in = numpy.zeros(len(way_ids), dtype=bool)
+    if len(way_ids):
+        way_in = numpy.logical_or.reduceat(node_in[ref_rows], way_starts)
+        bbox_geom = geometry.box(west, south, east, north)
+        for idx in numpy.flatnonzero(~way_in & (way_lengths > 1)):
+            coords = data.node_coords[
+                ref_rows[way_starts[idx] : way_starts[idx] + way_lengths[idx]]
+            ]
+            if (
+                coords[:, 0].max() >= west
+                and coords[:, 0].min() <= east
+                and coords[:, 1].max() >= south
+                and coords[:, 1].min() <= north
+            ):
+                way_in[idx] = geometry.LineString(coords).intersects(
+                    bbox_geom
+                )
+    node_sel = numpy.zeros(len(node_ids), dtype=bool)
+    way_sel = numpy.zeros(len(way_ids), dtype=bool)
+    rel_sel = numpy.zeros(len(data.rel_ids), dtype=bool)
+    rel_rows = []
+    for members in data.rel_members:
+        refs = numpy.array([ref for (ref, _) in members], dtype=numpy.int64)
+        rows = numpy.minimum(
+            numpy.searchsorted(way_ids, refs), max(len(way_ids) - 1, 0)
+        )
+        if not len(way_ids):
+            rows = rows[:0]
+        rel_rows.append(rows[way_ids[rows] == refs] if len(rows) else rows)
+    for (osmtype, filters) in clauses:
+        if osmtype == "n":
+            for (idx, tags) in data.tags["n"].items():
+                if node_in[idx] and tags_match(tags, filters):
+                    node_sel[idx] = True
+        elif osmtype == "w":
+            for (idx, tags) in data.tags["w"].items():
+                if way_in[idx] and tags_match(tags, filters):
+                    way_sel[idx] = True
+        else:
+            for (idx, tags) in data.tags["r"].items():
+                if tags_match(tags, filters) and way_in[rel_rows[idx]].any():
+                    rel_sel[idx] = True
+    # children
+    for idx in numpy.flatnonzero(rel_sel):
+        way_sel[rel_rows[idx]] = True
+    ref_sel = numpy.repeat(way_sel, way_lengths)
+    node_sel[ref_rows[ref_sel]] = True
+    # the answer, in id order as Overpass does
+    osm_data = OSM.OSM_xml_data()
+    node_idx = numpy.flatnonzero(node_sel)
+    osm_data.node_ids = node_ids[node_idx]
+    osm_data.node_coords = data.node_coords[node_idx].ravel()
+    way_idx = numpy.flatnonzero(way_sel)
+    osm_data.way_ids = way_ids[way_idx]
+    osm_data.way_starts = numpy.concatenate(
+        ([0], numpy.cumsum(way_lengths[way_idx])[:-1])
+    ).astype(numpy.int64)[: len(way_idx)]
+    osm_data.way_refs = node_ids[ref_rows[ref_sel]]
+    rel_idx = numpy.flatnonzero(rel_sel)
+    osm_data.rel_ids = [data.rel_ids[idx] for idx in rel_idx]
+    osm_data.rel_members = [data.rel_members[idx] for idx in rel_idx]
+    # tags as filtered by parse_osm_xml
+    for (osmtype, selected) in (("n", node_idx), ("w", way_idx), ("r", rel_idx)):
+        keep_all = (not input_tags) or (("all", "") in target_tags[osmtype])
+        targets = set(target_tags[osmtype]) if input_tags else set()
+        inputs = set(input_tags[osmtype]) if input_tags else set()
+        for (i, idx) in enumerate(selected.tolist()):
+            if idx not in data.tags[osmtype]:
+                continue
+            for (k, v) in data.tags[osmtype][idx].items():
+                if keep_all or (k, "") in targets or (k, v) in targets:
+                    if i not in osm_data.tags[osmtype]:
+                        osm_data.tags[osmtype][i] = {}
+                    osm_data.tags[osmtype][i][k] = v
+                    if (k, "") in inputs or (k, v) in inputs:
+                        osm_data.first[osmtype].add(i)
+    return osm_data
+
+
+################################################################################
+
+if __name__ == "__main__":
+    UI.log = False
+    UI.verbosity = 1
+    Syntax = (
+        "Syntax :\n"
+        "--------\n"
+        "(PYTHON) O4_OSM_Extracts.py extract_file [name]\n"
+        "extract_file is a .osm.pbf (requires pyosmium), .osm or .osm.bz2 "
+        "regional extract, a .poly file next to it with the same name "
+        "restricts the tiles it covers.\n"
+    )
+    if len(sys.argv) not in (2, 3):
+        print(Syntax)
+        sys.exit(1)
+    if not ingest_extract(
+        sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None
+    ):
+        sys.exit(1)
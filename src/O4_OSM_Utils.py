@@ -1,13 +1,18 @@
 import os
+import sys
 import time
-import io
+import array
 import bz2
 import random
-import requests
+import asyncio
 import numpy
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
 from shapely import geometry, ops
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_File_Names as FNAMES
+import O4_Async_Utils as AIO
 
 overpass_servers = {
     "DE": "http://overpass-api.de/api/interpreter",
@@ -18,16 +23,106 @@ overpass_servers = {
 overpass_server_choice = "DE"
 max_osm_tentatives = 8
 
+################################################################################
+class OSM_nodes:
+    # Coordinates of the nodes of an OSM_layer : the node id -1-i refers to
+    # the row i of coords. It reads like the dict from ids to (lon, lat)
+    # tuples that it replaces.
+    def __init__(self):
+        self.coords = numpy.zeros((0, 2))
+        # lon + 1j * lat of all rows, sorted, and the corresponding rows :
+        # nodes with the same coordinates are merged.
+        self.sorted_keys = numpy.zeros(0, dtype=numpy.complex128)
+        self.sorted_rows = numpy.zeros(0, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __contains__(self, nodeid):
+        return -len(self.coords) <= nodeid <= -1
+
+    def __getitem__(self, nodeid):
+        if not -len(self.coords) <= nodeid <= -1:
+            raise KeyError(nodeid)
+        return tuple(self.coords[-1 - nodeid].tolist())
+
+    def __iter__(self):
+        return iter(range(-1, -1 - len(self.coords), -1))
+
+    def items(self):
+        for (row, (lonp, latp)) in enumerate(self.coords.tolist()):
+            yield (-1 - row, (lonp, latp))
+
+    def add(self, coords):
+        # Returns the rows of the (lon, lat) coords, new rows being created
+        # in the order of first appearance of new coordinates.
+        keys = (coords[:, 0] + 1j * coords[:, 1]).astype(numpy.complex128)
+        (unique_keys, first, inverse) = numpy.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        unique_rows = numpy.full(len(unique_keys), -1, dtype=numpy.int64)
+        if len(self.sorted_keys):
+            pos = numpy.minimum(
+                numpy.searchsorted(self.sorted_keys, unique_keys),
+                len(self.sorted_keys) - 1,
+            )
+            known = self.sorted_keys[pos] == unique_keys
+            unique_rows[known] = self.sorted_rows[pos[known]]
+        new = numpy.flatnonzero(unique_rows == -1)
+        new = new[numpy.argsort(first[new], kind="stable")]
+        unique_rows[new] = len(self.coords) + numpy.arange(len(new))
+        self.coords = numpy.concatenate((self.coords, coords[first[new]]))
+        keys = numpy.concatenate((self.sorted_keys, unique_keys[new]))
+        rows = numpy.concatenate((self.sorted_rows, unique_rows[new]))
+        order = numpy.argsort(keys, kind="stable")
+        (self.sorted_keys, self.sorted_rows) = (keys[order], rows[order])
+        return unique_rows[inverse.ravel()]
+
+
+################################################################################
+class OSM_ways:
+    # Ways of an OSM_layer as rows of its nodes : the way id -1-i has the
+    # nodes rows[offsets[i]:offsets[i+1]]. It reads like the dict from ids to
+    # lists of node ids that it replaces.
+    def __init__(self):
+        self.offsets = numpy.zeros(1, dtype=numpy.int64)
+        self.rows = numpy.zeros(0, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, wayid):
+        return -len(self) <= wayid <= -1
+
+    def __getitem__(self, wayid):
+        return (-1 - self.node_rows(wayid).astype(numpy.int64)).tolist()
+
+    def __iter__(self):
+        return iter(range(-1, -1 - len(self), -1))
+
+    def items(self):
+        for wayid in self:
+            yield (wayid, self[wayid])
+
+    def node_rows(self, wayid):
+        if not -len(self) <= wayid <= -1:
+            raise KeyError(wayid)
+        return self.rows[self.offsets[-1 - wayid] : self.offsets[-wayid]]
+
+    def add(self, lengths, rows):
+        self.offsets = numpy.concatenate(
+            (self.offsets, self.offsets[-1] + numpy.cumsum(lengths))
+        )
+        self.rows = numpy.concatenate((self.rows, rows.astype(numpy.int32)))
+
+
 ################################################################################
 class OSM_layer:
     def __init__(self):
-        self.dicosmn = (
-            {}
-        )  # keys are ints (ids) and values are tuple of (lat,lon)
-        self.dicosmn_reverse = {}  # reverese of the previous one
-        self.dicosmw = {}
-        self.next_node_id = -1
-        self.next_way_id = -1
+        # node ids to (lon, lat)
+        self.dicosmn = OSM_nodes()
+        # way ids to lists of node ids
+        self.dicosmw = OSM_ways()
         self.next_rel_id = -1
         # rels already sorted out and containing nodeids rather than wayids
         self.dicosmr = {}
@@ -47,228 +142,98 @@ class OSM_layer:
             self.dicosmtags,
         ]
 
+    def way_coords(self, wayid):
+        return self.dicosmn.coords[self.dicosmw.node_rows(wayid)]
+
+    def nodes_coords(self, nodeids):
+        return self.dicosmn.coords[-1 - numpy.array(nodeids, dtype=numpy.int64)]
+
+    @STATS.timed("osm_parse")
     def update_dicosm(self, osm_input, input_tags=None, target_tags=None):
         # input_tags (dict or None) are the input query tags (per osm type)
         # target_tags (dict or None) are the the tags which should be kept 
         # (per osm type) It is expected that if not None the target_tags 
         # contains the input_tags
+        osm_data = parse_osm_xml(osm_input, input_tags, target_tags)
+        if osm_data is None:
+            return 0
+        return self.merge_osm_data(osm_data, input_tags, target_tags)
+
+    @STATS.timed("osm_cache_load")
+    def update_dicosm_from_cache(self, osm_file_name, input_tags, target_tags):
+        # Same as update_dicosm for an OSM cache file, read from its binary
+        # copy (created on first use) as long as it matches.
+        osm_data = read_cached_osm_data(osm_file_name, input_tags, target_tags)
+        if osm_data is None:
+            return 0
+        return self.merge_osm_data(osm_data, input_tags, target_tags)
+
+    def merge_osm_data(self, osm_data, input_tags, target_tags):
         initnodes = len(self.dicosmn)
         initways = len(self.dicosmfirst["w"])
         initrels = len(self.dicosmfirst["r"])
-        dicosmn_id_map = {}
-        dicosmw_id_map = {}
-        # osm_input may either refer to an osm filename (e.g. cached data) or
-        # to a xml bytestring (direct download)
-        if isinstance(osm_input, str):
-            osm_file_name = osm_input
-            try:
-                if osm_file_name[-4:] == ".bz2":
-                    pfile = bz2.open(osm_file_name, "rt", encoding="utf-8")
-                else:
-                    pfile = open(osm_file_name, "r", encoding="utf-8")
-            except:
-                UI.vprint(
-                    1,
-                    "    Could not open",
-                    osm_file_name,
-                    "for reading (corrupted ?).",
-                )
-                return 0
-        elif isinstance(osm_input, bytes):
-            pfile = io.StringIO(osm_input.decode(encoding="utf-8"))
-        first_line = pfile.readline()
-        if "<osm " not in first_line:
-            first_line = pfile.readline()
-        separator = "'" if "'" in first_line else '"'
-        normal_exit = False
-        for line in pfile:
-            items = line.split(separator)
-            if "<node id=" in items[0]:
-                osmtype = "n"
-                osmid = items[1]
-                for j in range(0, len(items)):
-                    if items[j] == " lat=":
-                        latp = float(items[j + 1])
-                    elif items[j] == " lon=":
-                        lonp = float(items[j + 1])
-                if (lonp, latp) in self.dicosmn_reverse:
-                    true_osmid = self.dicosmn_reverse[(lonp, latp)]
-                    dicosmn_id_map[osmid] = true_osmid
-                    osmid = true_osmid
-                else:
-                    true_osmid = self.next_node_id
-                    dicosmn_id_map[osmid] = true_osmid
-                    osmid = true_osmid
-                    self.dicosmn_reverse[(lonp, latp)] = osmid
-                    self.dicosmn[osmid] = (lonp, latp)
-                    self.next_node_id -= 1
-            elif "<way id=" in items[0]:
-                osmtype = "w"
-                osmid = items[1]
-                true_osmid = self.next_way_id
-                self.next_way_id -= 1
-                dicosmw_id_map[osmid] = true_osmid
-                osmid = true_osmid
-                self.dicosmw[osmid] = []
-                if not input_tags:
-                    self.dicosmfirst["w"].add(osmid)
-            elif "<nd ref=" in items[0]:
-                self.dicosmw[osmid].append(dicosmn_id_map[items[1]])
-            elif "<relation id=" in items[0]:
-                osmtype = "r"
-                osmid = items[1]
-                true_osmid = self.next_rel_id
-                self.next_rel_id -= 1
-                osmid = true_osmid
-                self.dicosmr[osmid] = {"outer": [], "inner": []}
-                self.dicosmrorig[osmid] = {"outer": [], "inner": []}
-                dico_rel_check = {"inner": {}, "outer": {}}
-                if not input_tags:
-                    self.dicosmfirst["r"].add(osmid)
-            elif "<member type=" in items[0]:
-                role = items[5]
-                if items[1] != "way" or role not in ("outer", "inner"):
-                    if items[1] == "node":
-                        continue  # not necessary to report these
-                    UI.lvprint(
-                        2,
-                        "Relation id=",
-                        osmid,
-                        "contains a member of type",
-                        "'" + items[1] + "'",
-                        "and role",
-                        "'" + role + "'",
-                        "which was not treated (only deal with 'ways' of role ",
-                        "'inner' or 'outer').",
-                    )
-                    continue
-                try:
-                    wayid = dicosmw_id_map[items[3]]
-                except:
-                    continue
-                self.dicosmrorig[osmid][role].append(wayid)
-                endpt1 = self.dicosmw[wayid][0]
-                endpt2 = self.dicosmw[wayid][-1]
-                if endpt1 == endpt2:
-                    self.dicosmr[osmid][role].append(self.dicosmw[wayid])
-                else:
-                    if endpt1 in dico_rel_check[role]:
-                        dico_rel_check[role][endpt1].append(wayid)
-                    else:
-                        dico_rel_check[role][endpt1] = [wayid]
-                    if endpt2 in dico_rel_check[role]:
-                        dico_rel_check[role][endpt2].append(wayid)
-                    else:
-                        dico_rel_check[role][endpt2] = [wayid]
-            elif "<tag k=" in items[0]:
-                # Do we need to catch that tag ?
-                if (
-                    (not input_tags)
-                    or (("all", "") in target_tags[osmtype])
-                    or ((items[1], "") in target_tags[osmtype])
-                    or ((items[1], items[3]) in target_tags[osmtype])
-                ):
-                    if osmid not in self.dicosmtags[osmtype]:
-                        self.dicosmtags[osmtype][osmid] = {items[1]: items[3]}
-                    else:
-                        self.dicosmtags[osmtype][osmid][items[1]] = items[3]
-                    # If so, do we need to declare this osmid as a first catch, 
-                    # not one only brought with as a child
-                    if input_tags and (
-                        ((items[1], "") in input_tags[osmtype])
-                        or ((items[1], items[3]) in input_tags[osmtype])
-                    ):
-                        self.dicosmfirst[osmtype].add(osmid)
-            elif "</way" in items[0]:
-                if not self.dicosmw[osmid]:
-                    del self.dicosmw[osmid]
-                    self.next_way_id += 1
-                    if osmid in self.dicosmfirst["w"]:
-                        self.dicosmfirst["w"].remove(osmid)
-                    if osmid in self.dicosmtags["w"]:
-                        del self.dicosmtags[osmtype][osmid]
-            elif "</relation>" in items[0]:
-                bad_rel = False
-                for role, endpt in (
-                    (r, e)
-                    for r in ["outer", "inner"]
-                    for e in dico_rel_check[r]
-                ):
-                    if len(dico_rel_check[role][endpt]) != 2:
-                        bad_rel = True
-                        break
-                if bad_rel == True:
-                    UI.lvprint(
-                        2,
-                        "Relation id=",
-                        osmid,
-                        "is ill formed and was not treated.",
-                    )
-                    del self.dicosmr[osmid]
-                    del self.dicosmrorig[osmid]
-                    del dico_rel_check
-                    self.next_rel_id += 1
-                    if osmid in self.dicosmfirst["r"]:
-                        self.dicosmfirst["r"].remove(osmid)
-                    if osmid in self.dicosmtags["r"]:
-                        del self.dicosmtags["r"][osmid]
-                    continue
-                for role in ["outer", "inner"]:
-                    while dico_rel_check[role]:
-                        nodeids = []
-                        endpt = next(iter(dico_rel_check[role]))
-                        wayid = dico_rel_check[role][endpt][0]
-                        endptinit = self.dicosmw[wayid][0]
-                        endpt1 = endptinit
-                        endpt2 = self.dicosmw[wayid][-1]
-                        for nodeid in self.dicosmw[wayid][:-1]:
-                            nodeids.append(nodeid)
-                        while endpt2 != endptinit:
-                            if dico_rel_check[role][endpt2][0] == wayid:
-                                wayid = dico_rel_check[role][endpt2][1]
-                            else:
-                                wayid = dico_rel_check[role][endpt2][0]
-                            endpt1 = endpt2
-                            if self.dicosmw[wayid][0] == endpt1:
-                                endpt2 = self.dicosmw[wayid][-1]
-                                for nodeid in self.dicosmw[wayid][:-1]:
-                                    nodeids.append(nodeid)
-                            else:
-                                endpt2 = self.dicosmw[wayid][0]
-                                for nodeid in self.dicosmw[wayid][-1:0:-1]:
-                                    nodeids.append(nodeid)
-                            del dico_rel_check[role][endpt1]
-                        nodeids.append(endptinit)
-                        self.dicosmr[osmid][role].append(nodeids)
-                        del dico_rel_check[role][endptinit]
-                if target_tags == None:
-                    for wayid in (
-                        self.dicosmrorig[osmid]["outer"]
-                        + self.dicosmrorig[osmid]["inner"]
-                    ):
-                        try:
-                            self.dicosmfirst["w"].remove(wayid)
-                        except:
-                            pass
-                if not self.dicosmr[osmid]["outer"]:
-                    del self.dicosmr[osmid]
-                    del self.dicosmrorig[osmid]
-                    self.next_rel_id += 1
-                    if osmid in self.dicosmfirst["r"]:
-                        self.dicosmfirst["r"].remove(osmid)
-                    if osmid in self.dicosmtags["r"]:
-                        del self.dicosmtags["r"][osmid]
-                del dico_rel_check
-            elif "</osm>" in items[0]:
-                normal_exit = True
-        pfile.close()
-        if not normal_exit:
-            UI.lvprint(
-                0,
-                "ERROR: OSM overpass server answer was corrupted ",
-                "(no ending </OSM> tag)",
+        # nodes, merged with the existing ones with the same coordinates
+        node_rows = self.dicosmn.add(
+            numpy.frombuffer(osm_data.node_coords).reshape(-1, 2)
+        )
+        node_map = osm_id_map(osm_data.node_ids)
+        for (idx, tags) in osm_data.tags["n"].items():
+            nodeid = -1 - int(node_rows[idx])
+            self.dicosmtags["n"].setdefault(nodeid, {}).update(tags)
+        for idx in osm_data.first["n"]:
+            self.dicosmfirst["n"].add(-1 - int(node_rows[idx]))
+        # ways, references to unknown nodes are dropped as well as the ways
+        # left without nodes
+        refs = node_map(numpy.frombuffer(osm_data.way_refs, dtype=numpy.int64))
+        lengths = numpy.diff(
+            numpy.append(
+                numpy.frombuffer(osm_data.way_starts, dtype=numpy.int64),
+                len(refs),
             )
-            return 0
+        )
+        ref_ways = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        lengths = numpy.bincount(ref_ways[refs >= 0], minlength=len(lengths))
+        way_ids = numpy.zeros(len(lengths), dtype=numpy.int64)
+        kept = numpy.flatnonzero(lengths)
+        way_ids[kept] = -1 - len(self.dicosmw) - numpy.arange(len(kept))
+        self.dicosmw.add(lengths[kept], node_rows[refs[refs >= 0]])
+        if not input_tags:
+            self.dicosmfirst["w"].update(way_ids[kept].tolist())
+        for (idx, tags) in osm_data.tags["w"].items():
+            if way_ids[idx]:
+                self.dicosmtags["w"][int(way_ids[idx])] = tags
+        for idx in osm_data.first["w"]:
+            if way_ids[idx]:
+                self.dicosmfirst["w"].add(int(way_ids[idx]))
+        # relations
+        way_map = osm_id_map(osm_data.way_ids)
+        for (idx, members) in enumerate(osm_data.rel_members):
+            wayids = way_map(numpy.array([ref for (ref, _) in members]))
+            members = [
+                (int(way_ids[wayid]), role)
+                for (wayid, (_, role)) in zip(wayids, members)
+                if wayid >= 0 and way_ids[wayid]
+            ]
+            osmid = self.next_rel_id
+            if not self.add_relation(osmid, members, target_tags):
+                UI.lvprint(
+                    2,
+                    "Relation id=",
+                    osm_data.rel_ids[idx],
+                    "is ill formed and was not treated.",
+                )
+                continue
+            if not self.dicosmr[osmid]["outer"]:
+                del self.dicosmr[osmid]
+                del self.dicosmrorig[osmid]
+                continue
+            self.next_rel_id -= 1
+            if not input_tags:
+                self.dicosmfirst["r"].add(osmid)
+            if idx in osm_data.tags["r"]:
+                self.dicosmtags["r"][osmid] = osm_data.tags["r"][idx]
+            if idx in osm_data.first["r"]:
+                self.dicosmfirst["r"].add(osmid)
         UI.vprint(
             2,
             "      A total of "
@@ -281,6 +246,76 @@ class OSM_layer:
         )
         return 1
 
+    def add_relation(self, osmid, members, target_tags):
+        # members are (wayid, role) with role 'outer' or 'inner', their ways
+        # are chained into closed rings of nodes.
+        self.dicosmr[osmid] = {"outer": [], "inner": []}
+        self.dicosmrorig[osmid] = {"outer": [], "inner": []}
+        dico_rel_check = {"inner": {}, "outer": {}}
+        for (wayid, role) in members:
+            self.dicosmrorig[osmid][role].append(wayid)
+            way = self.dicosmw[wayid]
+            endpt1 = way[0]
+            endpt2 = way[-1]
+            if endpt1 == endpt2:
+                self.dicosmr[osmid][role].append(way)
+            else:
+                if endpt1 in dico_rel_check[role]:
+                    dico_rel_check[role][endpt1].append(wayid)
+                else:
+                    dico_rel_check[role][endpt1] = [wayid]
+                if endpt2 in dico_rel_check[role]:
+                    dico_rel_check[role][endpt2].append(wayid)
+                else:
+                    dico_rel_check[role][endpt2] = [wayid]
+        for role, endpt in (
+            (r, e) for r in ["outer", "inner"] for e in dico_rel_check[r]
+        ):
+            if len(dico_rel_check[role][endpt]) != 2:
+                del self.dicosmr[osmid]
+                del self.dicosmrorig[osmid]
+                return 0
+        for role in ["outer", "inner"]:
+            while dico_rel_check[role]:
+                nodeids = []
+                endpt = next(iter(dico_rel_check[role]))
+                wayid = dico_rel_check[role][endpt][0]
+                way = self.dicosmw[wayid]
+                endptinit = way[0]
+                endpt1 = endptinit
+                endpt2 = way[-1]
+                for nodeid in way[:-1]:
+                    nodeids.append(nodeid)
+                while endpt2 != endptinit:
+                    if dico_rel_check[role][endpt2][0] == wayid:
+                        wayid = dico_rel_check[role][endpt2][1]
+                    else:
+                        wayid = dico_rel_check[role][endpt2][0]
+                    endpt1 = endpt2
+                    way = self.dicosmw[wayid]
+                    if way[0] == endpt1:
+                        endpt2 = way[-1]
+                        for nodeid in way[:-1]:
+                            nodeids.append(nodeid)
+                    else:
+                        endpt2 = way[0]
+                        for nodeid in way[-1:0:-1]:
+                            nodeids.append(nodeid)
+                    del dico_rel_check[role][endpt1]
+                nodeids.append(endptinit)
+                self.dicosmr[osmid][role].append(nodeids)
+                del dico_rel_check[role][endptinit]
+        if target_tags == None:
+            for wayid in (
+                self.dicosmrorig[osmid]["outer"]
+                + self.dicosmrorig[osmid]["inner"]
+            ):
+                try:
+                    self.dicosmfirst["w"].remove(wayid)
+                except:
+                    pass
+        return 1
+
     def write_to_file(self, filename):
         try:
             if filename[-4:] == ".bz2":
@@ -329,11 +364,11 @@ class OSM_layer:
                     )
                     for tag in self.dicosmtags["n"][nodeid]:
                         fout.write(
-                            '    <tag k="'
-                            + tag
-                            + '" v="'
-                            + self.dicosmtags["n"][nodeid][tag]
-                            + '"/>\n'
+                            '    <tag k='
+                            + quoteattr(tag)
+                            + ' v='
+                            + quoteattr(self.dicosmtags["n"][nodeid][tag])
+                            + '/>\n'
                         )
                     fout.write("  </node>\n")
         for wayid in tuple(self.dicosmfirst["w"]) + tuple(
@@ -348,11 +383,11 @@ class OSM_layer:
                 else []
             ):
                 fout.write(
-                    '    <tag k="'
-                    + tag
-                    + '" v="'
-                    + self.dicosmtags["w"][wayid][tag]
-                    + '"/>\n'
+                    '    <tag k='
+                    + quoteattr(tag)
+                    + ' v='
+                    + quoteattr(self.dicosmtags["w"][wayid][tag])
+                    + '/>\n'
                 )
             fout.write("  </way>\n")
         for relid in tuple(self.dicosmfirst["r"]) + tuple(
@@ -377,17 +412,331 @@ class OSM_layer:
                 else []
             ):
                 fout.write(
-                    '    <tag k="'
-                    + tag
-                    + '" v="'
-                    + self.dicosmtags["r"][relid][tag]
-                    + '"/>\n'
+                    '    <tag k='
+                    + quoteattr(tag)
+                    + ' v='
+                    + quoteattr(self.dicosmtags["r"][relid][tag])
+                    + '/>\n'
                 )
             fout.write("  </relation>\n")
         fout.write("</osm>")
         fout.close()
         return 1
 
+################################################################################
+class OSM_xml_data:
+    # Flat content of an OSM xml document, as gathered by parse_osm_xml. Nodes,
+    # ways and relations are refered to by their index in the document.
+    def __init__(self):
+        self.node_ids = array.array("q")
+        self.node_coords = array.array("d")
+        self.way_ids = array.array("q")
+        self.way_starts = array.array("q")
+        self.way_refs = array.array("q")
+        self.rel_ids = []
+        self.rel_members = []
+        self.tags = {"n": {}, "w": {}, "r": {}}
+        self.first = {"n": set(), "w": set(), "r": set()}
+
+
+def parse_osm_xml(osm_input, input_tags=None, target_tags=None):
+    # osm_input may either refer to an osm filename (e.g. cached data) or
+    # to a xml bytestring (direct download)
+    osm_data = OSM_xml_data()
+    keep_all = {}
+    for osmtype in ("n", "w", "r"):
+        keep_all[osmtype] = (not input_tags) or (
+            ("all", "") in target_tags[osmtype]
+        )
+    target_tags = {
+        t: set(target_tags[t]) if input_tags else set() for t in keep_all
+    }
+    input_tags = {
+        t: set(input_tags[t]) if input_tags else set() for t in keep_all
+    }
+    add_ref = osm_data.way_refs.append
+    add_node_id = osm_data.node_ids.append
+    add_node_coord = osm_data.node_coords.append
+    osm_ids = {
+        "n": osm_data.node_ids,
+        "w": osm_data.way_ids,
+        "r": osm_data.rel_ids,
+    }
+    # osm type of the current node, way or relation, which is the last one
+    # of its type
+    current = [None]
+
+    def start_element(name, attrs):
+        # attrs is the flat list of names and values (ordered_attributes)
+        if name == "nd":
+            add_ref(int(attrs[1]))
+        elif name == "node":
+            current[0] = "n"
+            if attrs[0:5:2] == ["id", "lat", "lon"]:  # Overpass order
+                (osmid, latp, lonp) = attrs[1:6:2]
+            else:
+                attrs = dict(zip(attrs[::2], attrs[1::2]))
+                (osmid, latp, lonp) = (attrs["id"], attrs["lat"], attrs["lon"])
+            add_node_id(int(osmid))
+            add_node_coord(float(lonp))
+            add_node_coord(float(latp))
+        elif name == "tag":
+            osmtype = current[0]
+            if osmtype is None:
+                return
+            idx = len(osm_ids[osmtype]) - 1
+            if attrs[0] == "k":
+                (k, v) = (attrs[1], attrs[3])
+            else:
+                (v, k) = (attrs[1], attrs[3])
+            # Do we need to catch that tag ?
+            if (
+                keep_all[osmtype]
+                or (k, "") in target_tags[osmtype]
+                or (k, v) in target_tags[osmtype]
+            ):
+                tags = osm_data.tags[osmtype]
+                if idx not in tags:
+                    tags[idx] = {}
+                tags[idx][sys.intern(k)] = sys.intern(v)
+                # If so, do we need to declare this osmid as a first catch, 
+                # not one only brought with as a child
+                if (k, "") in input_tags[osmtype] or (
+                    k,
+                    v,
+                ) in input_tags[osmtype]:
+                    osm_data.first[osmtype].add(idx)
+        elif name == "way":
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
+            current[0] = "w"
+            osm_data.way_ids.append(int(attrs["id"]))
+            osm_data.way_starts.append(len(osm_data.way_refs))
+        elif name == "relation":
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
+            current[0] = "r"
+            osm_data.rel_ids.append(int(attrs["id"]))
+            osm_data.rel_members.append([])
+        elif name == "member":
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
+            (osmtype, role) = (attrs.get("type"), attrs.get("role"))
+            if osmtype != "way" or role not in ("outer", "inner"):
+                if osmtype == "node":
+                    return  # not necessary to report these
+                UI.lvprint(
+                    2,
+                    "Relation id=",
+                    osm_data.rel_ids[-1],
+                    "contains a member of type",
+                    "'" + str(osmtype) + "'",
+                    "and role",
+                    "'" + str(role) + "'",
+                    "which was not treated (only deal with 'ways' of role ",
+                    "'inner' or 'outer').",
+                )
+                return
+            osm_data.rel_members[-1].append((int(attrs["ref"]), role))
+
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start_element
+    try:
+        if isinstance(osm_input, str):
+            try:
+                if osm_input[-4:] == ".bz2":
+                    pfile = bz2.open(osm_input, "rb")
+                else:
+                    pfile = open(osm_input, "rb")
+            except:
+                UI.vprint(
+                    1,
+                    "    Could not open",
+                    osm_input,
+                    "for reading (corrupted ?).",
+                )
+                return None
+            with pfile:
+                for chunk in iter(lambda: pfile.read(2 ** 20), b""):
+                    parser.Parse(chunk, False)
+            parser.Parse(b"", True)
+        else:
+            parser.Parse(osm_input, True)
+    except (expat.ExpatError, OSError, EOFError):
+        # expat only accepts complete documents
+        UI.lvprint(
+            0,
+            "ERROR: OSM overpass server answer was corrupted ",
+            "(no ending </OSM> tag)",
+        )
+        return None
+    return osm_data
+
+
+def osm_id_map(osm_ids):
+    # Maps osm ids to their index in osm_ids (the last one if repeated),
+    # or -1 for unknown ones.
+    osm_ids = numpy.frombuffer(osm_ids, dtype=numpy.int64)
+    order = numpy.argsort(osm_ids, kind="stable")
+    sorted_ids = osm_ids[order]
+
+    def id_map(refs):
+        refs = numpy.asarray(refs, dtype=numpy.int64)
+        if not len(sorted_ids):
+            return numpy.full(len(refs), -1, dtype=numpy.int64)
+        pos = numpy.searchsorted(sorted_ids, refs, side="right") - 1
+        found = (pos >= 0) & (sorted_ids[numpy.maximum(pos, 0)] == refs)
+        return numpy.where(found, order[numpy.maximum(pos, 0)], -1)
+
+    return id_map
+
+################################################################################
+# Binary copies of the OSM cache files : the content of an OSM_xml_data as
+# NumPy arrays in an uncompressed npz, which loads much faster than the xml
+# parses. It records the query tags it was filtered with and the size and
+# date of the xml file, and is rebuilt from the xml as soon as one of them
+# changes (e.g. when the xml was edited in JOSM).
+################################################################################
+osm_cache_format = 1
+
+
+def osm_tags_signature(input_tags, target_tags):
+    if not input_tags:
+        return "all"
+    return repr(
+        [
+            sorted(set(tags[osmtype]))
+            for tags in (input_tags, target_tags)
+            for osmtype in ("n", "w", "r")
+        ]
+    )
+
+
+def osm_file_signature(osm_file_name):
+    stat = os.stat(osm_file_name)
+    return numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+def osm_data_to_arrays(osm_data):
+    arrays = {
+        "node_ids": numpy.frombuffer(osm_data.node_ids, dtype=numpy.int64),
+        "node_coords": numpy.frombuffer(osm_data.node_coords),
+        "way_ids": numpy.frombuffer(osm_data.way_ids, dtype=numpy.int64),
+        "way_starts": numpy.frombuffer(osm_data.way_starts, dtype=numpy.int64),
+        "way_refs": numpy.frombuffer(osm_data.way_refs, dtype=numpy.int64),
+        "rel_ids": numpy.array(osm_data.rel_ids, dtype=numpy.int64),
+        "rel_lengths": numpy.array(
+            [len(members) for members in osm_data.rel_members],
+            dtype=numpy.int64,
+        ),
+        "rel_refs": numpy.array(
+            [ref for members in osm_data.rel_members for (ref, _) in members],
+            dtype=numpy.int64,
+        ),
+        "rel_inner": numpy.array(
+            [
+                role == "inner"
+                for members in osm_data.rel_members
+                for (_, role) in members
+            ],
+            dtype=bool,
+        ),
+    }
+    # tags as (index, key, value) rows, the strings going to a single table
+    strings = {}
+    for osmtype in ("n", "w", "r"):
+        rows = []
+        for (idx, tags) in osm_data.tags[osmtype].items():
+            for (k, v) in tags.items():
+                rows.append(
+                    (
+                        idx,
+                        strings.setdefault(k, len(strings)),
+                        strings.setdefault(v, len(strings)),
+                    )
+                )
+        arrays["tags_" + osmtype] = numpy.array(
+            rows, dtype=numpy.int64
+        ).reshape(-1, 3)
+        arrays["first_" + osmtype] = numpy.array(
+            sorted(osm_data.first[osmtype]), dtype=numpy.int64
+        )
+    arrays["strings"] = numpy.frombuffer(
+        "\0".join(strings).encode(), dtype=numpy.uint8
+    )
+    return arrays
+
+
+def osm_data_from_arrays(arrays):
+    osm_data = OSM_xml_data()
+    for attr in ("node_ids", "node_coords", "way_ids", "way_starts"):
+        setattr(osm_data, attr, arrays[attr])
+    osm_data.way_refs = arrays["way_refs"]
+    osm_data.rel_ids = arrays["rel_ids"].tolist()
+    rel_refs = arrays["rel_refs"].tolist()
+    rel_roles = numpy.where(arrays["rel_inner"], "inner", "outer").tolist()
+    bounds = [0] + numpy.cumsum(arrays["rel_lengths"]).tolist()
+    osm_data.rel_members = [
+        list(zip(rel_refs[start:end], rel_roles[start:end]))
+        for (start, end) in zip(bounds[:-1], bounds[1:])
+    ]
+    strings = arrays["strings"].tobytes().decode().split("\0")
+    strings = [sys.intern(string) for string in strings]
+    for osmtype in ("n", "w", "r"):
+        tags = osm_data.tags[osmtype]
+        for (idx, k, v) in arrays["tags_" + osmtype].tolist():
+            if idx not in tags:
+                tags[idx] = {}
+            tags[idx][strings[k]] = strings[v]
+        osm_data.first[osmtype] = set(arrays["first_" + osmtype].tolist())
+    return osm_data
+
+
+def write_osm_cache(cache_file_name, osm_data, osm_file_name, signature):
+    arrays = osm_data_to_arrays(osm_data)
+    arrays["format"] = numpy.array([osm_cache_format])
+    arrays["signature"] = numpy.frombuffer(
+        signature.encode(), dtype=numpy.uint8
+    )
+    arrays["source"] = osm_file_signature(osm_file_name)
+    try:
+        with open(cache_file_name + ".tmp", "wb") as f:
+            numpy.savez(f, **arrays)
+        os.replace(cache_file_name + ".tmp", cache_file_name)
+    except:
+        UI.vprint(1, "    Could not write", cache_file_name)
+        return 0
+    return 1
+
+
+def read_osm_cache(cache_file_name, osm_file_name, signature):
+    # None unless the binary copy is valid for the xml file and the tags
+    if not os.path.isfile(cache_file_name):
+        return None
+    try:
+        with numpy.load(cache_file_name, allow_pickle=False) as npz:
+            arrays = dict(npz)
+        if (
+            arrays["format"][0] != osm_cache_format
+            or arrays["signature"].tobytes().decode() != signature
+            or (arrays["source"] != osm_file_signature(osm_file_name)).any()
+        ):
+            return None
+    except:
+        return None
+    return osm_data_from_arrays(arrays)
+
+
+def read_cached_osm_data(osm_file_name, input_tags, target_tags):
+    # Transparently migrates the xml only caches of former versions
+    cache_file_name = FNAMES.osm_binary_cached(osm_file_name)
+    signature = osm_tags_signature(input_tags, target_tags)
+    osm_data = read_osm_cache(cache_file_name, osm_file_name, signature)
+    if osm_data is not None:
+        return osm_data
+    osm_data = parse_osm_xml(osm_file_name, input_tags, target_tags)
+    if osm_data is not None:
+        write_osm_cache(cache_file_name, osm_data, osm_file_name, signature)
+    return osm_data
+
 ################################################################################
 def OSM_queries_to_OSM_layer(
     queries,
@@ -422,23 +771,56 @@ def OSM_queries_to_OSM_layer(
     cached_data_filename = FNAMES.osm_cached(lat, lon, cached_suffix)
     if cached_suffix and os.path.isfile(cached_data_filename):
         UI.vprint(1, "    * Recycling OSM data from", cached_data_filename)
-        return osm_layer.update_dicosm(
+        return osm_layer.update_dicosm_from_cache(
             cached_data_filename, input_tags, target_tags
         )
-    for query in queries:
+    # late import, O4_OSM_Extracts depends on this module
+    import O4_OSM_Extracts as EXTRACTS
+
+    extract = EXTRACTS.store_for_bbox((lat, lon, lat + 1, lon + 1))
+    # all the downloads are started at once, their answers are then merged
+    # in the order of the queries
+    downloads = {}
+    local = {}
+    for (i, query) in enumerate(queries):
         # look first for cached data (old scheme)
-        if isinstance(query, str):
-            old_cached_data_filename = FNAMES.osm_old_cached(lat, lon, query)
-            if os.path.isfile(old_cached_data_filename):
-                UI.vprint(1, "    * Recycling OSM data for", query)
-                osm_layer.update_dicosm(
-                    old_cached_data_filename, input_tags, target_tags
-                )
+        if isinstance(query, str) and os.path.isfile(
+            FNAMES.osm_old_cached(lat, lon, query)
+        ):
+            continue
+        if extract and EXTRACTS.store_answers(extract, query):
+            osm_data = EXTRACTS.query_osm_data(
+                extract,
+                query,
+                (lat, lon, lat + 1, lon + 1),
+                input_tags,
+                target_tags,
+            )
+            if osm_data is not None:
+                local[i] = osm_data
                 continue
         UI.vprint(1, "    * Downloading OSM data for", query)
-        response = get_overpass_data(
-            query, (lat, lon, lat + 1, lon + 1), server_code
+        downloads[i] = AIO.run(
+            get_overpass_data_async(
+                query, (lat, lon, lat + 1, lon + 1), server_code
+            )
         )
+    for (i, query) in enumerate(queries):
+        if i in local:
+            UI.vprint(1, "    * Reading OSM data for", query, "from", extract)
+            osm_layer.merge_osm_data(local[i], input_tags, target_tags)
+            continue
+        if i not in downloads:
+            UI.vprint(1, "    * Recycling OSM data for", query)
+            osm_layer.update_dicosm(
+                FNAMES.osm_old_cached(lat, lon, query), input_tags, target_tags
+            )
+            continue
+        response = downloads[i].result()
+        if UI.red_flag or not response:
+            # the pending downloads would otherwise go on in the background
+            for download in downloads.values():
+                download.cancel()
         if UI.red_flag:
             return 0
         if not response:
@@ -489,7 +871,22 @@ def OSM_query_to_OSM_layer(
                 target_tags[osm_type].append(tag)
     if cached_file_name and os.path.isfile(cached_file_name):
         UI.vprint(1, "    * Recycling OSM data from", cached_file_name)
-        osm_layer.update_dicosm(cached_file_name, input_tags, target_tags)
+        osm_layer.update_dicosm_from_cache(
+            cached_file_name, input_tags, target_tags
+        )
+        return 1
+    # late import, O4_OSM_Extracts depends on this module
+    import O4_OSM_Extracts as EXTRACTS
+
+    extract = EXTRACTS.store_for_bbox(bbox)
+    osm_data = None
+    if extract and EXTRACTS.store_answers(extract, query):
+        osm_data = EXTRACTS.query_osm_data(
+            extract, query, bbox, input_tags, target_tags
+        )
+    if osm_data is not None:
+        UI.vprint(1, "    * Reading OSM data for", query, "from", extract)
+        osm_layer.merge_osm_data(osm_data, input_tags, target_tags)
     else:
         response = get_overpass_data(query, bbox, server_code)
         if UI.red_flag:
@@ -510,31 +907,84 @@ def OSM_query_to_OSM_layer(
     return 1
 
 ################################################################################
-def get_overpass_data(query, bbox, server_code=None):
+# Overpass requests run on the shared asyncio loop of O4_Async_Utils, so that
+# the queries of a layer (and the layers of a tile) are downloaded at once
+# through pooled connections. Each server has a health score, which drops on
+# failures and recovers with successes, and a cool down date (after 429/504
+# answers or refused connections) : requests go to the configured server as
+# long as it is healthy, otherwise (or with "random") to a server drawn
+# according to the scores. Waits between tentatives are jittered and only
+# suspend the request concerned.
+################################################################################
+max_overpass_requests = 2  # per server, Overpass itself allows few slots
+overpass_timeout = (30, 60)  # connect, read : big answers take long to stream
+overpass_health = {}
+overpass_cool_down = {}
+
+
+def pick_overpass_server(server_code=None):
+    if server_code:
+        return server_code
+    now = time.monotonic()
+    if (
+        overpass_server_choice in overpass_servers
+        and overpass_health.get(overpass_server_choice, 1) >= 0.5
+        and overpass_cool_down.get(overpass_server_choice, 0) <= now
+    ):
+        return overpass_server_choice
+    codes = [
+        code
+        for code in overpass_servers
+        if overpass_cool_down.get(code, 0) <= now
+    ]
+    if not codes:
+        return min(overpass_servers, key=lambda c: overpass_cool_down[c])
+    return random.choices(
+        codes, [0.05 + overpass_health.get(code, 1) for code in codes]
+    )[0]
+
+
+def update_overpass_health(server_code, success, cool_down=0):
+    health = overpass_health.get(server_code, 1)
+    if success:
+        overpass_health[server_code] = 0.8 * health + 0.2
+    else:
+        overpass_health[server_code] = 0.5 * health
+    if cool_down:
+        overpass_cool_down[server_code] = time.monotonic() + cool_down
+
+
+async def get_overpass_data_async(query, bbox, server_code=None):
+    if isinstance(query, str):
+        overpass_query = query + str(bbox) + ";"
+    else:  # query is a tuple
+        overpass_query = "".join([x + str(bbox) + ";" for x in query])
     tentative = 1
     while True:
-        s = requests.Session()
-        true_server_code = server_code
-        if not server_code:
-            true_server_code = (
-                random.choice(list(overpass_servers.keys()))
-                if overpass_server_choice == "random"
-                else overpass_server_choice
-            )
+        true_server_code = pick_overpass_server(server_code)
+        server_limiter = AIO.get_limiter(
+            "overpass_" + true_server_code, max_overpass_requests
+        )
+        delay = overpass_cool_down.get(true_server_code, 0) - time.monotonic()
+        if delay > 0:
+            # all servers cool down (or a server was imposed), Retry-After
+            # answers must be honoured nevertheless
+            await asyncio.sleep(delay)
         base_url = overpass_servers[true_server_code]
-        if isinstance(query, str):
-            overpass_query = query + str(bbox) + ";"
-        else:  # query is a tuple
-            overpass_query = "".join([x + str(bbox) + ";" for x in query])
         url = base_url + "?data=(" + overpass_query + ");(._;>>;);out meta;"
         UI.vprint(3, url)
+        wait = min(64, 2 ** tentative)
         try:
-            r = s.get(url, timeout=60)
-            UI.vprint(3, "OSM response status :", r)
-            if "200" in str(r):
+            with STATS.timer("osm_download"):
+                (status, headers, content) = await AIO.http_get(
+                    url, None, overpass_timeout, server_limiter
+                )
+            STATS.count("osm_bytes", len(content))
+            UI.vprint(3, "OSM response status :", status)
+            if status == 200:
                 if (
-                    b"</osm>" not in r.content[-10:]
-                    and b"</OSM>" not in r.content[-10:]
+                    b"</osm>" not in content[-10:]
+                    and b"</OSM>" not in content[-10:]
                 ):
                     UI.vprint(
                         1,
@@ -542,46 +992,73 @@ def get_overpass_data(query, bbox, server_code=None):
                         true_server_code,
                         "sent a corrupted answer (no closing </osm> tag in ",
                         "answer), new tentative in",
-                        2 ** tentative,
-                        "sec...",
+                        wait,
+                        "sec at most...",
                     )
-                elif len(r.content) <= 1000 and b"error" in r.content:
+                    update_overpass_health(true_server_code, False)
+                elif len(content) <= 1000 and b"error" in content:
                     UI.vprint(
                         1,
                         "        OSM server",
                         true_server_code,
                         "sent us an error code for the data (data too big ?), ",
                         "new tentative in",
-                        2 ** tentative,
-                        "sec...",
+                        wait,
+                        "sec at most...",
                     )
+                    update_overpass_health(true_server_code, False)
                 else:
-                    break
+                    update_overpass_health(true_server_code, True)
+                    return content
+            elif status in (429, 503, 504):
+                try:
+                    cool_down = float(headers.get("Retry-After"))
+                except:
+                    cool_down = wait
+                UI.vprint(
+                    1,
+                    "        OSM server",
+                    true_server_code,
+                    "is overloaded (status " + str(status) + "),",
+                    "new tentative in",
+                    wait,
+                    "sec at most...",
+                )
+                update_overpass_health(true_server_code, False, cool_down)
             else:
                 UI.vprint(
                     1,
                     "        OSM server",
                     true_server_code,
                     "rejected our query, new tentative in",
-                    2 ** tentative,
-                    "sec...",
+                    wait,
+                    "sec at most...",
                 )
-        except:
+                update_overpass_health(true_server_code, False)
+        except Exception as e:
+            if not AIO.is_connection_error(e):
+                raise
             UI.vprint(
                 1,
                 "        OSM server",
                 true_server_code,
                 "was too busy, new tentative in",
-                2 ** tentative,
-                "sec...",
+                wait,
+                "sec at most...",
             )
+            update_overpass_health(true_server_code, False, wait)
         if tentative >= max_osm_tentatives:
             return 0
         if UI.red_flag:
             return 0
-        time.sleep(2 ** tentative)
+        await AIO.backoff(tentative, base=1, cap=64)
+        if UI.red_flag:
+            return 0
         tentative += 1
-    return r.content
+
+
+def get_overpass_data(query, bbox, server_code=None):
+    return AIO.run(get_overpass_data_async(query, bbox, server_code)).result()
 
 ################################################################################
 def OSM_to_MultiLineString(
@@ -606,13 +1083,7 @@ def OSM_to_MultiLineString(
             done += 1
             continue
         way = numpy.round(
-            numpy.array(
-                [
-                    osm_layer.dicosmn[nodeid]
-                    for nodeid in osm_layer.dicosmw[wayid]
-                ],
-                dtype=numpy.float64,
-            )
+            osm_layer.way_coords(wayid)
             - numpy.array([[lon, lat]], dtype=numpy.float64),
             7,
         )
@@ -649,22 +1120,17 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
     for wayid in osm_layer.dicosmfirst["w"]:
         if done % step == 0:
             UI.progress_bar(1, int(100 * done / todo))
-        if osm_layer.dicosmw[wayid][0] != osm_layer.dicosmw[wayid][-1]:
+        node_rows = osm_layer.dicosmw.node_rows(wayid)
+        if node_rows[0] != node_rows[-1]:
             UI.logprint(
                 "Non closed way starting at",
-                osm_layer.dicosmn[osm_layer.dicosmw[wayid][0]],
+                osm_layer.dicosmn[-1 - int(node_rows[0])],
                 ", skipped.",
             )
             done += 1
             continue
         way = numpy.round(
-            numpy.array(
-                [
-                    osm_layer.dicosmn[nodeid]
-                    for nodeid in osm_layer.dicosmw[wayid]
-                ],
-                dtype=numpy.float64,
-            )
+            osm_layer.way_coords(wayid)
             - numpy.array([[lon, lat]], dtype=numpy.float64),
             7,
         )
@@ -675,7 +1141,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             if not pol.is_valid:
                 UI.logprint(
                     "Invalid OSM way starting at",
-                    osm_layer.dicosmn[osm_layer.dicosmw[wayid][0]],
+                    osm_layer.dicosmn[-1 - int(node_rows[0])],
                     ", skipped.",
                 )
                 done += 1
@@ -696,10 +1162,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             multiout = [
                 geometry.Polygon(
                     numpy.round(
-                        numpy.array(
-                            [osm_layer.dicosmn[nodeid] for nodeid in nodelist],
-                            dtype=numpy.float64,
-                        )
+                        osm_layer.nodes_coords(nodelist)
                         - numpy.array([lon, lat], dtype=numpy.float64),
                         7,
                     )
@@ -712,10 +1175,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             multiin = [
                 geometry.Polygon(
                     numpy.round(
-                        numpy.array(
-                            [osm_layer.dicosmn[nodeid] for nodeid in nodelist],
-                            dtype=numpy.float64,
-                        )
+                        osm_layer.nodes_coords(nodelist)
                         - numpy.array([lon, lat], dtype=numpy.float64),
                         7,
                     )
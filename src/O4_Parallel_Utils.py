@@ -1,4 +1,6 @@
+import time
 import threading
+from concurrent.futures import wait, FIRST_COMPLETED
 import O4_UI_Utils as UI
 
 ################################################################################
@@ -61,4 +63,56 @@ def parallel_launch(task, queue, nbr_workers, progress=None):
 ################################################################################
 def parallel_join(workers):
     for worker in workers:
-        worker.join()
\ No newline at end of file
+        worker.join()
+
+################################################################################
+def parallel_dag_execute(jobs, pools, executor, on_done=None, stop_event=None):
+    # jobs is a dict key -> (task, args, pool, deps, after) where the jobs in
+    # deps must have succeeded and those in after must only be finished 
+    # (whatever their outcome) before the job can start. pools is a dict
+    # pool -> number of slots, at most that many jobs of a given pool are
+    # submitted to the executor simultaneously. Jobs are considered in the
+    # order of the dict. Returns a dict key -> 1 (success), 0 (failure) or 
+    # None (skipped because of a failed dependency or of an interruption).
+    results = {}
+    running = {}
+    busy = {pool: 0 for pool in pools}
+    todo = list(jobs)
+    while True:
+        progress = True
+        while progress and not UI.red_flag:
+            progress = False
+            for key in list(todo):
+                (task, args, pool, deps, after) = jobs[key]
+                if not all(dep in results for dep in deps + after):
+                    continue
+                if not all(results[dep] for dep in deps):
+                    results[key] = None
+                    todo.remove(key)
+                    progress = True
+                    if on_done:
+                        on_done(key, None, 0)
+                elif busy[pool] < pools[pool]:
+                    future = executor.submit(task, *args)
+                    running[future] = (key, time.time())
+                    busy[pool] += 1
+                    todo.remove(key)
+                    progress = True
+        if not running:
+            break
+        (done, _) = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            (key, timer) = running.pop(future)
+            busy[jobs[key][2]] -= 1
+            try:
+                results[key] = 1 if future.result() else 0
+            except Exception as e:
+                UI.vprint(2, e)
+                results[key] = 0
+            if on_done:
+                on_done(key, results[key], time.time() - timer)
+        if UI.red_flag and stop_event and not stop_event.is_set():
+            stop_event.set()
+    for key in todo:
+        results[key] = None
+    return results
@@ -0,0 +1,428 @@
+import time
+import numpy
+import O4_UI_Utils as UI
+
+has_scipy = False
+try:
+    from scipy import ndimage
+
+    has_scipy = True
+except:
+    pass
+
+################################################################################
+# Conditioning of elevation rasters : upsampling of coarser data and filling
+# of voids (nodata) with the value of the nearest valid pixel. Both work on
+# whole arrays at once, voids are filled in a single pass through a distance
+# transform (scipy) or, without scipy, through the same exact two-pass
+# Euclidean transform computed with numpy.
+#
+# Separable box and hat filters (DEM smoothing over airports, sand masks) are
+# computed with running sums, their cost does not depend on the width of the
+# kernel. Bands of band_lines lines are treated at once to bound the size of
+# the temporaries, the result can be written in place.
+#
+# Triangles (water masks) are rasterized all together : each of them is cut
+# into one span of pixels per row, computed with exact integer arithmetic,
+# and spans are drawn by blocks of rows as +1/-1 at their ends followed by a
+# cumulative sum along the rows.
+################################################################################
+
+band_lines = 256
+max_spans = 2 ** 22  # spans computed at once when rasterizing
+
+################################################################################
+def upsample(raster, factor=3):
+    # Bilinear interpolation on the grid points, (ny,nx) -> ((ny-1)*factor+1,
+    # (nx-1)*factor+1), e.g. 1201x1201 (3") to 3601x3601 (1"). Being
+    # separable, it is done along the rows first and then along the columns,
+    # each phase (offset from the source grid) of the output at once.
+    raster = numpy.asarray(raster, dtype=numpy.float32)
+    (ny, nx) = raster.shape
+    rows = numpy.empty((ny, (nx - 1) * factor + 1), dtype=numpy.float32)
+    out = numpy.empty(((ny - 1) * factor + 1, rows.shape[1]), numpy.float32)
+    for k in range(factor):
+        interpolate(
+            raster[:, :-1], raster[:, 1:], k / factor, rows[:, k:-1:factor]
+        )
+    rows[:, -1] = raster[:, -1]
+    for k in range(factor):
+        interpolate(rows[:-1], rows[1:], k / factor, out[k:-1:factor])
+    out[-1] = rows[-1]
+    return out
+
+
+################################################################################
+def interpolate(a, b, t, out):
+    # out = (1-t)*a + t*b without temporaries
+    numpy.multiply(a, numpy.float32(1 - t), out=out)
+    if t:
+        out += numpy.float32(t) * b
+
+
+################################################################################
+def fill_nodata(raster, nodata):
+    # In place, returns 0 if there is no valid data to fill from.
+    void = raster == nodata
+    if not void.any():
+        return 1
+    if void.all():
+        return 0
+    UI.vprint(
+        2,
+        "    INFO: Elevation file contains",
+        int(void.sum()),
+        "voids, filling them by nearest neighbour.",
+    )
+    # The nearest valid pixel of a void lies at worst on the border of the
+    # bounding box of the voids grown by one pixel, we only work there.
+    rows = numpy.nonzero(void.any(axis=1))[0]
+    cols = numpy.nonzero(void.any(axis=0))[0]
+    (y0, y1) = (max(rows[0] - 1, 0), min(rows[-1] + 2, raster.shape[0]))
+    (x0, x1) = (max(cols[0] - 1, 0), min(cols[-1] + 2, raster.shape[1]))
+    window = raster[y0:y1, x0:x1]
+    void = void[y0:y1, x0:x1]
+    if has_scipy:
+        (iy, ix) = ndimage.distance_transform_edt(
+            void, return_distances=False, return_indices=True
+        )
+    else:
+        (iy, ix) = nearest_valid(void)
+    window[void] = window[iy[void], ix[void]]
+    UI.vprint(2, "    Done.")
+    return 1
+
+
+################################################################################
+def nearest_valid(void):
+    # Indices of the nearest valid pixel, exact as the distance transform :
+    # the nearest valid pixel along each column first, then along each row
+    # the lower envelope of the parabolas (x-x')**2 + col_dist(x')**2
+    # (Felzenszwalb and Huttenlocher), built for all the rows at once while
+    # going through the columns. Intersections of parabolas are kept as
+    # integer fractions, hence compared exactly.
+    (ny, nx) = void.shape
+    if nx > ny:
+        (ix, iy) = nearest_valid(void.T)
+        return (iy.T, ix.T)
+    (col_idx, col_dist) = nearest_along_axis(void, 0)
+    # a column has a valid pixel for all its rows or for none
+    cols = numpy.flatnonzero(col_dist[0] != numpy.iinfo(numpy.int32).max)
+    f = col_dist.astype(numpy.int64) ** 2
+    f += numpy.arange(nx, dtype=numpy.int64) ** 2
+    # per row, the envelope is made of the parabolas of the columns v[:k+1],
+    # that of v[i] being the lowest from z[i] = znum[i]/zden[i] (z[0] is
+    # -infinity) on. The arrays are accessed through flat indices, row*nx+i.
+    v = numpy.full(ny * nx, cols[0], dtype=numpy.int64)
+    znum = numpy.zeros(ny * nx, dtype=numpy.int64)
+    zden = numpy.ones(ny * nx, dtype=numpy.int64)
+    f = f.ravel()
+    k = numpy.zeros(ny, dtype=numpy.int64)
+    rows = numpy.arange(ny)
+    for q in cols[1:].tolist():
+        todo = rows[k > 0]
+        while len(todo):
+            top = todo * nx + k[todo]
+            (num, den) = intersection(f, v, todo * nx, top, q)
+            todo = todo[num * zden[top] <= znum[top] * den]
+            k[todo] -= 1
+            todo = todo[k[todo] > 0]
+        (num, den) = intersection(f, v, rows * nx, rows * nx + k, q)
+        k += 1
+        top = rows * nx + k
+        (v[top], znum[top], zden[top]) = (q, num, den)
+    (v, znum, zden) = (
+        v.reshape(ny, nx),
+        znum.reshape(ny, nx),
+        zden.reshape(ny, nx),
+    )
+    # the lowest parabola over each column : v[i] from the first x > z[i] on
+    in_envelope = numpy.arange(nx) <= k[:, None]
+    starts = numpy.clip(znum // zden + 1, 0, nx)
+    starts[:, 0] = 0
+    starts = starts[in_envelope]
+    ends = numpy.append(starts[1:], 0)
+    ends[numpy.cumsum(k + 1) - 1] = nx
+    ix = numpy.repeat(v[in_envelope], ends - starts).reshape(ny, nx)
+    iy = col_idx[rows[:, None], ix]
+    ix = ix.astype(numpy.int32)
+    return (iy, ix)
+
+
+def intersection(f, v, starts, top, q):
+    # Abscissa of the intersection of the parabolas of the columns v[top] and
+    # q, as (numerator, positive denominator), starts are the flat indices of
+    # the rows.
+    vk = v[top]
+    return (f[starts + q] - f[starts + vk], 2 * (q - vk))
+
+
+################################################################################
+def nearest_along_axis(void, axis):
+    # Index (along axis) of the nearest valid pixel and its distance, the
+    # largest int32 if there is none.
+    n = void.shape[axis]
+    positions = numpy.arange(n, dtype=numpy.int32)
+    positions = positions[:, None] if axis == 0 else positions[None, :]
+    before = numpy.maximum.accumulate(
+        numpy.where(void, numpy.int32(-1), positions), axis=axis
+    )
+    after = numpy.flip(
+        numpy.minimum.accumulate(
+            numpy.flip(numpy.where(void, numpy.int32(2 * n), positions), axis),
+            axis=axis,
+        ),
+        axis,
+    )
+    dist_before = numpy.where(before >= 0, positions - before, 2 * n)
+    dist_after = after - positions
+    idx = numpy.where(dist_before <= dist_after, before, after)
+    dist = numpy.minimum(dist_before, dist_after)
+    dist[dist >= n] = numpy.iinfo(numpy.int32).max
+    return (idx, dist)
+
+
+################################################################################
+def box_filter(array, radius, out=None):
+    # Mean over the (2*radius+1)x(2*radius+1) square around each pixel, with
+    # zero padding.
+    return separable_filter(array, [(radius, radius)], out)
+
+
+################################################################################
+def hat_filter(array, width, out=None):
+    # Convolution with the normalized hat kernel 1,2,...,width,...,2,1 along
+    # each axis (i.e. two boxes of length width), with zero padding.
+    return separable_filter(array, [(width - 1, 0), (0, width - 1)], out)
+
+
+################################################################################
+def separable_filter(array, boxes, out=None):
+    # boxes is a list of (before, after) extents of boxes applied in turn
+    # along each axis. The result goes to out (float32 by default, which may
+    # be array itself). With an integer out, sums are exact and each axis pass
+    # is floored, as a cast of the float convolution would.
+    if out is None:
+        out = numpy.empty(array.shape, dtype=numpy.float32)
+    norm = 1
+    for (before, after) in boxes:
+        norm *= before + after + 1
+    # The band is padded with zeros so that intermediate boxes do see the
+    # data of their neighbours beyond the edges.
+    pad_before = sum(before for (before, after) in boxes)
+    pad_after = sum(after for (before, after) in boxes)
+    integer = numpy.issubdtype(out.dtype, numpy.integer)
+    accumulator = numpy.float64
+    if integer:
+        # int32 is faster and enough for masks
+        bound = (abs(int(array.max())) + abs(int(array.min()))) * norm
+        accumulator = (
+            numpy.int32
+            if bound * (max(array.shape) + pad_before + pad_after) < 2 ** 31
+            else numpy.int64
+        )
+    # Running sums are (much) faster along the last axis, columns are
+    # therefore treated by transposed bands.
+    for (source, target) in ((array, out), (out.T, out.T)):
+        length = source.shape[1]
+        for start in range(0, source.shape[0], band_lines):
+            lines = source[start : start + band_lines]
+            tmp = numpy.zeros(
+                (len(lines), pad_before + length + pad_after), accumulator
+            )
+            tmp[:, pad_before : pad_before + length] = lines
+            for (before, after) in boxes:
+                tmp = running_sum(tmp, before, after)
+            tmp = tmp[:, pad_before : pad_before + length]
+            if integer:
+                tmp //= norm
+            else:
+                tmp /= norm
+            target[start : start + band_lines] = tmp
+    return out
+
+
+################################################################################
+def running_sum(array, before, after):
+    # Sum of array[..., i-before] to array[..., i+after], zero padded. The
+    # cumulative sum is padded with before zeros and after copies of the
+    # total, so that the result is a difference of two of its slices.
+    length = array.shape[-1]
+    padded = numpy.empty(
+        array.shape[:-1] + (length + 1 + before + after,), dtype=array.dtype
+    )
+    padded[..., : before + 1] = 0
+    numpy.cumsum(array, axis=-1, out=padded[..., before + 1 : before + 1 + length])
+    padded[..., before + 1 + length :] = padded[..., before + length, None]
+    return padded[..., before + after + 1 :] - padded[..., :length]
+
+
+################################################################################
+def triangles_coverage(tris, shape):
+    # tris is a (n,3,2) array of integer pixel coordinates (x,y), returns
+    # a boolean array of the given shape, True at the pixels filled by at
+    # least one triangle. Rows of a triangle are filled between the rounded
+    # crossings of its edges, as PIL's polygon fill does.
+    (height, width) = shape
+    cover = numpy.zeros(shape, dtype=bool)
+    tris = numpy.asarray(tris, dtype=numpy.int64).reshape(-1, 3, 2)
+    (xs, ys) = (tris[:, :, 0], tris[:, :, 1])
+    keep = (
+        (xs.max(axis=1) >= 0)
+        & (xs.min(axis=1) < width)
+        & (ys.max(axis=1) >= 0)
+        & (ys.min(axis=1) < height)
+    )
+    tris = tris[keep]
+    if not len(tris):
+        return cover
+    # vertices sorted from top to bottom
+    order = numpy.argsort(tris[:, :, 1], axis=1, kind="stable")
+    tris = numpy.take_along_axis(tris, order[:, :, None], axis=1)
+    rows = numpy.minimum(tris[:, 2, 1], height - 1) - numpy.maximum(
+        tris[:, 0, 1], 0
+    )
+    # Groups of triangles with at most max_spans spans (or a single one)
+    bounds = numpy.cumsum(rows + 1)
+    start = 0
+    while start < len(tris):
+        limit = bounds[start] - rows[start] - 1 + max_spans
+        stop = max(
+            int(numpy.searchsorted(bounds, limit, side="right")), start + 1
+        )
+        (y, x0, x1) = triangle_spans(tris[start:stop], height)
+        x0 = numpy.maximum(x0, 0)
+        x1 = numpy.minimum(x1, width - 1)
+        keep = x0 <= x1
+        draw_spans(cover, y[keep], x0[keep], x1[keep])
+        start = stop
+    return cover
+
+
+################################################################################
+def triangle_spans(tris, height):
+    # One (y, x0, x1) span per row of the triangles (with vertices sorted by
+    # y) within [0, height). Each triangle is split at its middle vertex in
+    # an upper and a lower part, bounded by the long edge on one side and by
+    # a single short edge on the other.
+    (xa, ya) = (tris[:, 0, 0], tris[:, 0, 1])
+    (xb, yb) = (tris[:, 1, 0], tris[:, 1, 1])
+    (xc, yc) = (tris[:, 2, 0], tris[:, 2, 1])
+    # rows [top, bottom) of the upper part and [bottom, end) of the lower one
+    top = numpy.clip(ya, 0, height)
+    middle = numpy.clip(yb, 0, height)
+    end = numpy.clip(yc + 1, 0, height)
+    middle = numpy.maximum(middle, top)
+    parts = (
+        (top, middle, xa, ya, xb - xa, yb - ya),
+        (middle, end, xb, yb, xc - xb, yc - yb),
+    )
+    spans = []
+    for (first, last, xp, yp, dx, dy) in parts:
+        rows = numpy.maximum(last - first, 0)
+        n = int(rows.sum())
+        y = numpy.repeat(first - numpy.cumsum(rows) + rows, rows)
+        y += numpy.arange(n)
+        # x of the crossing of an edge is xp + num / den with den > 0, it is
+        # rounded half up on the left and half down on the right (flat edges
+        # have den = 1 and num = 0, they contribute their first vertex).
+        x0 = x1 = None
+        for (xp, yp, dx, dy) in (
+            (xa, ya, xc - xa, yc - ya),
+            (xp, yp, dx, dy),
+        ):
+            den = numpy.repeat(numpy.maximum(2 * dy, 1), rows)
+            num = 2 * (y - numpy.repeat(yp, rows)) * numpy.repeat(dx, rows)
+            xp = numpy.repeat(xp, rows)
+            left = xp + (num + den // 2) // den
+            right = xp - (den // 2 - num) // den
+            if x0 is None:
+                (x0, x1) = (left, right)
+            else:
+                numpy.minimum(x0, left, out=x0)
+                numpy.maximum(x1, right, out=x1)
+        spans.append((y, x0, x1))
+    # triangles flat on a single row
+    flat = (ya == yc) & (ya >= 0) & (ya < height)
+    xs = tris[flat, :, 0]
+    spans.append((ya[flat], xs.min(axis=1), xs.max(axis=1)))
+    return tuple(numpy.concatenate(column) for column in zip(*spans))
+
+
+################################################################################
+def draw_spans(cover, y, x0, x1):
+    (height, width) = cover.shape
+    # spans sorted by band of rows (radix sort on a small integer key)
+    band = (y // band_lines).astype(numpy.int16)
+    order = numpy.argsort(band, kind="stable")
+    (band, y, x0, x1) = (band[order], y[order], x0[order], x1[order])
+    for (k, row) in enumerate(range(0, height, band_lines)):
+        (i0, i1) = numpy.searchsorted(band, (k, k + 1))
+        if i0 == i1:
+            continue
+        lines = min(band_lines, height - row)
+        size = lines * (width + 1)
+        base = (y[i0:i1] - row) * (width + 1)
+        diff = numpy.bincount(base + x0[i0:i1], minlength=size)
+        diff -= numpy.bincount(base + x1[i0:i1] + 1, minlength=size)
+        diff = diff.astype(numpy.int32).reshape(lines, width + 1)
+        cover[row : row + lines] |= numpy.cumsum(diff, axis=1)[:, :width] > 0
+
+
+################################################################################
+def benchmark(size=1201, factor=3, void_fraction=0.02):
+    # Upsampling of a 3" raster and filling of a few large voids.
+    global has_scipy
+    rng = numpy.random.default_rng(0)
+    raster = rng.uniform(0, 3000, (size, size)).astype(numpy.float32)
+    timer = time.time()
+    big = upsample(raster, factor)
+    print(
+        "upsample",
+        size,
+        "->",
+        big.shape[0],
+        ":",
+        round(time.time() - timer, 3),
+        "sec",
+    )
+    nodata = -32768
+    for _ in range(int(void_fraction * size * size / 2500)):
+        (y, x) = rng.integers(0, size - 50, 2)
+        raster[y : y + 50, x : x + 50] = nodata
+    void = raster == nodata
+    for width in (8, 64, 512):
+        timer = time.time()
+        hat_filter(big, width)
+        print(
+            "hat_filter",
+            big.shape[0],
+            "x",
+            big.shape[1],
+            ", width",
+            width,
+            ":",
+            round(time.time() - timer, 3),
+            "sec",
+        )
+    scipy_state = has_scipy
+    for with_scipy in (True, False) if scipy_state else (False,):
+        test = raster.copy()
+        has_scipy = with_scipy
+        timer = time.time()
+        fill_nodata(test, nodata)
+        elapsed = time.time() - timer
+        has_scipy = scipy_state
+        print(
+            "fill_nodata",
+            "(scipy)" if with_scipy else "(numpy)",
+            int(void.sum()),
+            "voids :",
+            round(elapsed, 3),
+            "sec, remaining voids :",
+            int((test == nodata).sum()),
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,195 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import functools
+import contextlib
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+
+has_resource = False
+try:
+    import resource
+
+    has_resource = True
+except:
+    pass
+
+################################################################################
+# Light weight instrumentation of the tile steps : named phases are timed
+# (number of calls, cumulated and longest duration, phases running in
+# several threads at once add up), counters record bytes downloaded and
+# written, and at the end of each step the figures go together with the peak
+# RSS (of the process and of its children, i.e. Triangle4XP) to a JSON and a
+# CSV report in the build directory of the tile.
+################################################################################
+
+write_reports = False
+
+phases = {}
+counters = {}
+lock = threading.Lock()
+step_start = time.time()
+
+################################################################################
+def reset():
+    global step_start
+    with lock:
+        phases.clear()
+        counters.clear()
+        step_start = time.time()
+
+
+################################################################################
+def record(name, elapsed):
+    with lock:
+        if name not in phases:
+            phases[name] = [0, 0, 0]
+        phase = phases[name]
+        phase[0] += 1
+        phase[1] += elapsed
+        phase[2] = max(phase[2], elapsed)
+
+
+################################################################################
+@contextlib.contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+################################################################################
+def timed(name):
+    # Decorator version of timer.
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+################################################################################
+def count(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+################################################################################
+def count_file(file_name):
+    # A file was written, we record it together with its size.
+    try:
+        size = os.path.getsize(file_name)
+    except:
+        return
+    count("files_written")
+    count("bytes_written", size)
+
+
+################################################################################
+def snapshot():
+    # Phases and counters recorded so far, e.g. by a worker process.
+    with lock:
+        return (
+            {name: list(phase) for (name, phase) in phases.items()},
+            dict(counters),
+        )
+
+
+################################################################################
+def merge(snapshot):
+    (other_phases, other_counters) = snapshot
+    with lock:
+        for (name, (calls, total, longest)) in other_phases.items():
+            if name not in phases:
+                phases[name] = [0, 0, 0]
+            phase = phases[name]
+            phase[0] += calls
+            phase[1] += total
+            phase[2] = max(phase[2], longest)
+        for (name, amount) in other_counters.items():
+            counters[name] = counters.get(name, 0) + amount
+
+
+################################################################################
+def peak_rss(who="self"):
+    # In bytes, None if not available (Windows).
+    if not has_resource:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    # kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+################################################################################
+def step_report():
+    with lock:
+        return {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed": round(time.time() - step_start, 3),
+            "phases": {
+                name: {
+                    "calls": calls,
+                    "total": round(total, 3),
+                    "max": round(longest, 3),
+                }
+                for (name, (calls, total, longest)) in sorted(phases.items())
+            },
+            "counters": dict(sorted(counters.items())),
+            "peak_rss": peak_rss("self"),
+            "peak_rss_children": peak_rss("children"),
+        }
+
+
+################################################################################
+def write_report(tile, step):
+    # The report of the tile keeps the last run of each step.
+    if not write_reports:
+        return 0
+    json_file = FNAMES.report_file(tile.build_dir, tile.lat, tile.lon, "json")
+    try:
+        with open(json_file, "r") as f:
+            report = json.load(f)
+    except:
+        report = {"tile": FNAMES.short_latlon(tile.lat, tile.lon), "steps": {}}
+    report["steps"][step] = step_report()
+    try:
+        with open(json_file + ".tmp", "w") as f:
+            json.dump(report, f, indent=1)
+        os.replace(json_file + ".tmp", json_file)
+        with open(json_file[:-4] + "csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["step", "kind", "name", "calls", "total", "max"])
+            for (step, data) in report["steps"].items():
+                writer.writerow([step, "step", "elapsed", 1, data["elapsed"], ""])
+                for (name, phase) in data["phases"].items():
+                    writer.writerow(
+                        [
+                            step,
+                            "phase",
+                            name,
+                            phase["calls"],
+                            phase["total"],
+                            phase["max"],
+                        ]
+                    )
+                for (name, value) in data["counters"].items():
+                    writer.writerow([step, "counter", name, "", value, ""])
+                for name in ("peak_rss", "peak_rss_children"):
+                    writer.writerow([step, "memory", name, "", data[name], ""])
+    except Exception as e:
+        UI.vprint(1, "WARNING: Could not write the run report", json_file)
+        UI.vprint(3, e)
+        return 0
+    UI.vprint(2, "   Run report written to", json_file)
+    return 1
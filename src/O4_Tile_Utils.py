@@ -1,43 +1,87 @@
 import os
 import time
+import copy
 import shutil
 import queue
 import threading
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_File_Names as FNAMES
 import O4_Imagery_Utils as IMG
+import O4_Imagery_Cache as ICACHE
 import O4_Vector_Map as VMAP
 import O4_Mesh_Utils as MESH
 import O4_Mask_Utils as MASK
 import O4_DSF_Utils as DSF
 import O4_Overlay_Utils as OVL
 from O4_Parallel_Utils import parallel_launch, parallel_join
+from O4_Parallel_Utils import parallel_dag_execute
 
 max_convert_slots = 4
+max_download_slots = 1
+max_batch_workers = 1
+batch_network_slots = 2
+batch_disk_slots = 1
 skip_downloads = False
 skip_converts = False
 
 ################################################################################
 def download_textures(tile, download_queue, convert_queue):
-    UI.vprint(1, "-> Opening download queue.")
-    done = 0
+    UI.vprint(
+        1,
+        "-> Opening download queue and",
+        max_download_slots,
+        "download worker(s).",
+    )
+    IMG.inflight_requests = threading.BoundedSemaphore(
+        IMG.max_inflight_requests
+    )
+    progress = {"done": 0, "lock": threading.Lock()}
+    workers = [
+        threading.Thread(
+            target=download_worker,
+            args=[tile, download_queue, convert_queue, progress],
+        )
+        for _ in range(max_download_slots)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if UI.red_flag:
+        UI.vprint(1, "Download process interrupted.")
+        return 0
+    UI.progress_bar(2, 100)
+    if progress["done"]:
+        UI.vprint(1, " *Download of textures completed.")
+        ICACHE.print_stats()
+    return 1
+
+################################################################################
+def download_worker(tile, download_queue, convert_queue, progress):
     while True:
         texture_attributes = download_queue.get()
         if isinstance(texture_attributes, str) and texture_attributes == "quit":
-            UI.progress_bar(2, 100)
-            break
+            # for the other workers
+            download_queue.put("quit")
+            return 1
         if IMG.build_jpeg_ortho(tile, *texture_attributes):
-            done += 1
-            UI.progress_bar(
-                2, int(100 * done / (done + download_queue.qsize()))
-            )
+            with progress["lock"]:
+                progress["done"] += 1
+                UI.progress_bar(
+                    2,
+                    int(
+                        100
+                        * progress["done"]
+                        / (progress["done"] + download_queue.qsize())
+                    ),
+                )
             convert_queue.put((tile, *texture_attributes))
         if UI.red_flag:
-            UI.vprint(1, "Download process interrupted.")
             return 0
-    if done:
-        UI.vprint(1, " *Download of textures completed.")
-    return 1
 
 ################################################################################
 def build_tile(tile):
@@ -45,6 +89,7 @@ def build_tile(tile):
         return 0
     UI.is_working = 1
     UI.red_flag = False
+    STATS.reset()
     UI.logprint(
         "Step 3 for tile lat=", tile.lat, ", lon=", tile.lon, ": starting."
     )
@@ -132,6 +177,11 @@ def build_tile(tile):
                 "conversion workers.",
             )
             dico_conv_progress = {"done": 0, "bar": 3}
+            if IMG.dds_encoder == "builtin" and max_convert_slots > 1:
+                IMG.dds_encoder_pool = ProcessPoolExecutor(
+                    max_workers=max_convert_slots,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
             convert_workers = parallel_launch(
                 IMG.convert_texture,
                 convert_queue,
@@ -147,6 +197,9 @@ def build_tile(tile):
             for _ in range(max_convert_slots):
                 convert_queue.put("quit")
             parallel_join(convert_workers)
+            if IMG.dds_encoder_pool:
+                IMG.dds_encoder_pool.shutdown()
+                IMG.dds_encoder_pool = None
             if UI.red_flag:
                 UI.vprint(1, "DDS conversion process interrupted.")
             elif dico_conv_progress["done"] >= 1:
@@ -182,12 +235,21 @@ def build_tile(tile):
             os.remove(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon))
         except:
             pass
+        try:
+            os.remove(
+                FNAMES.binary_mesh_file(
+                    FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+                )
+            )
+        except:
+            pass
         try:
             os.remove(FNAMES.apt_file(tile))
         except:
             pass
     if UI.cleaning_level > 1 and not tile.grouped:
         remove_unwanted_textures(tile)
+    STATS.write_report(tile, "dsf_imagery")
     UI.timings_and_bottom_line(timer)
     UI.logprint(
         "Step 3 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
@@ -215,6 +277,131 @@ def build_all(tile):
     UI.is_working = 0
     return 1
 
+################################################################################
+def tile_copy(tile, lat, lon):
+    # Each tile of a batch gets its own instance, so that steps (or worker
+    # processes) never share a mutable tile object.
+    dem = tile.dem
+    tile.dem = None
+    new_tile = copy.deepcopy(tile)
+    tile.dem = dem
+    (new_tile.lat, new_tile.lon) = (lat, lon)
+    new_tile.build_dir = FNAMES.build_dir(lat, lon, tile.custom_build_dir)
+    return new_tile
+
+################################################################################
+def run_tile_step(tile, step):
+    if step == "fetch":
+        return VMAP.prefetch_osm_data(tile)
+    elif step == "osm":
+        return VMAP.build_poly_file(tile)
+    elif step == "mesh":
+        return MESH.build_mesh(tile)
+    elif step == "mask":
+        return MASK.build_masks(tile)
+    elif step == "dsf":
+        return build_tile(tile)
+    elif step == "ovl":
+        return OVL.build_overlay(tile.lat, tile.lon)
+
+################################################################################
+def prepare_tile(tile, do_osm, do_mesh, do_dsf, do_ptc):
+    if do_ptc:
+        tile.read_from_config()
+    if do_osm or do_mesh or do_dsf:
+        try:
+            tile.make_dirs()
+        except:
+            return "dirs"
+    return None
+
+################################################################################
+def build_tile_steps(tile, do_osm, do_mesh, do_mask, do_dsf, do_ovl, do_ptc):
+    # Returns the name of the first step which failed, None if all went fine.
+    failed_step = prepare_tile(tile, do_osm, do_mesh, do_dsf, do_ptc)
+    if failed_step:
+        return failed_step
+    for (step, do_step) in (
+        ("osm", do_osm),
+        ("mesh", do_mesh),
+        ("mask", do_mask),
+        ("dsf", do_dsf),
+        ("ovl", do_ovl),
+    ):
+        if not do_step:
+            continue
+        if not run_tile_step(tile, step) or UI.red_flag:
+            return step
+    return None
+
+################################################################################
+def batch_worker_init(app_vars, stop_event):
+    # Worker processes are spawned, hence start from the module defaults and
+    # the saved global config, we push the current application variables.
+    for ((module_name, var), value) in app_vars.items():
+        setattr(importlib.import_module(module_name), var, value)
+    IMG.initialize_extents_dict()
+    IMG.initialize_color_filters_dict()
+    IMG.initialize_providers_dict()
+    IMG.initialize_combined_providers_dict()
+
+    def watch_stop_event():
+        stop_event.wait()
+        while True:
+            UI.red_flag = True
+            time.sleep(0.5)
+
+    threading.Thread(target=watch_stop_event, daemon=True).start()
+
+################################################################################
+def run_tile_step_in_worker(tile, step):
+    # Each worker process runs one step at a time, steps rely on the
+    # UI.is_working flag which is thus always free at this point.
+    UI.is_working = 0
+    try:
+        return run_tile_step(tile, step)
+    except Exception as e:
+        UI.lvprint(
+            0,
+            "ERROR: Batch worker crashed on step",
+            step,
+            "of tile",
+            FNAMES.short_latlon(tile.lat, tile.lon),
+            ":",
+            e,
+        )
+        return 0
+
+################################################################################
+def remove_from_tiles_todo(lat, lon):
+    try:
+        UI.gui.earth_window.canvas.delete(
+            UI.gui.earth_window.dico_tiles_todo[(lat, lon)]
+        )
+        UI.gui.earth_window.dico_tiles_todo.pop((lat, lon), None)
+    except:
+        pass
+
+################################################################################
+def print_batch_summary(list_lat_lon, results):
+    UI.lvprint(0, "Batch summary:")
+    nbr_ok = 0
+    for (lat, lon) in list_lat_lon:
+        if (lat, lon) not in results:
+            status = "not built"
+        else:
+            (failed_step, elapsed) = results[(lat, lon)]
+            if failed_step is None:
+                status = "ok (" + UI.nicer_timer(elapsed) + ")"
+                nbr_ok += 1
+            else:
+                status = "failed at step " + failed_step
+        UI.lvprint(0, "  ", FNAMES.short_latlon(lat, lon), ":", status)
+    UI.lvprint(
+        0, "  ", nbr_ok, "out of", len(list_lat_lon), "tiles fully built."
+    )
+    return nbr_ok == len(list_lat_lon)
+
 ################################################################################
 def build_tile_list(
     tile, list_lat_lon, do_osm, do_mesh, do_mask, do_dsf, do_ovl, do_ptc
@@ -226,6 +413,10 @@ def build_tile_list(
     UI.lvprint(
         0, "Batch build launched for a number of", len(list_lat_lon), "tiles."
     )
+    steps = (do_osm, do_mesh, do_mask, do_dsf, do_ovl, do_ptc)
+    if max_batch_workers > 1 and len(list_lat_lon) > 1:
+        return build_tile_list_in_processes(tile, list_lat_lon, steps, timer)
+    results = {}
     k = 0
     for (lat, lon) in list_lat_lon:
         k += 1
@@ -238,51 +429,165 @@ def build_tile_list(
             ":",
             FNAMES.short_latlon(lat, lon),
         )
-        (tile.lat, tile.lon) = (lat, lon)
-        tile.build_dir = FNAMES.build_dir(
-            tile.lat, tile.lon, tile.custom_build_dir
+        tile_timer = time.time()
+        failed_step = build_tile_steps(tile_copy(tile, lat, lon), *steps)
+        if UI.red_flag:
+            UI.exit_message_and_bottom_line()
+            print_batch_summary(list_lat_lon, results)
+            return 0
+        results[(lat, lon)] = (failed_step, time.time() - tile_timer)
+        if failed_step is None:
+            remove_from_tiles_todo(lat, lon)
+    UI.lvprint(
+        0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
+    )
+    return 1 if print_batch_summary(list_lat_lon, results) else 0
+
+################################################################################
+def build_tile_list_in_processes(tile, list_lat_lon, steps, timer):
+    # Pipelined batch : each tile is split in a chain of steps which are 
+    # scheduled on separate pools (network, cpu, disk) of worker processes,
+    # so that e.g. the OSM download of a tile overlaps the triangulation of
+    # another one. Masks of a tile wait for the meshes of its neighbours 
+    # within the batch since they also draw water from these.
+    # CFG imports this module, hence the late import.
+    import O4_Config_Utils as CFG
+
+    UI.is_working = 1
+    app_vars = CFG.app_vars_values()
+    (do_osm, do_mesh, do_mask, do_dsf, do_ovl, do_ptc) = steps
+    tile_steps = [
+        step
+        for (step, do_step) in (
+            ("fetch", do_osm),
+            ("osm", do_osm),
+            ("mesh", do_mesh),
+            ("mask", do_mask),
+            ("dsf", do_dsf),
         )
-        tile.dem = None
-        if do_ptc:
-            tile.read_from_config()
-        if do_osm or do_mesh or do_dsf:
-            tile.make_dirs()
-        if do_osm:
-            VMAP.build_poly_file(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_mesh:
-            MESH.build_mesh(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_mask:
-            MASK.build_masks(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_dsf:
-            build_tile(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
+        if do_step
+    ]
+    pools = {
+        "network": batch_network_slots,
+        "cpu": max_batch_workers,
+        "disk": batch_disk_slots,
+    }
+    step_pool = {
+        "fetch": "network",
+        "osm": "cpu",
+        "mesh": "cpu",
+        "mask": "cpu",
+        "dsf": "network",
+        "ovl": "disk",
+    }
+    results = {}
+    jobs = {}
+    for (lat, lon) in list_lat_lon:
+        tile_k = tile_copy(tile, lat, lon)
+        failed_step = prepare_tile(tile_k, do_osm, do_mesh, do_dsf, do_ptc)
+        if failed_step:
+            results[(lat, lon)] = (failed_step, 0)
+            continue
+        deps = ()
+        for step in tile_steps:
+            after = ()
+            if step == "mask":
+                after = tuple(
+                    ("mesh", lat + i, lon + j)
+                    for i in (-1, 0, 1)
+                    for j in (-1, 0, 1)
+                    if i or j
+                )
+            jobs[(step, lat, lon)] = (
+                run_tile_step_in_worker,
+                (tile_k, step),
+                step_pool[step],
+                deps,
+                after,
+            )
+            deps = ((step, lat, lon),)
         if do_ovl:
-            OVL.build_overlay(lat, lon)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        try:
-            UI.gui.earth_window.canvas.delete(
-                UI.gui.earth_window.dico_tiles_todo[(lat, lon)]
+            jobs[("ovl", lat, lon)] = (
+                run_tile_step_in_worker,
+                (tile_k, "ovl"),
+                step_pool["ovl"],
+                (),
+                (),
             )
-            UI.gui.earth_window.dico_tiles_todo.pop((lat, lon), None)
-        except:
-            pass
+    for (key, (task, args, pool, deps, after)) in jobs.items():
+        jobs[key] = (
+            task,
+            args,
+            pool,
+            deps,
+            tuple(dep for dep in after if dep in jobs),
+        )
+    steps_left = {}
+    finish_time = {}
+    for (step, lat, lon) in jobs:
+        steps_left[(lat, lon)] = steps_left.get((lat, lon), 0) + 1
+
+    def on_done(key, success, elapsed):
+        (step, lat, lon) = key
+        UI.vprint(
+            1,
+            "Tile",
+            FNAMES.short_latlon(lat, lon),
+            ": step",
+            step,
+            "ok" if success else ("failed" if success == 0 else "skipped"),
+        )
+        steps_left[(lat, lon)] -= 1
+        if not steps_left[(lat, lon)]:
+            finish_time[(lat, lon)] = time.time() - timer
+            UI.progress_bar(
+                1,
+                int(
+                    100
+                    * len([x for x in steps_left.values() if not x])
+                    / len(steps_left)
+                ),
+            )
+
+    # spawn rather than fork, we may be called from a GUI thread
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    UI.vprint(
+        1,
+        "-> Opening a pool of",
+        sum(pools.values()),
+        "tile build processes (network/cpu/disk slots :",
+        "/".join(str(pools[pool]) for pool in ("network", "cpu", "disk")),
+        ").",
+    )
+    with ProcessPoolExecutor(
+        sum(pools.values()),
+        mp_context=context,
+        initializer=batch_worker_init,
+        initargs=(app_vars, stop_event),
+    ) as executor:
+        job_results = parallel_dag_execute(
+            jobs, pools, executor, on_done, stop_event
+        )
+    for (lat, lon) in list_lat_lon:
+        if (lat, lon) in results:
+            continue
+        keys = [key for key in jobs if key[1:] == (lat, lon)]
+        failed = [key[0] for key in keys if job_results[key] == 0]
+        if failed:
+            results[(lat, lon)] = (failed[0], 0)
+        elif all(job_results[key] for key in keys):
+            results[(lat, lon)] = (None, finish_time[(lat, lon)])
+            remove_from_tiles_todo(lat, lon)
+    if UI.red_flag:
+        UI.exit_message_and_bottom_line()
+        print_batch_summary(list_lat_lon, results)
+        return 0
     UI.lvprint(
         0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
     )
-    return 1
+    UI.is_working = 0
+    return 1 if print_batch_summary(list_lat_lon, results) else 0
 
 ################################################################################
 def remove_unwanted_textures(tile):
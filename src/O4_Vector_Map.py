@@ -1,5 +1,6 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from math import pi, sin, cos, sqrt, atan, exp
 import numpy
 from shapely import geometry, ops
@@ -7,11 +8,13 @@ from shapely import geometry, ops
 # from PIL import Image, ImageDraw, ImageFilter
 import O4_DEM_Utils as DEM
 import O4_UI_Utils as UI
+import O4_Stats_Utils as STATS
 import O4_OSM_Utils as OSM
 import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Airport_Utils as APT
+import O4_Mesh_Utils as MESH
 
 good_imagery_list = ()
 
@@ -23,6 +26,7 @@ def build_poly_file(tile):
     UI.red_flag = 0
     # in case that was forgotten by the user
     tile.iterate = 0
+    STATS.reset()
     # update the lat/lon scaling factor in VECT
     VECT.scalx = cos((tile.lat + 0.5) * pi / 180)
     # Let's go !
@@ -45,6 +49,11 @@ def build_poly_file(tile):
     poly_file = FNAMES.input_poly_file(tile)
     vector_map = VECT.Vector_Map()
 
+    # Missing OSM layers are downloaded concurrently beforehand, the
+    # include_* steps below then read them from the cache (and try again on
+    # their own for the ones which failed).
+    prefetch_osm_data(tile)
+
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
@@ -165,12 +174,18 @@ def build_poly_file(tile):
         else:
             vector_map.seeds["SEA"] = [numpy.array([0.5, 0.5])]
     vector_map.snap_to_grid(9) 
-    vector_map.write_node_file(node_file)
-    vector_map.write_poly_file(poly_file)
+    if MESH.use_binary_io(tile):
+        (nodes, segments, holes, regions) = vector_map.triangle_arrays()
+        MESH.write_binary_node_file(node_file, nodes)
+        MESH.write_binary_poly_file(poly_file, segments, holes, regions)
+    else:
+        vector_map.write_node_file(node_file)
+        vector_map.write_poly_file(poly_file)
 
     UI.vprint(
         1, "\nFinal number of constrained edges :", len(vector_map.dico_edges)
     )
+    STATS.write_report(tile, "vector")
     UI.timings_and_bottom_line(timer)
     UI.logprint(
         "Step 1 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
@@ -178,12 +193,118 @@ def build_poly_file(tile):
     return 1
 
 
+################################################################################
+def osm_layer_queries(tile, cached_suffix):
+    # Overpass queries and tags of interest for each (cached) OSM layer used
+    # by Step 1.
+    if cached_suffix == "airports":
+        return (
+            [('node["aeroway"]', 'way["aeroway"]', 'rel["aeroway"]')],
+            ["all"],
+        )
+    elif cached_suffix == "big_roads":
+        return (
+            [
+                'way["highway"="motorway"]',
+                'way["highway"="trunk"]',
+                'way["highway"="primary"]',
+                'way["highway"="secondary"]',
+                'way["railway"="rail"]',
+                'way["railway"="narrow_gauge"]',
+            ],
+            ["bridge", "tunnel"],
+        )
+    elif cached_suffix == "small_roads":
+        queries = ['way["highway"="tertiary"]']
+        if tile.road_level >= 3:
+            queries += [
+                'way["highway"="unclassified"]',
+                'way["highway"="residential"]',
+            ]
+        if tile.road_level >= 4:
+            queries += ['way["highway"="service"]']
+        if tile.road_level >= 5:
+            queries += ['way["highway"="track"]']
+        return (queries, ["bridge", "tunnel"])
+    elif cached_suffix == "coastline":
+        return (['way["natural"="coastline"]'], [])
+    elif cached_suffix == "water":
+        return (
+            [
+                'rel["natural"="water"]',
+                'rel["waterway"="riverbank"]',
+                'way["natural"="water"]',
+                'way["waterway"="riverbank"]',
+                'way["waterway"="dock"]',
+            ],
+            ["name"],
+        )
+
+################################################################################
+def osm_layers_for_tile(tile):
+    # The OSM layers which Step 1 will ask to Overpass for this tile, custom
+    # coastline and water data are left aside.
+    cached_suffixes = ["airports"]
+    if tile.road_level:
+        cached_suffixes.append("big_roads")
+    if tile.road_level >= 2:
+        cached_suffixes.append("small_roads")
+    if not (
+        os.path.isfile(FNAMES.custom_coastline(tile.lat, tile.lon))
+        or os.path.isdir(FNAMES.custom_coastline_dir(tile.lat, tile.lon))
+    ):
+        cached_suffixes.append("coastline")
+    if not (
+        os.path.isfile(FNAMES.custom_water(tile.lat, tile.lon))
+        or os.path.isdir(FNAMES.custom_water_dir(tile.lat, tile.lon))
+    ):
+        cached_suffixes.append("water")
+    return cached_suffixes
+
+################################################################################
+def prefetch_osm_data(tile):
+    # Network part of Step 1 only : fills the OSM cache of the tile so that 
+    # build_poly_file can afterwards run from disk.
+    UI.vprint(
+        1,
+        "-> Fetching OSM data for tile",
+        FNAMES.short_latlon(tile.lat, tile.lon),
+    )
+    if not os.path.exists(FNAMES.osm_dir(tile.lat, tile.lon)):
+        os.makedirs(FNAMES.osm_dir(tile.lat, tile.lon))
+    cached_suffixes = [
+        cached_suffix
+        for cached_suffix in osm_layers_for_tile(tile)
+        if not os.path.isfile(
+            FNAMES.osm_cached(tile.lat, tile.lon, cached_suffix)
+        )
+    ]
+    if not cached_suffixes:
+        return 1
+
+    def fetch_layer(cached_suffix):
+        (queries, tags_of_interest) = osm_layer_queries(tile, cached_suffix)
+        return OSM.OSM_queries_to_OSM_layer(
+            queries,
+            OSM.OSM_layer(),
+            tile.lat,
+            tile.lon,
+            tags_of_interest,
+            cached_suffix=cached_suffix,
+        )
+
+    # the layers are independent, their downloads all go at once
+    with ThreadPoolExecutor(max_workers=len(cached_suffixes)) as executor:
+        results = list(executor.map(fetch_layer, cached_suffixes))
+    if UI.red_flag:
+        return 0
+    return int(all(results))
+
 ################################################################################
 def include_airports(vector_map, tile):
     UI.vprint(0, "-> Dealing with airports")
     airport_layer = OSM.OSM_layer()
-    queries = [('node["aeroway"]', 'way["aeroway"]', 'rel["aeroway"]')]
-    tags_of_interest = ["all"]
+    (queries, tags_of_interest) = osm_layer_queries(tile, "airports")
     if not OSM.OSM_queries_to_OSM_layer(
         queries,
         airport_layer,
@@ -239,12 +360,11 @@ def include_roads(vector_map, tile, apt_array, apt_area):
             return True
         if filtered_segs >= tile.max_levelled_segs:
             return False
+        (alt_way, alt_shifted) = tile.dem.alt_vec_ways(
+            [way, VECT.shift_way(way, tile.lane_width)]
+        )
         return (
-            numpy.abs(
-                tile.dem.alt_vec(way)
-                - tile.dem.alt_vec(VECT.shift_way(way, tile.lane_width))
-            )
-            >= tile.road_banking_limit
+            numpy.abs(alt_way - alt_shifted) >= tile.road_banking_limit
         ).any()
 
     def alt_vec_shift(way):
@@ -253,19 +373,11 @@ def include_roads(vector_map, tile, apt_array, apt_area):
     if not tile.road_level:
         return
     UI.vprint(0, "-> Dealing with roads")
-    tags_of_interest = ["bridge", "tunnel"]
     # Need to evaluate if including bridges is better or worse
     tags_for_exclusion = set(["bridge", "tunnel"])
     # tags_for_exclusion=set(["tunnel"])
     road_layer = OSM.OSM_layer()
-    queries = [
-        'way["highway"="motorway"]',
-        'way["highway"="trunk"]',
-        'way["highway"="primary"]',
-        'way["highway"="secondary"]',
-        'way["railway"="rail"]',
-        'way["railway"="narrow_gauge"]',
-    ]
+    (queries, tags_of_interest) = osm_layer_queries(tile, "big_roads")
     if not OSM.OSM_queries_to_OSM_layer(
         queries,
         road_layer,
@@ -287,16 +399,7 @@ def include_roads(vector_map, tile, apt_array, apt_area):
         return 0
     if tile.road_level >= 2:
         road_layer = OSM.OSM_layer()
-        queries = ['way["highway"="tertiary"]']
-        if tile.road_level >= 3:
-            queries += [
-                'way["highway"="unclassified"]',
-                'way["highway"="residential"]',
-            ]
-        if tile.road_level >= 4:
-            queries += ['way["highway"="service"]']
-        if tile.road_level >= 5:
-            queries += ['way["highway"="track"]']
+        (queries, tags_of_interest) = osm_layer_queries(tile, "small_roads")
         if not OSM.OSM_queries_to_OSM_layer(
             queries,
             road_layer,
@@ -388,8 +491,7 @@ def include_sea(vector_map, tile):
             sea_layer.write_to_file(custom_coastline)
         custom_source = True
     else:
-        queries = ['way["natural"="coastline"]']
-        tags_of_interest = []
+        (queries, tags_of_interest) = osm_layer_queries(tile, "coastline")
         if not OSM.OSM_queries_to_OSM_layer(
             queries,
             sea_layer,
@@ -522,14 +624,7 @@ def include_water(vector_map, tile):
             )
             water_layer.write_to_file(custom_water)
     else:
-        queries = [
-            'rel["natural"="water"]',
-            'rel["waterway"="riverbank"]',
-            'way["natural"="water"]',
-            'way["waterway"="riverbank"]',
-            'way["waterway"="dock"]',
-        ]
-        tags_of_interest = ["name"]
+        (queries, tags_of_interest) = osm_layer_queries(tile, "water")
         if not OSM.OSM_queries_to_OSM_layer(
             queries,
             water_layer,
@@ -666,7 +761,6 @@ def include_patches(vector_map, tile):
             UI.vprint(1, "     Error in treating", pfile_name, ", skipped.")
         patches_list.append(pfile_name[:-10])
         dw = patch_layer.dicosmw
-        dn = patch_layer.dicosmn
         df = patch_layer.dicosmfirst
         dt = patch_layer.dicosmtags
         # reorganize them so that untagged dummy ways are treated last (due to
@@ -678,9 +772,7 @@ def include_patches(vector_map, tile):
             df["w"].difference(dt["w"])
         )
         for wayid in waylist:
-            way = numpy.array(
-                [dn[nodeid] for nodeid in dw[wayid]], dtype=float
-            )
+            way = patch_layer.way_coords(wayid)
             way = way - numpy.array([[tile.lon, tile.lat]])
             alti_way_orig = tile.dem.alt_vec(way)
             cplx_way = False
@@ -1,10 +1,11 @@
-from math import ceil, sqrt, atan2
+from math import ceil, sqrt, atan2, hypot
 import numpy
 from shapely import geometry, affinity
 from shapely import ops
 from rtree import index
 import O4_UI_Utils as UI
 import O4_Geo_Utils as GEO
+import O4_Stats_Utils as STATS
 
 # Some functions further down rely not only on a vector structure but also on a
 # metric (distances of course but more importantly angles and normals).
@@ -17,6 +18,9 @@ scaly = 1
 # These parameters are meant to be updated at runtime by the program, typically
 # with scaly=1 and scalx=cos(lat*pi/180).
 
+# Ways are sampled for their altitude by batches of at least that many nodes.
+batch_nodes = 65536
+
 
 # The first class we introduce is a vector map: this is simply a set of nodes
 # and edges with an insert_edge function that will compute and resolve all edge
@@ -38,6 +42,70 @@ scaly = 1
 # MultiLineStrings or MultiPolygons as defined in the SHAPELY Python module by
 # Sean Gillies.
 
+################################################################################
+class Edge_Index:
+    # The bounding boxes of the edges of a vector map, in an rtree which is
+    # bulk loaded (STR packing) from the live edges whenever the deleted ones
+    # it still holds outnumber them : deletions, by far the slowest rtree
+    # operation, are otherwise only recorded. Edges inserted without checks
+    # are kept aside until the next query and then bulk loaded with the rest
+    # if they are numerous enough.
+
+    def __init__(self):
+        # small nodes make for much faster insertions and queries of the
+        # (mostly tiny) edges bounding boxes than the defaults (100)
+        self.properties = index.Property()
+        self.properties.leaf_capacity = 16
+        self.properties.index_capacity = 16
+        self.properties.near_minimum_overlap_factor = 8
+        self.bboxes = {}
+        self.tree = index.Index(properties=self.properties)
+        self.stale = 0
+        self.pending = []
+
+    def insert(self, edge_id, bbox, bulk=False):
+        self.bboxes[edge_id] = bbox
+        if bulk:
+            self.pending.append(edge_id)
+        else:
+            self.tree.insert(edge_id, bbox)
+
+    def delete(self, edge_id):
+        del self.bboxes[edge_id]
+        self.stale += 1
+
+    def load(self):
+        if self.bboxes:
+            self.tree = index.Index(
+                (
+                    (edge_id, bbox, None)
+                    for (edge_id, bbox) in self.bboxes.items()
+                ),
+                properties=self.properties,
+            )
+        else:
+            self.tree = index.Index(properties=self.properties)
+        self.stale = 0
+        self.pending = []
+
+    def intersection(self, bbox):
+        # ids of the edges whose bounding box meets bbox, in creation order
+        if self.stale > max(len(self.bboxes), 4096) or len(
+            self.pending
+        ) > max(len(self.bboxes) // 8, 4096):
+            self.load()
+        elif self.pending:
+            for edge_id in self.pending:
+                if edge_id in self.bboxes:
+                    self.tree.insert(edge_id, self.bboxes[edge_id])
+            self.pending = []
+        return sorted(
+            edge_id
+            for edge_id in self.tree.intersection(bbox)
+            if edge_id in self.bboxes
+        )
+
+
 ################################################################################
 class Vector_Map:
 
@@ -64,7 +132,7 @@ class Vector_Map:
         # inverse of dico_nodes : ids to 2-uples (coordinates)
         self.edges_dico = {}
         # inverse of dico_edges : ids to 2-uples (end-points ids)
-        self.ebbox = index.Index()
+        self.ebbox = Edge_Index()
         self.data_nodes = {}
         # keys are ints (ids) and values are floats (vector altitude)
         # could easily be upgraded to arrays if necessary
@@ -103,7 +171,7 @@ class Vector_Map:
             return 1
         return 0
 
-    def create_edge(self, nodeid0, nodeid1, marker):
+    def create_edge(self, nodeid0, nodeid1, marker, bulk=False):
         if self.update_edge(nodeid0, nodeid1, marker):
             return
         edge_id = self.next_edge_id
@@ -111,12 +179,15 @@ class Vector_Map:
         self.dico_edges[(nodeid0, nodeid1)] = edge_id
         self.edges_dico[edge_id] = (nodeid0, nodeid1)
         self.data_edges[edge_id] = marker
-        self.ebbox.insert(edge_id, self.bbox_from_node_ids(nodeid0, nodeid1))
+        self.ebbox.insert(
+            edge_id, self.bbox_from_node_ids(nodeid0, nodeid1), bulk
+        )
         return
 
     def insert_edge(self, id0, id1, marker, check=True):
         if not check:
-            self.create_edge(id0, id1, marker)
+            self.create_edge(id0, id1, marker, bulk=True)
+            return
         if self.update_edge(id0, id1, marker):
             return
         weight_list = []
@@ -125,18 +196,24 @@ class Vector_Map:
         # to existing edges
         id_list = []  # ids of these points
         task = self.ebbox.intersection(
-            self.bbox_from_node_ids(id0, id1), objects=True
+            self.bbox_from_node_ids(id0, id1)
         )  # which other edges to search for instersection
-        for hits in task:
-            edge_id = hits.id
-            edge_bbox = hits.bbox
+        (a, b) = (self.nodes_dico[id0], self.nodes_dico[id1])
+        (a_array, b_array) = (None, None)
+        for edge_id in task:
             (id2, id3) = self.edges_dico[edge_id]
             c_marker = self.data_edges[edge_id]
+            # most candidates are discarded without numpy
+            if are_apart(a, b, self.nodes_dico[id2], self.nodes_dico[id3]):
+                continue
+            if a_array is None:
+                a_array = numpy.array(a, dtype=float)
+                b_array = numpy.array(b, dtype=float)
             # check for encroachment, slightly different than intersection, see
             # the details below in the function definition
             coeffs = self.are_encroached(
-                numpy.array(self.nodes_dico[id0], dtype = float),
-                numpy.array(self.nodes_dico[id1], dtype = float),
+                a_array,
+                b_array,
                 numpy.array(self.nodes_dico[id2], dtype = float),
                 numpy.array(self.nodes_dico[id3], dtype = float),
             )
@@ -161,7 +238,7 @@ class Vector_Map:
                     del self.dico_edges[(id2, id3)]
                     del self.edges_dico[edge_id]
                     del self.data_edges[edge_id]
-                    self.ebbox.delete(edge_id, edge_bbox)
+                    self.ebbox.delete(edge_id)
                     # and create two new ones
                     self.create_edge(id2, c_id, c_marker)
                     self.create_edge(c_id, id3, c_marker)
@@ -182,7 +259,7 @@ class Vector_Map:
                         del self.dico_edges[(id2, id3)]
                         del self.edges_dico[edge_id]
                         del self.data_edges[edge_id]
-                        self.ebbox.delete(edge_id, edge_bbox)
+                        self.ebbox.delete(edge_id)
                         # create new ones as needed
                         self.create_edge(
                             ordered_data[i - 1][1], ordered_data[i][1], c_marker
@@ -362,6 +439,7 @@ class Vector_Map:
                 and [alpha0, alpha1, beta0, beta1]
             )
 
+    @STATS.timed("encode_multipolygon")
     def encode_MultiPolygon(
         self,
         multipol,
@@ -382,7 +460,20 @@ class Vector_Map:
             todo = len(iterloop)
         step = int(todo / 100) + 1
         done = 0
+        pending = []
+        pending_nodes = 0
+
+        def flush():
+            for (way, alti_way) in zip(pending, batch_alt(pending, pol_to_alt)):
+                self.insert_way(
+                    numpy.hstack([way, alti_way.reshape((len(way), 1))]),
+                    marker,
+                    check,
+                )
+            pending.clear()
+
         for pol in iterloop:
+            pending_ways = len(pending)
             if cut:
                 pol = cut_to_tile(pol)
             if simplify:
@@ -399,18 +490,14 @@ class Vector_Map:
                 way = numpy.array(polygon.exterior.coords)
                 if refine:
                     way = refine_way(way, refine)
-                alti_way = pol_to_alt(way).reshape((len(way), 1))
-                self.insert_way(numpy.hstack([way, alti_way]), marker, check)
+                pending.append(way)
                 for linestring in polygon.interiors:
                     if linestring.is_empty:
                         continue
                     way = numpy.array(linestring.coords)
                     if refine:
                         way = refine_way(way, refine)
-                    alti_way = pol_to_alt(way).reshape((len(way), 1))
-                    self.insert_way(
-                        numpy.hstack([way, alti_way]), marker, check
-                    )
+                    pending.append(way)
                 try:
                     if marker in self.seeds:
                         self.seeds[marker].append(
@@ -427,13 +514,19 @@ class Vector_Map:
                         "with node ",
                         list(polygon.exterior.coords)[0],
                     )
+            pending_nodes += sum(len(way) for way in pending[pending_ways:])
+            if pending_nodes >= batch_nodes:
+                flush()
+                pending_nodes = 0
             done += 1
             if done % step == 0:
                 UI.progress_bar(1, int(100 * done / todo))
                 if UI.red_flag:
                     return 0
+        flush()
         return 1
 
+    @STATS.timed("encode_multilinestring")
     def encode_MultiLineString(
         self,
         multilinestring,
@@ -448,7 +541,20 @@ class Vector_Map:
         todo = len(multilinestring.geoms)
         step = int(todo / 100) + 1
         done = 0
+        pending = []
+        pending_nodes = 0
+
+        def flush():
+            for (way, alti_way) in zip(pending, batch_alt(pending, line_to_alt)):
+                self.insert_way(
+                    numpy.hstack([way, alti_way.reshape((len(way), 1))]),
+                    marker,
+                    check,
+                )
+            pending.clear()
+
         for line in multilinestring.geoms:
+            pending_ways = len(pending)
             if not skip_cut:
                 line = cut_to_tile(line)
             for linestring in ensure_MultiLineString(line).geoms:
@@ -457,13 +563,17 @@ class Vector_Map:
                 way = numpy.array(linestring.coords)
                 if refine:
                     way = refine_way(way, refine)
-                alti_way = line_to_alt(way).reshape((len(way), 1))
-                self.insert_way(numpy.hstack([way, alti_way]), marker, check)
+                pending.append(way)
+            pending_nodes += sum(len(way) for way in pending[pending_ways:])
+            if pending_nodes >= batch_nodes:
+                flush()
+                pending_nodes = 0
             done += 1
             if done % step == 0:
                 UI.progress_bar(1, int(100 * done / todo))
                 if UI.red_flag:
                     return 0
+        flush()
         return 1
 
     def snap_to_grid(self, digits):
@@ -612,6 +722,70 @@ class Vector_Map:
         f.close()
         return
 
+    def triangle_arrays(self):
+        # same content as write_node_file and write_poly_file, as arrays for
+        # the binary files of Triangle4XP : nodes (x, y, altitude), segments
+        # (end-points ids, marker), holes (x, y) and regions (x, y, marker)
+        nodes = numpy.array(
+            [
+                tuple(self.nodes_dico[idx]) + (self.data_nodes[idx],)
+                for idx in sorted(self.nodes_dico.keys())
+            ],
+            dtype=numpy.float64,
+        ).reshape(-1, 3)
+        segments = numpy.array(
+            [
+                tuple(self.edges_dico[edge_id]) + (self.data_edges[edge_id],)
+                for edge_id in self.edges_dico
+            ],
+            dtype=numpy.int32,
+        ).reshape(-1, 3)
+        holes = numpy.array(self.holes, dtype=numpy.float64).reshape(-1, 2)
+        regions = []
+        for (key, marker) in sorted(
+            self.dico_attributes.items(), key=lambda item: item[1]
+        ):
+            for seed in self.seeds.get(key, []):
+                regions.append((seed[0], seed[1], marker))
+        regions = numpy.array(regions, dtype=numpy.float64).reshape(-1, 3)
+        return (nodes, segments, holes, regions)
+
+
+################################################################################
+def are_apart(a, b, c, d):
+    # True when are_encroached(a, b, c, d) is bound to be False : the closed
+    # segments a->b and c->d only share an end-point and make a clear angle,
+    # or they are further apart than the tolerances used there allow for.
+    # Plain floats are much faster than numpy for such small computations.
+    ((ax, ay), (bx, by), (cx, cy), (dx, dy)) = (a, b, c, d)
+    (abx, aby, dcx, dcy) = (bx - ax, by - ay, cx - dx, cy - dy)
+    (ab, dc) = (hypot(abx, aby), hypot(dcx, dcy))
+    if (ax == dx and ay == dy) or (bx == cx and by == cy):
+        return abx * dcx + aby * dcy < 0.999 * ab * dc
+    if (ax == cx and ay == cy) or (bx == dx and by == dy):
+        return abx * dcx + aby * dcy > -0.999 * ab * dc
+    (acx, acy, adx, ady) = (cx - ax, cy - ay, dx - ax, dy - ay)
+    cross_c = abx * acy - aby * acx
+    cross_d = abx * ady - aby * adx
+    cross_a = dcx * acy - dcy * acx
+    cross_b = dcx * (cy - by) - dcy * (cx - bx)
+    if (cross_c <= 0 <= cross_d or cross_d <= 0 <= cross_c) and (
+        cross_a <= 0 <= cross_b or cross_b <= 0 <= cross_a
+    ):
+        return False
+    # not crossing, their distance is that of an end-point to the other one
+    tol = 1e-6 * (ab + dc + hypot(acx, acy))
+    for (px, py, qx, qy, ux, uy, u) in (
+        (ax, ay, cx, cy, -dcx, -dcy, dc),
+        (bx, by, cx, cy, -dcx, -dcy, dc),
+        (cx, cy, ax, ay, abx, aby, ab),
+        (dx, dy, ax, ay, abx, aby, ab),
+    ):
+        t = min(max(((px - qx) * ux + (py - qy) * uy) / (u * u), 0), 1)
+        if hypot(px - qx - t * ux, py - qy - t * uy) <= tol:
+            return False
+    return True
+
 
 ################################################################################
 def split_polygon(input_pol, max_size, count=0):
@@ -1372,6 +1546,16 @@ def point_in_polygon(point, polygon):
         return True
 
 
+################################################################################
+def batch_alt(ways, to_alt):
+    # DEM samplers are pointwise, all ways then go through a single call,
+    # other altitude functions (e.g. shifted ways) are called way by way.
+    dem = getattr(to_alt, "__self__", None)
+    if hasattr(dem, "alt_vec_ways") and to_alt == dem.alt_vec:
+        return dem.alt_vec_ways(ways)
+    return [to_alt(way) for way in ways]
+
+
 ################################################################################
 def dummy_alt(way):
     return numpy.zeros(way.shape[0])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of Ortho4XP are imported flat from src, as Ortho4XP.py does.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
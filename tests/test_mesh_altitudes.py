@@ -0,0 +1,121 @@
+import types
+import numpy
+import pytest
+import O4_File_Names as FNAMES
+import O4_Mesh_Utils as MESH
+
+
+def reference_tile(build_dir):
+    # A 1x1 degree grid mesh, in shuffled order, with lakes (WATER and
+    # SEA_EQUIV, some also INTERP_ALT), sea and dummy triangles.
+    rng = numpy.random.default_rng(3)
+    n = 120
+    (lats, lons) = numpy.meshgrid(
+        numpy.linspace(0, 1, n), numpy.linspace(0, 1, n), indexing="ij"
+    )
+    nodes = numpy.column_stack(
+        (
+            lons.ravel(),
+            lats.ravel(),
+            rng.uniform(-5, 300, n * n),
+            rng.uniform(-1, 1, (n * n, 2)),
+            rng.uniform(0, 200, n * n),
+        )
+    )
+    (i, j) = numpy.meshgrid(numpy.arange(n - 1), numpy.arange(n - 1))
+    a = (i * n + j).ravel()
+    tris = numpy.vstack(
+        (
+            numpy.column_stack((a, a + 1, a + n + 1)),
+            numpy.column_stack((a, a + n + 1, a + n)),
+        )
+    )
+    (i, j) = (numpy.tile(i.ravel(), 2), numpy.tile(j.ravel(), 2))
+    attr = numpy.zeros(len(tris), dtype=numpy.int64)
+    for _ in range(12):
+        (y, x, r) = rng.integers(0, n, 2).tolist() + [rng.integers(5, 30)]
+        attr[(i - y) ** 2 + (j - x) ** 2 < r * r] = rng.choice([1, 4, 5, 9])
+    attr[i > 0.8 * n] = 2
+    order = rng.permutation(len(tris))
+    (tris, attr) = (tris[order], attr[order])
+    tile = types.SimpleNamespace(lat=45, lon=6, iterate=0, build_dir=build_dir)
+    with open(FNAMES.output_node_file(tile), "w") as f:
+        f.write("%d 2 4 0\n" % len(nodes))
+        MESH.write_indexed_lines(f, "%d" + " %.15f" * 6 + "\n", nodes)
+    with open(FNAMES.output_ele_file(tile), "w") as f:
+        f.write("%d 3 1\n" % len(tris))
+        MESH.write_indexed_lines(
+            f, "%d %d %d %d %d\n", numpy.column_stack((tris + 1, attr))
+        )
+    return tile
+
+
+def sequential_altitudes(tile):
+    # The former implementation, one triangle at a time.
+    f_node = open(FNAMES.output_node_file(tile), "r")
+    nbr_pt = int(f_node.readline().split()[0])
+    vertices = numpy.zeros(6 * nbr_pt)
+    for i in range(0, nbr_pt):
+        vertices[6 * i : 6 * i + 6] = [
+            float(x) for x in f_node.readline().split()[1:7]
+        ]
+    f_node.close()
+    f_ele = open(FNAMES.output_ele_file(tile), "r")
+    nbr_tri = int(f_ele.readline().split()[0])
+    (water_tris, sea_tris, interp_alt_tris) = (set(), set(), set())
+    for i in range(nbr_tri):
+        line = f_ele.readline()
+        if line[-2] == "0":
+            continue
+        (v1, v2, v3, attr) = [int(x) - 1 for x in line.split()[1:5]]
+        attr += 1
+        if attr >= 8:
+            interp_alt_tris.add((v1, v2, v3))
+        elif attr & 2:
+            sea_tris.add((v1, v2, v3))
+        elif attr & 1 or attr & 4:
+            water_tris.add((v1, v2, v3))
+    f_ele.close()
+    z = vertices[2::6]
+    for _ in range(tile.water_smoothing):
+        for tri in water_tris:
+            z[list(tri)] = (z[tri[0]] + z[tri[1]] + z[tri[2]]) / 3
+    for tri in sea_tris:
+        if tile.sea_smoothing_mode == "zero":
+            z[list(tri)] = 0
+        elif tile.sea_smoothing_mode == "mean":
+            z[list(tri)] = (z[tri[0]] + z[tri[1]] + z[tri[2]]) / 3
+        else:
+            z[list(tri)] = numpy.maximum(z[list(tri)], 0)
+    for tri in interp_alt_tris:
+        for v in tri:
+            vertices[6 * v + 2] = vertices[6 * v + 5]
+            vertices[6 * v + 3 : 6 * v + 5] = 0
+    return vertices
+
+
+@pytest.mark.parametrize("sea_smoothing_mode", ["zero", "mean", "max"])
+def test_altitudes_match_the_sequential_levelling(
+    tmp_path, sea_smoothing_mode
+):
+    tile = reference_tile(str(tmp_path))
+    tile.water_smoothing = 2
+    tile.sea_smoothing_mode = sea_smoothing_mode
+    expected = sequential_altitudes(tile)
+    assert numpy.array_equal(MESH.post_process_nodes_altitudes(tile), expected)
+
+
+def test_disjoint_batches_follow_the_triangle_order():
+    tris = numpy.random.default_rng(4).integers(0, 300, (2000, 3))
+    tris = tris[(tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2])]
+    tris = tris[tris[:, 0] != tris[:, 2]]
+    batches = MESH.disjoint_batches(tris)
+    assert numpy.array_equal(
+        numpy.sort(numpy.concatenate(batches)), numpy.arange(len(tris))
+    )
+    last = numpy.full(300, -1)
+    for (k, batch) in enumerate(batches):
+        assert len(numpy.unique(tris[batch])) == 3 * len(batch)
+        # right after the batch of the last earlier triangle sharing a vertex
+        assert (last[tris[batch]].max(axis=1) == k - 1).all()
+        last[tris[batch]] = k
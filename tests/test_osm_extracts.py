@@ -0,0 +1,110 @@
+import json
+import os
+import numpy
+import O4_File_Names as FNAMES
+import O4_OSM_Extracts as EXTRACTS
+
+
+def test_queries_on_keys_not_ingested_go_to_overpass(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(EXTRACTS, "stores", {})
+    os.makedirs(FNAMES.osm_extract_dir("region"))
+    with open(
+        os.path.join(FNAMES.osm_extract_dir("region"), "index.json"), "w"
+    ) as f:
+        json.dump(
+            {
+                "format": EXTRACTS.extract_format,
+                "source": "region.osm.pbf",
+                "keys": ["highway", "natural"],
+                "tiles": [[39, -78]],
+            },
+            f,
+        )
+    assert EXTRACTS.store_for_bbox((39, -78, 40, -77)) == "region"
+    assert EXTRACTS.store_answers("region", 'way["highway"="motorway"]')
+    assert EXTRACTS.store_answers(
+        "region", ('way["natural"="water"]', 'rel["natural"="water"]')
+    )
+    assert not EXTRACTS.store_answers("region", 'way["landuse"="reservoir"]')
+    assert not EXTRACTS.store_answers(
+        "region", ('way["natural"="water"]', 'way["landuse"="reservoir"]')
+    )
+    assert not EXTRACTS.store_answers(
+        "region", 'way["highway"="motorway"]["landuse"]'
+    )
+    assert not EXTRACTS.store_answers("region", "not a query")
+
+
+EXTRACT = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <bounds minlat="38.5" minlon="-78.5" maxlat="40.5" maxlon="-76.5"/>
+ <node id="2" lat="39.5" lon="-77.05"/>
+ <node id="5" lat="39.5" lon="-77.9"/>
+ <node id="6" lat="39.6" lon="-77.1"/>
+ <node id="7" lat="39.4" lon="-77.4"/>
+ <node id="8" lat="39.4" lon="-77.3"/>
+ <node id="9" lat="39.45" lon="-77.35"/>
+ <node id="11" lat="39.9" lon="-77.1"/>
+ <node id="12" lat="39.95" lon="-77.05"/>
+ <node id="13" lat="39.3" lon="-77.6"/>
+ <node id="14" lat="39.35" lon="-77.6"/>
+ <node id="20" lat="39.5" lon="-77.5"/>
+ <way id="100"><nd ref="20"/><nd ref="2"/>
+  <tag k="highway" v="primary"/></way>
+ <way id="101"><nd ref="11"/><nd ref="12"/>
+  <tag k="highway" v="primary"/></way>
+ <way id="102"><nd ref="6"/><nd ref="5"/>
+  <tag k="highway" v="primary"/></way>
+ <way id="103"><nd ref="7"/><nd ref="8"/><nd ref="9"/><nd ref="7"/></way>
+ <way id="104"><nd ref="13"/><nd ref="14"/>
+  <tag k="landuse" v="reservoir"/></way>
+ <relation id="200">
+  <member type="way" ref="103" role="outer"/>
+  <tag k="type" v="multipolygon"/><tag k="natural" v="water"/>
+ </relation>
+</osm>
+"""
+
+
+def test_ingested_extract_answers_as_overpass(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(EXTRACTS, "stores", {})
+    monkeypatch.setattr(EXTRACTS, "loaded_tiles", {})
+    (tmp_path / "region.osm").write_text(EXTRACT)
+    assert EXTRACTS.ingest_extract("region.osm")
+    bbox = (39.2, -77.8, 39.8, -77.2)
+    assert EXTRACTS.store_for_bbox(bbox) == "region"
+    # ways crossing the edge of the bbox (with a node inside or not) come
+    # with all their nodes, in id order
+    osm_data = EXTRACTS.query_osm_data(
+        "region", 'way["highway"="primary"]', bbox
+    )
+    assert list(osm_data.way_ids) == [100, 102]
+    assert list(osm_data.way_starts) == [0, 2]
+    assert list(osm_data.way_refs) == [20, 2, 6, 5]
+    assert list(osm_data.node_ids) == [2, 5, 6, 20]
+    assert numpy.array_equal(
+        numpy.asarray(osm_data.node_coords).reshape(-1, 2),
+        [[-77.05, 39.5], [-77.9, 39.5], [-77.1, 39.6], [-77.5, 39.5]],
+    )
+    assert osm_data.tags["w"] == {
+        0: {"highway": "primary"},
+        1: {"highway": "primary"},
+    }
+    # relations pull in their member ways, untagged ones included
+    osm_data = EXTRACTS.query_osm_data("region", 'rel["natural"="water"]', bbox)
+    assert osm_data.rel_ids == [200]
+    assert osm_data.rel_members == [[(103, "outer")]]
+    assert list(osm_data.way_ids) == [103]
+    assert list(osm_data.way_refs) == [7, 8, 9, 7]
+    assert list(osm_data.node_ids) == [7, 8, 9]
+    # objects without the ingested keys are not in the store
+    assert not EXTRACTS.store_answers("region", 'way["landuse"="reservoir"]')
+    # bboxes not covered by the store are left to Overpass
+    for bbox in ((40.2, -77.8, 40.8, -77.2), (39.2, -77.8, 40.2, -77.2)):
+        assert EXTRACTS.store_for_bbox(bbox) is None
+        assert (
+            EXTRACTS.query_osm_data("region", 'way["highway"="primary"]', bbox)
+            is None
+        )
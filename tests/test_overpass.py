@@ -0,0 +1,176 @@
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import pytest
+import O4_Async_Utils as AIO
+import O4_OSM_Utils as OSM
+import O4_UI_Utils as UI
+
+ANSWER = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="39.1" lon="-77.9"/>
+ <node id="2" lat="39.2" lon="-77.8"/>
+ <way id="10"><nd ref="1"/><nd ref="2"/><tag k="highway" v="{}"/></way>
+</osm>
+"""
+
+
+class stand_in_server:
+    # A local Overpass stand-in, behaviour(value, hit) returns the (status,
+    # headers, delay) of the answer to the hit-th request (from 0), value is
+    # the one of the first filter of the query, echoed in the answer.
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.hits = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)["data"][0]
+                value = re.search(r'"[^"]*"="([^"]*)"', query).group(1)
+                with server.lock:
+                    hit = len(server.hits)
+                    server.hits.append(time.monotonic())
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                (status, headers, delay) = server.behaviour(value, hit)
+                time.sleep(delay)
+                with server.lock:
+                    server.active -= 1
+                body = ANSWER.format(value).encode()
+                self.send_response(status)
+                for (key, val) in headers.items():
+                    self.send_header(key, val)
+                self.send_header("Content-Length", str(len(body)))
+                try:
+                    self.end_headers()
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # the client cancelled the request
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/api/interpreter" % (
+            self.httpd.server_port
+        )
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def dead_url():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return "http://127.0.0.1:%d/api/interpreter" % port
+
+
+async def no_backoff(attempt, base=2, cap=30):
+    pass
+
+
+@pytest.fixture
+def overpass(monkeypatch, tmp_path):
+    # Fresh client state, no waits between tentatives so that only the
+    # cool downs (Retry-After) delay the retries, and no local OSM data.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(OSM, "overpass_servers", {})
+    monkeypatch.setattr(OSM, "overpass_health", {})
+    monkeypatch.setattr(OSM, "overpass_cool_down", {})
+    monkeypatch.setattr(OSM, "max_osm_tentatives", 4)
+    monkeypatch.setattr(AIO, "limiters", {})
+    monkeypatch.setattr(AIO, "backoff", no_backoff)
+    servers = []
+
+    def serve(code, behaviour):
+        server = stand_in_server(behaviour)
+        servers.append(server)
+        OSM.overpass_servers[code] = server.url
+        return server
+
+    yield serve
+    for server in servers:
+        server.close()
+
+
+def test_concurrency_is_capped_per_server(overpass, monkeypatch):
+    server = overpass("A", lambda value, hit: (200, {}, 0.3))
+    monkeypatch.setattr(OSM, "overpass_server_choice", "A")
+    queries = ['way["highway"="q%d"]' % i for i in range(6)]
+    for max_requests in (2, 3):
+        server.max_active = 0
+        monkeypatch.setattr(OSM, "max_overpass_requests", max_requests)
+        osm_layer = OSM.OSM_layer()
+        assert OSM.OSM_queries_to_OSM_layer(queries, osm_layer, 39, -78)
+        # a changed limit takes effect
+        assert server.max_active == max_requests
+
+
+@pytest.mark.parametrize("status", [429, 504])
+def test_retry_after_is_honoured(overpass, monkeypatch, status):
+    server = overpass(
+        "A",
+        lambda value, hit: (status, {"Retry-After": "1"}, 0)
+        if hit == 0
+        else (200, {}, 0),
+    )
+    monkeypatch.setattr(OSM, "overpass_server_choice", "A")
+    content = OSM.get_overpass_data('way["highway"="q"]', (39, -78, 40, -77))
+    assert content and b'v="q"' in content
+    assert len(server.hits) == 2
+    assert server.hits[1] - server.hits[0] >= 0.9
+    assert OSM.overpass_health["A"] < 1
+
+
+def test_failover_away_from_a_dead_server(overpass, monkeypatch):
+    OSM.overpass_servers["DEAD"] = dead_url()
+    server = overpass("B", lambda value, hit: (200, {}, 0))
+    monkeypatch.setattr(OSM, "overpass_server_choice", "DEAD")
+    content = OSM.get_overpass_data('way["highway"="q"]', (39, -78, 40, -77))
+    assert content and b'v="q"' in content
+    assert len(server.hits) == 1
+    assert OSM.overpass_health["DEAD"] <= 0.5 < OSM.overpass_health["B"]
+    assert OSM.pick_overpass_server() == "B"
+
+
+def test_answers_are_merged_in_query_order(overpass, monkeypatch):
+    # the later the query, the sooner its answer
+    overpass("A", lambda value, hit: (200, {}, 0.1 * (5 - int(value[1:]))))
+    monkeypatch.setattr(OSM, "overpass_server_choice", "A")
+    monkeypatch.setattr(OSM, "max_overpass_requests", 6)
+    queries = ['way["highway"="q%d"]' % i for i in range(6)]
+    osm_layer = OSM.OSM_layer()
+    assert OSM.OSM_queries_to_OSM_layer(queries, osm_layer, 39, -78)
+    assert [osm_layer.dicosmtags["w"][-1 - i]["highway"] for i in range(6)] == [
+        "q%d" % i for i in range(6)
+    ]
+
+
+def test_pending_downloads_are_cancelled_on_interruption(overpass, monkeypatch):
+    def interrupt(value, hit):
+        UI.red_flag = True
+        return (200, {}, 0.3)
+
+    server = overpass("A", interrupt)
+    monkeypatch.setattr(OSM, "overpass_server_choice", "A")
+    monkeypatch.setattr(OSM, "max_overpass_requests", 1)
+    monkeypatch.setattr(UI, "red_flag", False)
+    queries = ['way["highway"="q%d"]' % i for i in range(4)]
+    osm_layer = OSM.OSM_layer()
+    assert not OSM.OSM_queries_to_OSM_layer(queries, osm_layer, 39, -78)
+    time.sleep(1)
+    # the next one may have started before the cancellation, not the others
+    assert len(server.hits) <= 2
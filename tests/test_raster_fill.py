@@ -0,0 +1,41 @@
+import numpy
+import pytest
+import O4_Raster_Utils as RASTER
+
+
+@pytest.mark.parametrize("with_scipy", [False, True])
+@pytest.mark.parametrize("void_fraction", [0.3, 0.9, 0.995])
+def test_voids_take_the_nearest_valid_pixel(
+    monkeypatch, with_scipy, void_fraction
+):
+    if with_scipy and not RASTER.has_scipy:
+        pytest.skip("scipy is not installed")
+    monkeypatch.setattr(RASTER, "has_scipy", with_scipy)
+    rng = numpy.random.default_rng(5)
+    (ny, nx) = (61, 47)
+    nodata = -32768
+    # each pixel holds its own flat index, which tells where a fill came from
+    raster = numpy.arange(ny * nx, dtype=numpy.float64).reshape(ny, nx)
+    void = rng.random((ny, nx)) < void_fraction
+    void[ny // 2, nx // 3] = False
+    raster[void] = nodata
+    assert RASTER.fill_nodata(raster, nodata)
+    (y, x) = numpy.nonzero(void)
+    (vy, vx) = numpy.nonzero(~void)
+    nearest = ((y[:, None] - vy) ** 2 + (x[:, None] - vx) ** 2).min(axis=1)
+    source = raster[y, x].astype(numpy.int64)
+    assert not void.ravel()[source].any()
+    assert numpy.array_equal(
+        (y - source // nx) ** 2 + (x - source % nx) ** 2, nearest
+    )
+
+
+def test_wide_and_tall_windows_agree():
+    void = numpy.random.default_rng(6).random((23, 71)) < 0.8
+    (iy, ix) = RASTER.nearest_valid(void)
+    (ix_t, iy_t) = RASTER.nearest_valid(void.T)
+    (y, x) = numpy.indices(void.shape)
+    assert numpy.array_equal(
+        (y - iy) ** 2 + (x - ix) ** 2, (y - iy_t.T) ** 2 + (x - ix_t.T) ** 2
+    )
+    assert not void[iy, ix].any()
@@ -0,0 +1,163 @@
+import io
+import os
+import subprocess
+import numpy
+import pytest
+import O4_Mesh_Utils as MESH
+import O4_Vector_Utils as VECT
+
+
+def small_vector_map():
+    vector_map = VECT.Vector_Map()
+    rng = numpy.random.default_rng(0)
+    for _ in range(40):
+        way = numpy.cumsum(rng.uniform(-0.05, 0.05, (6, 2)), axis=0) + 0.5
+        vector_map.insert_way(
+            numpy.hstack([way, rng.uniform(0, 900, (6, 1))]), "DUMMY"
+        )
+    square = numpy.array(
+        [[0.1, 0.1, 5], [0.3, 0.1, 5], [0.3, 0.3, 5], [0.1, 0.3, 5]]
+    )
+    square = numpy.vstack([square, square[:1]])
+    vector_map.insert_way(square, "WATER")
+    vector_map.seeds["WATER"] = [numpy.array([0.2, 0.2])]
+    vector_map.seeds["SEA"] = [numpy.array([0.9, 0.95])]
+    vector_map.holes = [(0.25, 0.25)]
+    return vector_map
+
+
+def test_binary_input_files_convert_to_the_text_ones(tmp_path):
+    vector_map = small_vector_map()
+    vector_map.write_node_file(str(tmp_path / "text.node"))
+    vector_map.write_poly_file(str(tmp_path / "text.poly"))
+    (nodes, segments, holes, regions) = vector_map.triangle_arrays()
+    (node_file, poly_file) = (tmp_path / "bin.node", tmp_path / "bin.poly")
+    MESH.write_binary_node_file(str(node_file), nodes)
+    MESH.write_binary_poly_file(str(poly_file), segments, holes, regions)
+    assert MESH.is_binary_triangle_file(str(node_file))
+    assert MESH.is_binary_triangle_file(str(poly_file))
+    MESH.convert_binary_input_files(str(node_file), str(poly_file))
+    assert node_file.read_bytes() == (tmp_path / "text.node").read_bytes()
+    assert poly_file.read_bytes() == (tmp_path / "text.poly").read_bytes()
+
+
+def test_triangle_sections_round_trip():
+    rng = numpy.random.default_rng(1)
+    for (real_cols, int_cols) in ((3, 0), (0, 3), (2, 1)):
+        reals = rng.uniform(-1e3, 1e3, (17, real_cols))
+        ints = rng.integers(-(2 ** 31), 2 ** 31, (17, int_cols))
+        f = io.BytesIO()
+        MESH.write_triangle_section(f, MESH.TRI_TRIANGLES, reals, ints)
+        f.seek(0)
+        (reals_read, ints_read) = MESH.read_triangle_section(
+            f, MESH.TRI_TRIANGLES
+        )
+        assert numpy.array_equal(reals_read, reals)
+        assert numpy.array_equal(ints_read, ints)
+
+
+def test_read_binary_triangle_file_inverts_write_triangle_section(tmp_path):
+    reals = numpy.random.default_rng(2).uniform(0, 1, (100, 3))
+    ints = numpy.arange(300, dtype=numpy.int32).reshape(100, 3)
+    file_name = str(tmp_path / "tile.1.ele")
+    with open(file_name, "wb") as f:
+        MESH.write_triangle_section(f, MESH.TRI_TRIANGLES, reals, ints)
+    (reals_read, ints_read) = MESH.read_binary_triangle_file(
+        file_name, MESH.TRI_TRIANGLES
+    )
+    assert numpy.array_equal(reals_read, reals)
+    assert numpy.array_equal(ints_read, ints)
+
+
+def test_text_files_are_not_binary(tmp_path):
+    vector_map = small_vector_map()
+    vector_map.write_node_file(str(tmp_path / "text.node"))
+    vector_map.write_poly_file(str(tmp_path / "text.poly"))
+    assert not MESH.is_binary_triangle_file(str(tmp_path / "text.node"))
+    assert not MESH.is_binary_triangle_file(str(tmp_path / "text.poly"))
+    assert not MESH.is_binary_triangle_file(str(tmp_path / "missing.ele"))
+
+
+def run_triangle4xp(build_dir, binary):
+    # Step 2 on the small vector map, over a flat 121x121 DEM, with the
+    # input files written as Step 1 does in the given mode.
+    vector_map = small_vector_map()
+    # the tile boundary, the hole would swallow the WATER square
+    frame = numpy.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 0]])
+    vector_map.insert_way(frame.astype(numpy.float64), "DUMMY")
+    vector_map.holes = []
+    vector_map.snap_to_grid(9)
+    for idx in vector_map.data_nodes:
+        # as carried by the text files
+        vector_map.data_nodes[idx] = round(vector_map.data_nodes[idx], 9)
+    os.makedirs(build_dir)
+    (node_file, poly_file) = (
+        os.path.join(build_dir, "Data.node"),
+        os.path.join(build_dir, "Data.poly"),
+    )
+    if binary:
+        (nodes, segments, holes, regions) = vector_map.triangle_arrays()
+        MESH.write_binary_node_file(node_file, nodes)
+        MESH.write_binary_poly_file(poly_file, segments, holes, regions)
+    else:
+        vector_map.write_node_file(node_file)
+        vector_map.write_poly_file(poly_file)
+    alt_file = os.path.join(build_dir, "Data.alt")
+    (y, x) = numpy.mgrid[0:121, 0:121] / 120
+    (300 + 200 * numpy.sin(6 * x) * numpy.cos(4 * y)).astype(
+        numpy.float32
+    ).tofile(alt_file)
+    weight_file = os.path.join(build_dir, "Data.weight")
+    numpy.ones((1001, 1001), dtype=numpy.float32).tofile(weight_file)
+    subprocess.run(
+        [
+            MESH.Triangle4XP_cmd.strip(),
+            "-pq10AuYB" + ("b" if binary else "") + "QPS500000",
+            "78700",
+            "111120",
+            "121",
+            "121",
+            "0",
+            "0",
+            "1",
+            "1",
+            "-32768",
+            "2",
+            alt_file,
+            weight_file,
+            poly_file,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        timeout=120,
+    )
+    return os.path.join(build_dir, "Data.1")
+
+
+@pytest.mark.skipif(
+    not os.path.isfile(MESH.Triangle4XP_cmd.strip())
+    or not MESH.has_binary_io(),
+    reason="no Triangle4XP binary with the -b switch",
+)
+def test_triangle4xp_binary_mode_matches_text_mode(tmp_path):
+    text = run_triangle4xp(str(tmp_path / "text"), False)
+    binary = run_triangle4xp(str(tmp_path / "binary"), True)
+    assert MESH.is_binary_triangle_file(binary + ".node")
+    assert MESH.is_binary_triangle_file(binary + ".ele")
+    assert not MESH.is_binary_triangle_file(text + ".node")
+    (_, text_nodes, _) = MESH.read_triangle_file(text + ".node", numpy.float64)
+    (node_reals, node_ints) = MESH.read_binary_triangle_file(
+        binary + ".node", MESH.TRI_NODES
+    )
+    # coordinates and all the attributes of the nodes
+    assert node_ints.shape[1] == 0
+    assert node_reals.shape == text_nodes[:, 1:].shape
+    assert numpy.array_equal(node_reals, text_nodes[:, 1:])
+    (_, text_tris, _) = MESH.read_triangle_file(text + ".ele", numpy.int64)
+    (ele_reals, ele_ints) = MESH.read_binary_triangle_file(
+        binary + ".ele", MESH.TRI_TRIANGLES
+    )
+    # vertices and region attribute of the triangles
+    assert numpy.array_equal(ele_ints[:, :3], text_tris[:, 1:4])
+    assert ele_reals.shape[1] == text_tris.shape[1] - 4
+    assert numpy.array_equal(ele_reals, text_tris[:, 4:])